@@ -1,125 +1,111 @@
-from db import get_all_habits, get_longest_streak_all_habits, get_habit_details, get_longest_streak_one_habit, get_habits_by_periodicity
+from db import iter_habit_pages, get_streak_leaderboard, get_habit_details, get_longest_streak_one_habit, DEFAULT_USER_ID
 
 class Analysis:
     """Class to handle the analysis of habits and their streaks. The class contains methods to display the list of habits, the longest streak of all habits, the longest streak of a specific habit, and the list of habits by periodicity."""
-    def display_habit_list(self, db, created_by, is_active):
-        """Method to display the list of habits retrieved from the database.
+    def render_habit_pages(self, db, created_by, is_active, periodicity=None, page_size=20, user_id=DEFAULT_USER_ID):
+        """Generator of the list of habits as text, one page of page_size habits at a time.
+        The pages are read from the db module with iter_habit_pages: a page is only queried and formatted when it is requested.
         Parameter:
             - created_by ('user' or 'predefined')
             - is_active (1 if created by user, 0 if predefined).
-        The method get_all_habits is called from the db module to retrieve the list of habits (a tuple of lists)."""
-        habit_list = get_all_habits(db, created_by, is_active)
-        for habit in habit_list:
-            # Access the habit id
-            habit_id = habit[0]
-            print("Habit # ", habit_id)
-
-            # Access the task name
-            task_name = habit[1]
-            print("Task Name:", task_name)
-
-            # Access the periodicity
-            periodicity = habit[2]
-            print("Periodicity:", periodicity)
-
-            # Access the creation date
-            creation_date = habit[3]
-            print("Creation Date:", creation_date)
-
-            # Access the creation date
-            update_date = habit[4]
-            print("Last update on:", update_date, "\n")
-
+            - periodicity: daily, weekly or monthly to list only the habits with this periodicity, None (default) for all habits.
+            - user_id: the user owning the habits (DEFAULT_USER_ID by default)."""
+        for page in iter_habit_pages(db, created_by, is_active, page_size, periodicity, user_id):
+            yield "".join(f"Habit #  {habit_id}\n"
+                          f"Task Name: {task_name}\n"
+                          f"Periodicity: {habit_periodicity}\n"
+                          f"Creation Date: {creation_date}\n"
+                          f"Last update on: {update_date} \n\n"
+                          for habit_id, task_name, habit_periodicity, creation_date, update_date in page)
+
+    def display_pages(self, pages):
+        """Method to print pages of text one after the other. Before printing the next page, the user is asked to press Enter
+        (or to type q to stop the list), so a long list does not flood the terminal."""
+        page = next(pages, None)
+        while page is not None:
+            print(page, end="")
+            page = next(pages, None)
+            if page is not None and input("Press Enter to see more habits or type q to stop: ").strip().lower() == "q":
+                pages.close()
+                break
+
+    def display_habit_list(self, db, created_by, is_active, user_id=DEFAULT_USER_ID, page_size=20):
+        """Method to display the list of habits retrieved from the database, page_size habits at a time.
+        Parameter:
+            - created_by ('user' or 'predefined')
+            - is_active (1 if created by user, 0 if predefined).
+            - user_id: the user owning the habits (DEFAULT_USER_ID by default).
+        The pages are rendered by render_habit_pages."""
+        self.display_pages(self.render_habit_pages(db, created_by, is_active, None, page_size, user_id))
         print("End of list.")
 
-    def display_longest_streak_all_habits(self, db, created_by, is_active):
+    def display_longest_streak_all_habits(self, db, created_by, is_active, user_id=DEFAULT_USER_ID):
         """Method to display the longest streak of all habits (active and inactive).
-        The method get_longest_streak_all_habits is called from the db module to retrieve the longest streak of all habits.
-        The method get_habit_details is called from the db module to retrieve name and periodicity of the habit with the longest streak to display complete information.
+        The method get_streak_leaderboard is called from the db module to retrieve the longest streak of all habits together with the name and periodicity of its habit.
         The information is then displayed to the user.
         Parameters:
             - created_by ('user' or 'predefined')
-            - is_active (1 if created by user, 0 if predefined)."""
+            - is_active (1 if created by user, 0 if predefined).
+            - user_id: the user owning the habits (DEFAULT_USER_ID by default)."""
         # Get the longest streak of all habits
-        longest_streak = get_longest_streak_all_habits(db, created_by, is_active)
-
-        # Get the habit details
-        habit_id = longest_streak[0]
-        habit_details = get_habit_details(db, habit_id, created_by, is_active)
+        leaderboard = get_streak_leaderboard(db, created_by, is_active, 1, user_id=user_id)
+        if not leaderboard:
+            print("No streak data available.")
+            return
+        habit_id, task_name, habit_periodicity, streak, started_on, ended_on = leaderboard[0]
 
         # Access the periodicity to display the correct information
-        if habit_details[2] == "daily":
+        if habit_periodicity == "daily":
             periodicity = "day(s)"
-        elif habit_details[2] == "weekly":
+        elif habit_periodicity == "weekly":
             periodicity = "week(s)"
-        elif habit_details[2] == "monthly":
+        elif habit_periodicity == "monthly":
             periodicity = "month(s)"
 
         # Display all information regarding the longest streak
-        if longest_streak[3] is None:
-            print(f"The longest streak of all habits is habit #", longest_streak[0], ", ", habit_details[1], "is", longest_streak[1], " ", periodicity, ". It started on", longest_streak[2], "and is still ongoing.\n")
+        if ended_on is None:
+            print(f"The longest streak of all habits is habit #", habit_id, ", ", task_name, "is", streak, " ", periodicity, ". It started on", started_on, "and is still ongoing.\n")
         else:
-            print(f"The longest streak of all habits is habit #", longest_streak[0], ", ", habit_details[1], "is", longest_streak[1], " ", periodicity, ". It started on", longest_streak[2], "and ended on", longest_streak[3], "\n")
+            print(f"The longest streak of all habits is habit #", habit_id, ", ", task_name, "is", streak, " ", periodicity, ". It started on", started_on, "and ended on", ended_on, "\n")
 
-    def display_longest_streak_one_habit(self, db, habit_id, created_by, is_active):
+    def display_longest_streak_one_habit(self, db, habit_id, created_by, is_active, user_id=DEFAULT_USER_ID):
         """Method to display the longest streak of a specific habit. habit_id is entered by the user.
         The method get_longest_streak_one_habit is called from the db module to retrieve the longest streak of the habit.
         The information is then displayed to the user.
         Parameter:
             - habit_id: the unique identifier of the habit.
             - created_by ('user' or 'predefined')
-            - is_active (1 if created by user, 0 if predefined)."""
-        streak = get_longest_streak_one_habit(db, habit_id, created_by, is_active)
+            - is_active (1 if created by user, 0 if predefined).
+            - user_id: the user owning the habit (DEFAULT_USER_ID by default)."""
+        streak = get_longest_streak_one_habit(db, habit_id, created_by, is_active, user_id)
 
         # Get the habit details
-        habit_details = get_habit_details(db, habit_id, created_by, is_active)
+        habit_details = get_habit_details(db, habit_id, created_by, is_active, user_id)
 
         # Access the periodicity to display the correct information
-        if habit_details[2] == "daily":
+        if habit_details.periodicity == "daily":
             periodicity = "day(s)"
-        elif habit_details[2] == "weekly":
+        elif habit_details.periodicity == "weekly":
             periodicity = "week(s)"
-        elif habit_details[2] == "monthly":
+        elif habit_details.periodicity == "monthly":
             periodicity = "month(s)"
 
         if streak is not None:
             # If there is no end date, the streak is still ongoing
-            if streak[3] is None:
-                print(f"Longest streak for habit #", habit_id, ", ", habit_details[1], "is", streak[1], " ", periodicity, ". It started on", streak[2], "and is still ongoing.\n")
+            if streak.ended_on is None:
+                print(f"Longest streak for habit #", habit_id, ", ", habit_details.task, "is", streak.streak, " ", periodicity, ". It started on", streak.started_on, "and is still ongoing.\n")
             else:
-                print(f"Longest streak for habit #", habit_id, ", ", habit_details[1], "is", streak[1], " ", periodicity, ". It started on", streak[2], "and ended on", streak[3], "\n")
+                print(f"Longest streak for habit #", habit_id, ", ", habit_details.task, "is", streak.streak, " ", periodicity, ". It started on", streak.started_on, "and ended on", streak.ended_on, "\n")
         else:
             print(f"No streak data available for habit #{habit_id}.")
 
 
-    def display_habits_by_periodicity(self, db, periodicity, created_by, is_active):
-        """Method to display the list of habits by periodicity.
-        The method get_all_habits is called from the db module to retrieve the list of habits (a tuple of lists).
-        The list is then filtered by periodicity and displayed to the user.
+    def display_habits_by_periodicity(self, db, periodicity, created_by, is_active, user_id=DEFAULT_USER_ID, page_size=20):
+        """Method to display the list of habits by periodicity, page_size habits at a time.
+        The pages are rendered by render_habit_pages, filtered by periodicity in the query.
         Parameter:
             - periodicity # daily, weekly, monthly
             - created_by ('user' or 'predefined')
             - is_active (1 if created by user, 0 if predefined).
-        Returns the list of habits with the requested periodicity."""
-        habit_list = get_habits_by_periodicity(db, periodicity, created_by, is_active)
-
-        for habit in habit_list:
-            # Access the habit id
-            habit_id = habit[0]
-            print("Habit # ", habit_id)
-
-            # Access the task name
-            task_name = habit[1]
-            print("Task Name:", task_name)
-
-            # Access the periodicity
-            periodicity = habit[2]
-            print("Periodicity:", periodicity)
-
-            # Access the creation date
-            creation_date = habit[3]
-            print("Creation Date:", creation_date)
-
-            # Access the creation date
-            update_date = habit[4]
-            print("Last update on:", update_date, "\n")
\ No newline at end of file
+            - user_id: the user owning the habits (DEFAULT_USER_ID by default)."""
+        self.display_pages(self.render_habit_pages(db, created_by, is_active, periodicity, page_size, user_id))
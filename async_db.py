@@ -0,0 +1,162 @@
+# Contains the asyncio counterpart of the db module, to use the habit database from an asyncio application without blocking the event loop.
+# Writes are queued to a single writer thread that commits them in groups (one commit and one fsync for all the writes waiting at that moment),
+# reads run on a pool of threads each having its own read-only connection.
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import db
+
+
+def _write_method(function):
+    """Return an async method applying function of the db module on the writer thread."""
+    async def method(self, *args, **kwargs):
+        return await self._write(function, *args, **kwargs)
+    method.__name__ = function.__name__
+    method.__doc__ = f"Async version of db.{function.__name__}, committed together with the other writes pending at the same time."
+    return method
+
+
+def _read_method(function):
+    """Return an async method running function of the db module on a reader thread."""
+    async def method(self, *args, **kwargs):
+        return await self._read(function, *args, **kwargs)
+    method.__name__ = function.__name__
+    method.__doc__ = f"Async version of db.{function.__name__}, run on a read-only connection."
+    return method
+
+
+class AsyncDatabase:
+    """Class to use the db module from asyncio code. Use it as an async context manager: async with AsyncDatabase("main.db") as database: ...
+    The methods have the same parameters as the functions of the db module, without the connection.
+    Attributes:
+        - name: The SQLite file
+        - max_pending_writes: The size of the write queue, writers wait when it is full instead of piling up in memory
+        - max_batch: The maximum number of writes committed together
+        - writes: The number of writes applied
+        - commits: The number of commits done (writes / commits is the average group size)
+    Methods:
+        - start: Method to start the writer (called by async with)
+        - close: Method to apply the pending writes and stop the threads (called at the end of async with)"""
+
+    def __init__(self, name="main.db", max_pending_writes=1000, max_batch=500, readers=4):
+        self.name = name
+        self.max_pending_writes = max_pending_writes
+        self.max_batch = max_batch
+        self.writes = 0
+        self.commits = 0
+        self._reader_count = readers
+        self._readers = ThreadPoolExecutor(max_workers=readers, thread_name_prefix="habit-reader")
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="habit-writer")
+        self._queue = None
+        self._writer_task = None
+        self._db = None
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc, traceback):
+        await self.close()
+
+    async def start(self):
+        """Method to open the writer connection (on the writer thread, which is the only one using it) and start the group commit loop."""
+        loop = asyncio.get_running_loop()
+        self._db = await loop.run_in_executor(self._writer, db.get_db, self.name)
+        self._queue = asyncio.Queue(maxsize=self.max_pending_writes)
+        self._writer_task = asyncio.create_task(self._group_commit_loop())
+
+    async def close(self):
+        """Method to apply the pending writes, close the connections and stop the threads.
+        The read-only connections are closed by their own reader thread (an sqlite3 connection cannot be closed from another thread)."""
+        if self._writer_task is not None:
+            await self._queue.put(None)
+            await self._writer_task
+            self._writer_task = None
+        if self._db is not None:
+            await asyncio.get_running_loop().run_in_executor(self._writer, self._db.close)
+            self._db = None
+        # One task per reader thread: the barrier holds each task until all the threads have one, so no thread runs two of them
+        barrier = threading.Barrier(self._reader_count)
+
+        def close_reader():
+            db.close_read_dbs()
+            barrier.wait()
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*(loop.run_in_executor(self._readers, close_reader) for _ in range(self._reader_count)))
+        self._writer.shutdown()
+        self._readers.shutdown()
+
+    async def _write(self, function, *args, **kwargs):
+        """Queue a write and wait until it is committed. Returns the result of the function or raises its exception."""
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((function, args, kwargs, future))
+        return await future
+
+    async def _read(self, function, *args, **kwargs):
+        """Run a read on a reader thread with the read-only connection of that thread."""
+        return await asyncio.get_running_loop().run_in_executor(self._readers, lambda: function(db.get_read_db(self.name), *args, **kwargs))
+
+    async def _group_commit_loop(self):
+        """Take all the writes waiting in the queue (up to max_batch) and apply them on the writer thread in a single transaction."""
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            batch = [await self._queue.get()]
+            while len(batch) < self.max_batch and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            if None in batch:
+                stopping = True
+                batch = [write for write in batch if write is not None]
+            if not batch:
+                continue
+            try:
+                outcomes = await loop.run_in_executor(self._writer, self._apply_batch, batch)
+            except Exception as error:
+                # The commit failed: none of the writes of the group were saved
+                outcomes = [(False, error)] * len(batch)
+            for (_, _, _, future), (succeeded, value) in zip(batch, outcomes):
+                if future.cancelled():
+                    continue
+                if succeeded:
+                    future.set_result(value)
+                else:
+                    future.set_exception(value)
+
+    def _apply_batch(self, batch):
+        """Apply a group of writes in a single transaction (writer thread). Each write runs in its own savepoint,
+        so a failing write is rolled back alone and the others are still committed.
+        The write lock is taken when the transaction starts: writes reading before they write could not upgrade a read snapshot
+        that another connection committed over. The cached habit rows changed by the group are invalidated after the commit (see db.transaction).
+        Returns the list of (succeeded, result or exception) of the writes."""
+        outcomes = []
+        with db.transaction(self._db, immediate=True):
+            for function, args, kwargs, _ in batch:
+                self._db.execute("SAVEPOINT async_write;")
+                try:
+                    outcomes.append((True, function(self._db, *args, **kwargs)))
+                except Exception as error:
+                    self._db.execute("ROLLBACK TO async_write;")
+                    outcomes.append((False, error))
+                self._db.execute("RELEASE async_write;")
+        self.writes += len(batch)
+        self.commits += 1
+        return outcomes
+
+    add_user = _write_method(db.add_user)
+    add_habit = _write_method(db.add_habit)
+    update_habit = _write_method(db.update_habit)
+    delete_habit = _write_method(db.delete_habit)
+    add_checkoff = _write_method(db.add_checkoff)
+    add_checkoffs_bulk = _write_method(db.add_checkoffs_bulk)
+    start_streak = _write_method(db.start_streak)
+    increment_current_streak = _write_method(db.increment_current_streak)
+    end_streak = _write_method(db.end_streak)
+    rebuild_streaks = _write_method(db.rebuild_streaks)
+
+    get_habit_details = _read_method(db.get_habit_details)
+    habit_exists = _read_method(db.habit_exists)
+    get_all_habits = _read_method(db.get_all_habits)
+    get_habits_by_periodicity = _read_method(db.get_habits_by_periodicity)
+    last_checkedoff_on = _read_method(db.last_checkedoff_on)
+    get_longest_streak_all_habits = _read_method(db.get_longest_streak_all_habits)
+    get_longest_streak_one_habit = _read_method(db.get_longest_streak_one_habit)
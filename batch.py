@@ -0,0 +1,222 @@
+# Contains the batch mode. Commands (add, checkoff, update, delete) are streamed from a JSON Lines or CSV file, or from stdin,
+# through a pipeline of generators: parse, validate, group in chunks and apply each chunk in a single transaction.
+# Run it with: python batch.py commands.jsonl, or: cat commands.csv | python batch.py - --format csv
+import argparse
+import csv
+import datetime
+import itertools
+import json
+import sys
+import time
+from db import get_db, add_habit, start_streak, add_checkoffs_bulk, update_habit, delete_habit, get_habit_details, rebuild_streaks, transaction, DEFAULT_USER_ID, PERIODICITIES
+
+OPERATIONS = ('add', 'checkoff', 'update', 'delete')
+# Columns of a CSV batch file, the first line of the file is the header
+CSV_FIELDS = ('op', 'habit_id', 'task', 'periodicity', 'date', 'user_id', 'ref')
+
+
+class BatchError(Exception):
+    """Error of a command of a batch file, the command is skipped."""
+
+
+def parse_jsonl(lines):
+    """Generator of the commands of a JSON Lines file: yields (line number, dictionary) for every non-empty line."""
+    for line_number, line in enumerate(lines, 1):
+        if line.strip():
+            try:
+                yield line_number, json.loads(line)
+            except ValueError as error:
+                yield line_number, BatchError(f"invalid JSON: {error}")
+
+
+def parse_csv(lines):
+    """Generator of the commands of a CSV file with a header line: yields (line number, dictionary) for every row, empty cells being left out."""
+    for line_number, row in enumerate(csv.DictReader(lines), 2):
+        yield line_number, {field: value for field, value in row.items() if value not in (None, '')}
+
+
+def _is_sqlite_integer(value):
+    """Return True if value fits in a SQLite integer (signed 64 bits): larger ids raise OverflowError when they are bound to a query."""
+    return -2 ** 63 <= value < 2 ** 63
+
+
+def validate(commands):
+    """Generator checking the commands and converting their fields. Yields (line number, command) where command is a dictionary
+    with op, habit_id (an int, or the ref of a habit added earlier in the batch), task, periodicity, date and user_id,
+    or a BatchError for an invalid command."""
+    for line_number, command in commands:
+        try:
+            if isinstance(command, BatchError):
+                raise command
+            if not isinstance(command, dict):
+                raise BatchError("a command must be an object")
+            op = command.get('op')
+            if op not in OPERATIONS:
+                raise BatchError(f"op must be one of {', '.join(OPERATIONS)}")
+            checked = {'op': op, 'ref': command.get('ref'), 'task': command.get('task'), 'periodicity': command.get('periodicity'), 'date': command.get('date')}
+            try:
+                checked['user_id'] = int(command.get('user_id', DEFAULT_USER_ID))
+            except (TypeError, ValueError):
+                raise BatchError("user_id must be an integer")
+            if not _is_sqlite_integer(checked['user_id']):
+                raise BatchError("user_id is out of range")
+            if checked['date'] is not None:
+                try:
+                    checked['date'] = datetime.date.fromisoformat(checked['date']).isoformat()
+                except (TypeError, ValueError):
+                    raise BatchError("date must be formatted YYYY-MM-DD")
+            if op != 'add':
+                habit_id = command.get('habit_id')
+                try:
+                    checked['habit_id'] = int(habit_id)
+                except (TypeError, ValueError):
+                    # Not a number: the ref of a habit added earlier in the batch
+                    if not isinstance(habit_id, str) or not habit_id:
+                        raise BatchError("habit_id is missing")
+                    checked['habit_id'] = habit_id
+                else:
+                    if not _is_sqlite_integer(checked['habit_id']):
+                        raise BatchError("habit_id is out of range")
+            if op == 'add' or (op == 'update' and checked['task'] is not None):
+                if not isinstance(checked['task'], str) or not checked['task']:
+                    raise BatchError("task cannot be empty")
+            if op == 'add' or (op == 'update' and checked['periodicity'] is not None):
+                if checked['periodicity'] not in PERIODICITIES:
+                    raise BatchError("periodicity must be daily, weekly or monthly")
+            yield line_number, checked
+        except BatchError as error:
+            yield line_number, error
+
+
+def chunks(commands, size):
+    """Generator grouping the commands in lists of at most size commands."""
+    iterator = iter(commands)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class BatchRunner:
+    """Class to apply the commands of a batch to a database, one chunk per transaction.
+    Consecutive checkoffs of the same user are inserted with a single add_checkoffs_bulk call.
+    Attributes:
+        - db: The database connection
+        - refs: The habit_id of the habits added by the batch, by ref
+        - habit_ids: The habits that received checkoffs, whose streaks are rebuilt at the end of the batch
+        - applied: The number of commands applied
+        - errors: The (line number, message) of the commands skipped
+    Methods:
+        - apply_chunk: Method to apply a chunk of commands in a single transaction"""
+
+    def __init__(self, db):
+        self.db = db
+        self.refs = {}
+        self.habit_ids = set()
+        self.applied = 0
+        self.errors = []
+
+    def _habit_id(self, command):
+        habit_id = command['habit_id']
+        if isinstance(habit_id, str):
+            if habit_id not in self.refs:
+                raise BatchError(f"unknown habit ref {habit_id}")
+            return self.refs[habit_id]
+        return habit_id
+
+    def _flush_checkoffs(self, checkoffs, user_id):
+        if checkoffs:
+            self.applied += add_checkoffs_bulk(self.db, checkoffs, user_id)
+            self.habit_ids.update(habit_id for habit_id, _ in checkoffs)
+            checkoffs.clear()
+
+    def apply_chunk(self, chunk):
+        checkoffs, checkoffs_user_id = [], None
+        with transaction(self.db, immediate=True):
+            for line_number, command in chunk:
+                if isinstance(command, BatchError):
+                    self.errors.append((line_number, str(command)))
+                    continue
+                try:
+                    if command['op'] == 'checkoff':
+                        if command['user_id'] != checkoffs_user_id:
+                            self._flush_checkoffs(checkoffs, checkoffs_user_id)
+                            checkoffs_user_id = command['user_id']
+                        checkoffs.append((self._habit_id(command), command['date']))
+                        continue
+                    self._flush_checkoffs(checkoffs, checkoffs_user_id)
+                    self._apply(command)
+                    self.applied += 1
+                except BatchError as error:
+                    self.errors.append((line_number, str(error)))
+            self._flush_checkoffs(checkoffs, checkoffs_user_id)
+
+    def _apply(self, command):
+        user_id = command['user_id']
+        if command['op'] == 'add':
+            habit_id = add_habit(self.db, command['task'], command['periodicity'], command['date'], user_id)
+            start_streak(self.db, habit_id, command['date'], user_id)
+            if command['ref'] is not None:
+                self.refs[command['ref']] = habit_id
+            return
+        habit_id = self._habit_id(command)
+        habit_details = get_habit_details(self.db, habit_id, 'user', 1, user_id)
+        if habit_details is None:
+            raise BatchError(f"habit {habit_id} does not exist")
+        if command['op'] == 'update':
+            update_habit(self.db, habit_id, command['task'] or habit_details.task, command['periodicity'] or habit_details.periodicity, user_id)
+        else:
+            delete_habit(self.db, habit_id, user_id)
+
+
+def run_batch(db, lines, format='jsonl', chunk_size=10000, rebuild=True):
+    """Function to apply a stream of commands to the database. The lines are read one at a time, so the memory used does not depend on the size of the file.
+    Parameters:
+        - lines: an iterable of lines (an open file, sys.stdin...).
+        - format: 'jsonl' or 'csv'.
+        - chunk_size: the number of commands applied per transaction.
+        - rebuild: True (default) to rebuild the streaks of the habits checked off once the batch is applied, checkoffs being allowed in any order.
+        - Requires a database connection.
+    Returns the number of rows read, of commands applied and skipped, the errors (line number, message), the duration in seconds and the rows per second."""
+    start = time.perf_counter()
+    parser = parse_csv if format == 'csv' else parse_jsonl
+    runner = BatchRunner(db)
+    rows = 0
+    for chunk in chunks(validate(parser(lines)), chunk_size):
+        runner.apply_chunk(chunk)
+        rows += len(chunk)
+    if rebuild and runner.habit_ids:
+        rebuild_streaks(db, sorted(runner.habit_ids))
+    duration = time.perf_counter() - start
+    return {
+        'rows': rows,
+        'applied': runner.applied,
+        'skipped': rows - runner.applied,
+        'errors': runner.errors,
+        'duration': duration,
+        'rows_per_second': rows / duration if duration else 0.0,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Apply a stream of habit commands (add, checkoff, update, delete) from a JSON Lines or CSV file.")
+    parser.add_argument('file', help="batch file, - for stdin")
+    parser.add_argument('--format', choices=('jsonl', 'csv'), help="format of the file (default: from the file extension, jsonl for stdin)")
+    parser.add_argument('--db', default="main.db", help="database file (default: main.db)")
+    parser.add_argument('--chunk-size', type=int, default=10000, help="commands per transaction (default: 10000)")
+    parser.add_argument('--no-rebuild', action='store_true', help="do not rebuild the streaks of the habits checked off")
+    args = parser.parse_args()
+
+    format = args.format or ('csv' if args.file.endswith('.csv') else 'jsonl')
+    db = get_db(args.db)
+    lines = sys.stdin if args.file == '-' else open(args.file, newline='')
+    try:
+        metrics = run_batch(db, lines, format, args.chunk_size, not args.no_rebuild)
+    finally:
+        if lines is not sys.stdin:
+            lines.close()
+        db.close()
+    for line_number, message in metrics['errors']:
+        print(f"line {line_number}: {message}", file=sys.stderr)
+    print(f"{metrics['rows']} rows ({metrics['applied']} applied, {metrics['skipped']} skipped) in {metrics['duration']:.2f} s: {metrics['rows_per_second']:.0f} rows/s")
@@ -0,0 +1,189 @@
+# Contains the benchmark suite. A seeded generator fills a database with users, habits and years of checkoffs, then the main operations
+# of the db, habit and analysis modules are timed at several dataset sizes. Results are saved as JSON and compared to a saved baseline.
+# Run it with: python benchmark.py --sizes 1000 100000 --output results.json --baseline baseline.json
+import argparse
+import datetime
+import json
+import os
+import platform
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+import numpy as np
+from db import get_db, add_user, add_habit, add_checkoff, get_longest_streak_all_habits, get_habits_by_periodicity, iter_habit_pages, close_read_dbs, habit_cache, PERIODICITIES
+from habit import Habit
+from importer import import_checkoffs
+
+# Share of the habits of each periodicity and average number of checkoffs per year of a habit of this periodicity (at 70% adherence)
+PERIODICITY_SHARE = (0.5, 0.35, 0.15)
+CHECKOFFS_PER_YEAR = {'daily': 365 * 0.7, 'weekly': 52 * 0.7, 'monthly': 12 * 0.7}
+# A benchmark is flagged when its median is more than REGRESSION_THRESHOLD times the baseline median and at least
+# REGRESSION_MIN_MS slower: a few microseconds of noise on a very fast operation is not a regression
+REGRESSION_THRESHOLD = 1.25
+REGRESSION_MIN_MS = 0.05
+
+
+def _habit_checkoffs(rng, periodicity, start, days):
+    """Return the days (offsets from start) a habit is checked off on: each period is completed with the adherence of the habit,
+    except during breaks (a few runs of missed periods), and a weekly or monthly habit is completed on a random day of its period."""
+    adherence = rng.beta(7, 3)
+    if periodicity == 'daily':
+        periods = np.arange(days)
+        completed = periods[rng.random(days) < adherence]
+    else:
+        length = 7 if periodicity == 'weekly' else 30
+        periods = np.arange(0, days - length + 1, length)
+        completed = periods[rng.random(len(periods)) < adherence]
+        completed = completed + rng.integers(0, length, len(completed))
+    # Breaks: a few runs of missed days (holidays, illness...)
+    for break_start in rng.integers(0, days, rng.poisson(2)):
+        completed = completed[(completed < break_start) | (completed >= break_start + rng.geometric(0.05))]
+    return [(start + datetime.timedelta(days=int(day))).isoformat() for day in completed]
+
+
+def generate_dataset(db, checkoffs, users=10, years=2, seed=42, end=datetime.date(2024, 12, 31)):
+    """Function to fill a database with a synthetic dataset of about checkoffs checkoffs. The same seed always gives the same dataset.
+    Habits are spread over the users and the periodicities (see PERIODICITY_SHARE), were created years before end
+    and were checked off with their own adherence, with a few breaks.
+    Parameters:
+        - checkoffs: the number of checkoffs wanted (the dataset has about this number of checkoffs).
+        - users: the number of users.
+        - years: the number of years of history.
+        - seed: the seed of the random generator.
+        - end: the last day of the history.
+        - Requires a database connection.
+    Returns the number of users, habits and checkoffs created."""
+    rng = np.random.default_rng(seed)
+    days = int(365 * years)
+    start = end - datetime.timedelta(days=days - 1)
+    checkoffs_per_habit = years * sum(share * CHECKOFFS_PER_YEAR[periodicity] for share, periodicity in zip(PERIODICITY_SHARE, PERIODICITIES))
+    habits = max(1, round(checkoffs / checkoffs_per_habit))
+
+    user_ids = [add_user(db, f"user {number}", user_id=number + 1) for number in range(users)]
+
+    def history():
+        # Habits are added while the importer reads their checkoffs, so the history is never held in memory at once
+        for number, periodicity in enumerate(rng.choice(PERIODICITIES, size=habits, p=PERIODICITY_SHARE)):
+            habit_id = add_habit(db, f"habit {number}", str(periodicity), start.isoformat(), user_ids[number % users])
+            yield from ((habit_id, day) for day in _habit_checkoffs(rng, periodicity, start, days))
+
+    metrics = import_checkoffs(db, history())
+    return {'users': users, 'habits': habits, 'checkoffs': metrics['imported']}
+
+
+def _time(function, repeat):
+    """Call function repeat times and return the duration of each call in milliseconds."""
+    durations = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        durations.append((time.perf_counter() - started) * 1000)
+    return durations
+
+
+def run_benchmarks(db, repeat=50, seed=42):
+    """Function to time the main operations on a database filled by generate_dataset. Each operation is called repeat times on random habits or users.
+    Returns a dictionary with, for each operation, the median and 95th percentile durations in milliseconds and the operations per second."""
+    rng = np.random.default_rng(seed)
+    habits = db.execute("SELECT habit_id, user_id FROM habits WHERE created_by = 'user' AND is_active = 1;").fetchall()
+    users = sorted({user_id for _, user_id in habits})
+    picked_habits = [habits[index] for index in rng.integers(0, len(habits), repeat)]
+    picked_users = [users[index] for index in rng.integers(0, len(users), repeat)]
+    # New checkoffs are recorded after the generated history, one day per call so that none is a duplicate
+    last_day = datetime.date.fromisoformat(db.execute("SELECT MAX(checkedoff_on) FROM checkoffs;").fetchone()[0] or '2024-12-31')
+    new_days = [(last_day + datetime.timedelta(days=day)).isoformat() for day in range(1, repeat + 1)]
+    continuity = Habit()
+
+    def each(arguments, function):
+        arguments = iter(arguments)
+        return lambda: function(*next(arguments))
+
+    results = {
+        'add_checkoff': _time(each(zip(picked_habits, new_days), lambda habit, day: add_checkoff(db, habit[0], day, habit[1])), repeat),
+    }
+    habit_cache.clear()
+    results['check_habit_continuity'] = _time(each(picked_habits, lambda habit_id, user_id: continuity.check_habit_continuity(db, habit_id, 'user', 1, user_id)), repeat)
+    results['get_longest_streak_all_habits'] = _time(each(zip(picked_users), lambda user_id: get_longest_streak_all_habits(db, 'user', 1, user_id)), repeat)
+    results['get_habits_by_periodicity'] = _time(each(zip(picked_users), lambda user_id: get_habits_by_periodicity(db, 'daily', 'user', 1, user_id)), repeat)
+    results['list_habits'] = _time(each(zip(picked_users), lambda user_id: sum(len(page) for page in iter_habit_pages(db, 'user', 1, 100, None, user_id))), repeat)
+
+    return {name: {'median_ms': statistics.median(durations),
+                   'p95_ms': sorted(durations)[min(len(durations) - 1, int(len(durations) * 0.95))],
+                   'ops_per_second': 1000 / statistics.mean(durations) if statistics.mean(durations) else 0.0}
+            for name, durations in results.items()}
+
+
+def run_suite(sizes, repeat=50, seed=42, directory=None):
+    """Function to generate a dataset of each size (number of checkoffs) in a temporary database and run the benchmarks on it.
+    Returns the results: the environment (python and SQLite versions, date, seed) and, for each size, the dataset and the benchmark timings."""
+    suite = {
+        'environment': {'python': platform.python_version(), 'sqlite': sqlite3.sqlite_version, 'date': datetime.datetime.now().isoformat(timespec='seconds'),
+                        'seed': seed, 'repeat': repeat},
+        'sizes': {},
+    }
+    with tempfile.TemporaryDirectory(dir=directory) as temporary:
+        for size in sizes:
+            db = get_db(os.path.join(temporary, f"benchmark_{size}.db"))
+            try:
+                started = time.perf_counter()
+                dataset = generate_dataset(db, size, seed=seed)
+                dataset['generation_seconds'] = time.perf_counter() - started
+                suite['sizes'][str(size)] = {'dataset': dataset, 'benchmarks': run_benchmarks(db, repeat, seed)}
+            finally:
+                db.close()
+                close_read_dbs()
+                habit_cache.clear()
+    return suite
+
+
+def compare(results, baseline, threshold=REGRESSION_THRESHOLD, min_ms=REGRESSION_MIN_MS):
+    """Function to compare benchmark results to a baseline (both as returned by run_suite).
+    Returns the list of regressions: (size, benchmark, baseline median, median, ratio) for every benchmark whose median is more than threshold times
+    the baseline median and at least min_ms milliseconds slower. Sizes and benchmarks missing from the baseline are not compared."""
+    regressions = []
+    for size, measured in results['sizes'].items():
+        reference = baseline.get('sizes', {}).get(size)
+        if reference is None:
+            continue
+        for name, timings in measured['benchmarks'].items():
+            baseline_median = reference['benchmarks'].get(name, {}).get('median_ms')
+            if baseline_median and timings['median_ms'] > baseline_median * threshold and timings['median_ms'] - baseline_median >= min_ms:
+                regressions.append((size, name, baseline_median, timings['median_ms'], timings['median_ms'] / baseline_median))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the habit tracker on synthetic datasets.")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000], help="numbers of checkoffs of the datasets, up to 10000000 (default: 1000 10000 100000)")
+    parser.add_argument('--repeat', type=int, default=50, help="calls per benchmark (default: 50)")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', default="benchmark_results.json", help="file the results are written to")
+    parser.add_argument('--baseline', help="results of a previous run to compare to")
+    parser.add_argument('--save-baseline', action='store_true', help="also write the results to the --baseline file")
+    parser.add_argument('--threshold', type=float, default=REGRESSION_THRESHOLD, help="slowdown ratio flagged as a regression (default: 1.25)")
+    args = parser.parse_args()
+
+    suite = run_suite(args.sizes, args.repeat, args.seed)
+    with open(args.output, 'w') as file:
+        json.dump(suite, file, indent=2)
+    for size, measured in suite['sizes'].items():
+        dataset = measured['dataset']
+        print(f"{size} checkoffs requested: {dataset['users']} users, {dataset['habits']} habits, {dataset['checkoffs']} checkoffs generated in {dataset['generation_seconds']:.1f} s")
+        for name, timings in measured['benchmarks'].items():
+            print(f"    {name:32} median {timings['median_ms']:9.3f} ms   p95 {timings['p95_ms']:9.3f} ms   {timings['ops_per_second']:10.0f} ops/s")
+
+    regressions = []
+    if args.baseline and os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline) as file:
+            regressions = compare(suite, json.load(file), args.threshold)
+        for size, name, baseline_median, median, ratio in regressions:
+            print(f"REGRESSION {size} {name}: {baseline_median:.3f} ms -> {median:.3f} ms ({ratio:.2f}x)")
+        if not regressions:
+            print(f"No regression against {args.baseline}")
+    if args.baseline and args.save_baseline:
+        with open(args.baseline, 'w') as file:
+            json.dump(suite, file, indent=2)
+        print(f"Baseline saved to {args.baseline}")
+    sys.exit(1 if regressions else 0)
@@ -0,0 +1,92 @@
+# Contains the in-process cache used by the db module to avoid reading the same habit rows again on every interaction.
+import threading
+import time
+from collections import OrderedDict
+
+# Returned by LRUCache.get when the key is not cached (None is a valid cached value)
+MISSING = object()
+
+
+class LRUCache:
+    """Class to represent a bounded cache evicting the least recently used entries.
+    Attributes:
+        - maxsize: The maximum number of entries kept in the cache
+        - ttl: The number of seconds an entry stays valid, None for no expiry
+        - hits: The number of lookups answered by the cache
+        - misses: The number of lookups not found in the cache (or expired)
+        - generation: The number of invalidations so far, to detect a value read from the source before an invalidation (see set)
+    Methods:
+        - get: Method to retrieve a cached value, MISSING if it is not cached
+        - set: Method to store a value
+        - values: Method to retrieve the values cached and not expired
+        - invalidate: Method to remove an entry after the underlying data changed
+        - clear: Method to remove all the entries
+        - stats: Method to retrieve the hit/miss counters and the size of the cache"""
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Method to retrieve the value cached for key. Returns MISSING if the key is not cached or its entry expired."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and (entry[1] is None or entry[1] > time.monotonic()):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return MISSING
+
+    def set(self, key, value, generation=None):
+        """Method to store value for key, evicting the least recently used entry when the cache is full.
+        generation is the generation read before value was read from the source: if an invalidation happened since, value may be
+        older than the change that caused it and is not stored. Returns True if the value was stored."""
+        expires = time.monotonic() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return False
+            self._entries[key] = (value, expires)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+            return True
+
+    def values(self):
+        """Method to retrieve a list of the values cached and not expired, without counting hits or changing the eviction order."""
+        now = time.monotonic()
+        with self._lock:
+            return [value for value, expires in self._entries.values() if expires is None or expires > now]
+
+    def invalidate(self, key):
+        """Method to remove the entry of key, if cached."""
+        with self._lock:
+            self._entries.pop(key, None)
+            self.generation += 1
+
+    def clear(self):
+        """Method to remove all the entries and reset the counters."""
+        with self._lock:
+            self._entries.clear()
+            self.generation += 1
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """Method to retrieve the counters of the cache. Returns a dictionary with hits, misses, hit rate, current size and maximum size."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+            }
@@ -1,15 +1,135 @@
 # Contains all the functions to interact with the database. The functions are used in the habit and analysis modules to interact with the database. The functions are also tested in the test_project.py file.
 
+import collections
+import datetime
+import functools
+import json
+import os
 import sqlite3
+import threading
+import numpy as np
+from contextlib import contextmanager
+from cache import LRUCache, MISSING
+
+# Pragmas applied to every connection: write-ahead logging so that readers and the writer do not block each other, one fsync per checkpoint
+# instead of one per commit (safe with WAL), memory mapped reads (256 MB), a 64 MB page cache and waiting up to 5 s for a lock instead of failing.
+CONNECTION_PRAGMAS = (
+	"PRAGMA journal_mode = WAL;",
+	"PRAGMA synchronous = NORMAL;",
+	"PRAGMA mmap_size = 268435456;",
+	"PRAGMA cache_size = -65536;",
+	"PRAGMA busy_timeout = 5000;",
+)
+
+# User owning the data when no user is given: the single user of the command line program
+DEFAULT_USER_ID = 1
+
+# Periodicities of the habits. The NumPy analytics (habit_analytics) code them by their index in this tuple
+PERIODICITIES = ('daily', 'weekly', 'monthly')
+
+# Read-only connections of each thread, by database name
+_read_connections = threading.local()
+
+# Habit rows by (database, habit_id), shared by all the connections of the process. Writes through this module invalidate their entries,
+# the time to live bounds how long a change made by another process can go unnoticed.
+habit_cache = LRUCache(maxsize=4096, ttl=60)
+
+
+def _reduce_row(row):
+	# Rows are sent to other processes (see shards.map) as plain tuples: their classes are created on the fly and cannot be pickled by name
+	return tuple, (tuple(row),)
+
+
+@functools.lru_cache(maxsize=256)
+def _row_class(columns):
+	"""Return the named tuple class of the rows of a query with these column names (invalid names become _0, _1...), created once per query shape."""
+	row_class = collections.namedtuple("Row", columns, rename=True)
+	row_class.__reduce__ = _reduce_row
+	return row_class
+
+
+class Cursor(sqlite3.Cursor):
+	"""sqlite3 cursor remembering the named tuple class of the rows of its current query (see named_row): the class is looked up once per query instead of once per row."""
+	# (description of the query, function building a row) of the last query read through named_row
+	_named_rows = (None, None)
+
+
+def named_row(cursor, row):
+	"""Row factory of the connections: each row is a named tuple, read by column name (habit.periodicity) or by position like a plain tuple.
+	Named tuples have no per-row dictionary, so a row takes the memory of a tuple. Loops reading many rows set cursor.row_factory = None
+	to get plain tuples, and setting the row_factory of a connection (e.g. to sqlite3.Row) applies to its cursors as usual."""
+	description, new_row = getattr(cursor, "_named_rows", Cursor._named_rows)
+	# The description of a query is the same object for all its rows: the row class is only looked up on its first row
+	if description is not cursor.description:
+		new_row = functools.partial(tuple.__new__, _row_class(tuple(column[0] for column in cursor.description)))
+		if isinstance(cursor, Cursor):
+			cursor._named_rows = (cursor.description, new_row)
+	return new_row(row)
+
+
+class Connection(sqlite3.Connection):
+	"""sqlite3 connection remembering the database file it was opened on (cache_key), so that all the connections to a file share their cache entries.
+	Its cursors, including the ones of execute and executemany, are Cursor objects, so named_row can remember the row class of their query."""
+	cache_key = None
+
+	def cursor(self, factory=Cursor):
+		return super().cursor(factory)
+
+	def execute(self, sql, parameters=()):
+		return self.cursor().execute(sql, parameters)
+
+	def executemany(self, sql, parameters):
+		return self.cursor().executemany(sql, parameters)
+
+
+def connect(name="main.db", read_only=False):
+	"""Open a connection to the SQLite database specified by name with the CONNECTION_PRAGMAS applied. Rows are returned as named tuples (see named_row).
+	The tables are not created, use get_db or get_read_db for that.
+	Parameters:
+		- read_only: True to get a connection refusing any write (PRAGMA query_only)."""
+	db = sqlite3.connect(name, factory=Connection)
+	db.cache_key = object() if name == ":memory:" else os.path.abspath(name)
+	db.row_factory = named_row
+	for pragma in CONNECTION_PRAGMAS:
+		db.execute(pragma)
+	if read_only:
+		db.execute("PRAGMA query_only = 1;")
+	return db
 
 
 def get_db(name="main.db"):
-	"""Create a database connection to the SQLite database specified by name"""
-	db = sqlite3.connect(name)
-	create_tables(db)
+	"""Create a database connection to the SQLite database specified by name.
+	The tables are created (or upgraded) only when the schema version stored in the file is behind SCHEMA_VERSION, so once per file."""
+	db = connect(name)
+	if get_schema_version(db) < SCHEMA_VERSION:
+		create_tables(db)
+	return db
+
+
+def get_read_db(name="main.db"):
+	"""Return the read-only connection of the current thread to the SQLite database specified by name.
+	The connection is opened on the first call and reused afterwards. Each thread gets its own connection,
+	so analysis queries running in parallel never block (and are never blocked by) the connection recording checkoffs."""
+	connections = getattr(_read_connections, "connections", None)
+	if connections is None:
+		connections = _read_connections.connections = {}
+	db = connections.get(name)
+	if db is None:
+		db = connect(name, read_only=True)
+		if get_schema_version(db) < SCHEMA_VERSION:
+			get_db(name).close()
+		connections[name] = db
 	return db
 
 
+def close_read_dbs():
+	"""Close the read-only connections opened by get_read_db in the current thread."""
+	connections = getattr(_read_connections, "connections", {})
+	for db in connections.values():
+		db.close()
+	connections.clear()
+
+
 def create_tables(db):
 	"""Create tables for errors messages, streaks, checkoffs and habits from the create_table_sql statement. Requires a database connection."""
 	cursor = db.cursor()
@@ -44,6 +164,207 @@ def create_tables(db):
 
 	db.commit()
 
+	# Bring the schema (indexes, new columns...) up to the latest version
+	migrate(db)
+
+# Schema migrations. Each function upgrades the database by one version, the version reached is stored in PRAGMA user_version.
+def _migration_1(cur):
+	"""Version 1: covering indexes for the lookups done on every interaction (last checkoff, longest streak, habit lists)."""
+	cur.execute("""CREATE INDEX IF NOT EXISTS idx_checkoffs_habit_date
+		ON checkoffs (habit_id, checkedoff_on);""")
+	cur.execute("""CREATE INDEX IF NOT EXISTS idx_streaks_habit_active
+		ON streaks (habit_id, is_active, current_streak);""")
+	cur.execute("""CREATE INDEX IF NOT EXISTS idx_habits_owner
+		ON habits (created_by, is_active, periodicity);""")
+
+def _migration_2(cur):
+	"""Version 2: streak_state table, the streak summary of each habit maintained incrementally on every checkoff, filled from the existing history."""
+	cur.execute("""CREATE TABLE IF NOT EXISTS streak_state (
+		habit_id INTEGER PRIMARY KEY,
+		last_checkoff_id INTEGER NOT NULL DEFAULT 0,
+		last_checkedoff_on DATE DEFAULT NULL,
+		last_period INTEGER DEFAULT NULL,
+		current_streak INTEGER NOT NULL DEFAULT 0,
+		current_started_on DATE DEFAULT NULL,
+		longest_streak INTEGER NOT NULL DEFAULT 0,
+		longest_started_on DATE DEFAULT NULL,
+		longest_ended_on DATE DEFAULT NULL,
+		FOREIGN KEY (habit_id) REFERENCES habits(habit_id));""")
+	return _backfill_streak_state
+
+def _backfill_streak_state(cur):
+	"""Fill the streak summary of every habit from the checkoffs history (or from the streaks of the habits without checkoffs)."""
+	_compute_streak_runs(cur)
+	_write_streak_state(cur)
+	_seed_streak_state_from_streaks(cur)
+
+def _migration_3(cur):
+	"""Version 3: users table and user_id column in habits, checkoffs and streaks, so that one database serves many users.
+	The existing data belongs to the default user. The indexes now lead with user_id, so per-user queries only read that user's rows."""
+	cur.execute("""CREATE TABLE IF NOT EXISTS users (
+		user_id INTEGER PRIMARY KEY AUTOINCREMENT,
+		name TEXT NOT NULL,
+		created_on DATE DEFAULT (date('now')));""")
+	cur.execute("INSERT OR IGNORE INTO users (user_id, name) VALUES (?, 'default');", (DEFAULT_USER_ID,))
+	for table in ("habits", "checkoffs", "streaks"):
+		cur.execute(f"ALTER TABLE {table} ADD COLUMN user_id INTEGER NOT NULL DEFAULT {DEFAULT_USER_ID};")
+	cur.execute("DROP INDEX IF EXISTS idx_habits_owner;")
+	cur.execute("DROP INDEX IF EXISTS idx_checkoffs_habit_date;")
+	cur.execute("DROP INDEX IF EXISTS idx_streaks_habit_active;")
+	cur.execute("""CREATE INDEX IF NOT EXISTS idx_habits_user
+		ON habits (user_id, created_by, is_active, periodicity);""")
+	cur.execute("""CREATE INDEX IF NOT EXISTS idx_checkoffs_user_habit_date
+		ON checkoffs (user_id, habit_id, checkedoff_on);""")
+	cur.execute("""CREATE INDEX IF NOT EXISTS idx_streaks_user_habit_active
+		ON streaks (user_id, habit_id, is_active, current_streak);""")
+
+def _migration_4(cur):
+	"""Version 4: a habit is checked off at most once per day. Duplicated checkoffs (same habit, same date) are removed, keeping the first one,
+	and the checkoff index becomes unique so that inserting a duplicate is ignored (INSERT OR IGNORE) instead of being recorded."""
+	cur.execute("""
+		DELETE FROM checkoffs
+		WHERE checkoff_id NOT IN (SELECT MIN(checkoff_id) FROM checkoffs GROUP BY user_id, habit_id, checkedoff_on);
+		""")
+	cur.execute("DROP INDEX IF EXISTS idx_checkoffs_user_habit_date;")
+	cur.execute("""CREATE UNIQUE INDEX idx_checkoffs_user_habit_date
+		ON checkoffs (user_id, habit_id, checkedoff_on);""")
+
+def _migration_5(cur):
+	"""Version 5: index of the habits of a user in habit_id order, so that a page of the habit list (get_habits_page) is read from where
+	the previous page ended instead of sorting all the habits of the user. With a periodicity, idx_habits_user is already in habit_id order."""
+	cur.execute("""CREATE INDEX IF NOT EXISTS idx_habits_user_page
+		ON habits (user_id, created_by, is_active, habit_id);""")
+
+def _migration_6(cur):
+	"""Version 6: indexes of the streak summaries by longest and by current streak, so that the top K streaks (get_streak_leaderboard)
+	are read in order and the search stops after K habits instead of sorting the summaries of all the habits."""
+	cur.execute("CREATE INDEX IF NOT EXISTS idx_streak_state_longest ON streak_state (longest_streak DESC);")
+	cur.execute("CREATE INDEX IF NOT EXISTS idx_streak_state_current ON streak_state (current_streak DESC);")
+
+def _migration_7(cur):
+	"""Version 7: integer day numbers of the checkoffs, computed from checkedoff_on: checkedoff_day (days since 1970-01-01), checkedoff_week
+	(weeks starting on Monday) and checkedoff_month (year * 12 + month - 1). The columns are VIRTUAL, so rows do not grow and checkedoff_on stays
+	the stored date, but queries compare and subtract integers instead of converting dates. The periods of the streak summaries now use the same
+	numbering (days and weeks were counted from the julian day 0)."""
+	for column, expression in (("checkedoff_day", epoch_day_sql("checkedoff_on")), ("checkedoff_week", _epoch_week_sql("checkedoff_on")),
+			("checkedoff_month", _month_sql("checkedoff_on"))):
+		cur.execute(f"ALTER TABLE checkoffs ADD COLUMN {column} INTEGER GENERATED ALWAYS AS {expression} VIRTUAL;")
+	cur.execute("""
+		UPDATE streak_state
+		SET last_period = last_period - (SELECT CASE h.periodicity WHEN 'daily' THEN 2440588 WHEN 'weekly' THEN 348655 ELSE 0 END
+			FROM habits h WHERE h.habit_id = streak_state.habit_id)
+		WHERE last_period IS NOT NULL;
+		""")
+
+def _migration_8(cur):
+	"""Version 8: habit_bitmaps table, the completion bitmap of each habit (see was_completed), filled from the existing history."""
+	cur.execute("""CREATE TABLE IF NOT EXISTS habit_bitmaps (
+		habit_id INTEGER NOT NULL,
+		chunk INTEGER NOT NULL,
+		bits BLOB NOT NULL,
+		PRIMARY KEY (habit_id, chunk),
+		FOREIGN KEY (habit_id) REFERENCES habits(habit_id)) WITHOUT ROWID;""")
+	return _rebuild_completion_bitmaps
+
+def _migration_9(cur):
+	"""Version 9: the day numbers of the checkoffs become stored columns. As VIRTUAL columns they were computed from checkedoff_on again each time
+	a row was read, so queries still converted every date. They are now written with each checkoff (see checkoff_periods_sql), filled here for
+	the existing checkoffs, and indexed with the habit so that the day numbers of a habit are read from the index, in day order."""
+	for column in CHECKOFF_PERIOD_COLUMNS.split(", "):
+		cur.execute(f"ALTER TABLE checkoffs DROP COLUMN {column};")
+		cur.execute(f"ALTER TABLE checkoffs ADD COLUMN {column} INTEGER;")
+	cur.execute(f"UPDATE checkoffs SET ({CHECKOFF_PERIOD_COLUMNS}) = ({checkoff_periods_sql('checkedoff_on')});")
+	cur.execute("CREATE INDEX IF NOT EXISTS idx_checkoffs_habit_day ON checkoffs (habit_id, checkedoff_day);")
+
+MIGRATIONS = [_migration_1, _migration_2, _migration_3, _migration_4, _migration_5, _migration_6, _migration_7, _migration_8, _migration_9]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+def get_schema_version(db):
+	"""Function to retrieve the schema version of the database (PRAGMA user_version, 0 for a database created before migrations existed).
+	Requires a database connection."""
+	return db.execute("PRAGMA user_version;").fetchone()[0]
+
+def migrate(db):
+	"""Function to upgrade the database schema in place up to SCHEMA_VERSION.
+	A migration changes the schema and can return a backfill function filling the new tables from the existing data. Backfills use the functions
+	of this module, so they run once all the pending migrations are applied (the schema they expect is the latest one).
+	Everything runs in one IMMEDIATE transaction together with the user_version bump, so an interrupted upgrade leaves the database untouched
+	and two processes opening the same file at the same time do not migrate it twice (the version is read again once the write lock is held).
+	Readers are not blocked while the migration runs.
+	Requires a database connection."""
+	if db.in_transaction:
+		db.commit()
+	if get_schema_version(db) >= SCHEMA_VERSION:
+		return
+	with transaction(db, immediate=True):
+		cur = db.cursor()
+		backfills = []
+		for migration in MIGRATIONS[get_schema_version(db):]:
+			backfill = migration(cur)
+			if backfill is not None and backfill not in backfills:
+				backfills.append(backfill)
+		for backfill in backfills:
+			backfill(cur)
+		cur.execute(f"PRAGMA user_version = {SCHEMA_VERSION};")
+
+# Transactions. Connections (by id) currently inside a transaction() block, with the nesting depth of the block.
+_open_transactions = {}
+# Habits changed inside a transaction() block, by connection id: their cached rows are invalidated once the block has committed,
+# otherwise another connection could read the row before the commit and cache it again.
+_pending_invalidations = {}
+
+@contextmanager
+def transaction(db, immediate=False):
+	"""Context manager to group several writes in a single transaction, so they are committed (and synced to disk) once.
+	The functions of this module do not commit while a transaction is open on their connection: the changes are committed when the outermost block exits
+	and rolled back if an exception is raised inside it. Blocks can be nested.
+	Parameters:
+		- immediate: True to take the write lock when the transaction starts instead of at the first write.
+		- Requires a database connection."""
+	key = id(db)
+	depth = _open_transactions.get(key, 0)
+	if depth == 0 and not db.in_transaction:
+		db.execute("BEGIN IMMEDIATE;" if immediate else "BEGIN;")
+	_open_transactions[key] = depth + 1
+	try:
+		yield db
+	except BaseException:
+		if depth == 0:
+			db.rollback()
+		raise
+	else:
+		if depth == 0:
+			db.commit()
+	finally:
+		if depth == 0:
+			del _open_transactions[key]
+			for habit_id in _pending_invalidations.pop(key, ()):
+				habit_cache.invalidate((db.cache_key, habit_id))
+		else:
+			_open_transactions[key] = depth
+
+def _commit(db):
+	"""Commit the pending changes, unless they are part of a transaction() block which will commit them on exit."""
+	if id(db) not in _open_transactions:
+		db.commit()
+
+# Functions to interact with users table
+def add_user(db, name, user_id=None):
+	"""Function to add a new user to users table. It returns the user_id of the new user, to be passed to the other functions of this module.
+	Parameters:
+		- name: the name of the user.
+		- user_id: the identifier to give to the user (e.g. when users are spread over several databases), a new one by default.
+		  If a user already has this identifier, its name is updated.
+		- Requires a database connection."""
+	cur = db.cursor()
+	cur.execute("""
+		INSERT INTO users (user_id, name)
+		VALUES (?, ?)
+		ON CONFLICT (user_id) DO UPDATE SET name = excluded.name
+		""", (user_id, name))
+	_commit(db)
+	return user_id if user_id is not None else cur.lastrowid
+
 # Functions to interact with habits table
 def insert_predefined_habits(db):
 	"""Insert predefined habits into the database: 6 habits in Habits table and 2 streaks are entered in Streaks table.
@@ -74,9 +395,12 @@ def insert_predefined_habits(db):
         VALUES (?, ?, ?, ?, ?)
         """, predefined_streaks)
 
-	db.commit()
+	# Predefined habits have no checkoffs, their streak summary comes from the streaks above
+	_seed_streak_state_from_streaks(cur)
+
+	_commit(db)
 
-def add_habit(db, task, periodicity, created_on=None):
+def add_habit(db, task, periodicity, created_on=None, user_id=DEFAULT_USER_ID):
 	"""Function to add a new habit to habits table. It returns habit_id of the new habit to be used in the streak table.
 	Parameters:
 		- Task and periodicity are entered by the user.
@@ -84,227 +408,841 @@ def add_habit(db, task, periodicity, created_on=None):
 		- The creation date is set to the current date by default in the database.
 		- created_by is set by default to 'user' when user creates habit and set to 'predefined' for predefined habits.
 		- is_active is set to 1 by default.
+		- user_id: the user owning the habit (DEFAULT_USER_ID by default).
 		- Requires a database connection."""
 	cursor = db.cursor()
 	if created_on is None:
 		cursor.execute("""
-			INSERT INTO habits (task, periodicity, created_on)
-			VALUES (?, ?, date('now'))
-			""", (task, periodicity))
+			INSERT INTO habits (task, periodicity, created_on, user_id)
+			VALUES (?, ?, date('now'), ?)
+			""", (task, periodicity, user_id))
 
 	else:
 		cursor.execute("""
-			INSERT INTO habits (task, periodicity, created_on)
-			VALUES (?, ?, ?)
-			""", (task, periodicity, created_on))
+			INSERT INTO habits (task, periodicity, created_on, user_id)
+			VALUES (?, ?, ?, ?)
+			""", (task, periodicity, created_on, user_id))
 
-	db.commit()
+	_commit(db)
 # Get the habit_id of the newly created habit
 	habit_id = cursor.lastrowid
+	_invalidate_habit(db, habit_id)
 	return habit_id
 
-def update_habit(db, habit_id, task, periodicity):
+def update_habit(db, habit_id, task, periodicity, user_id=DEFAULT_USER_ID):
 	"""Function to update a habit in habits table
 	Parameters:
 		- task and periodicity are entered by the user.
 		- habit_id: the unique identifier of the habit to be deleted.
+		- user_id: the user owning the habit (DEFAULT_USER_ID by default).
 		- Requires a database connection."""
 	cur = db.cursor()
-	cur.execute("""
-		UPDATE habits
-		SET task = ?, periodicity = ?, updated_on = date('now')
-		WHERE habit_id = ?;
-		""", (task, periodicity, habit_id))
-	db.commit()
+	with transaction(db, immediate=True):
+		cur.execute("SELECT periodicity FROM habits WHERE habit_id = ? AND user_id = ?;", (habit_id, user_id))
+		previous = cur.fetchone()
+		cur.execute("""
+			UPDATE habits
+			SET task = ?, periodicity = ?, updated_on = date('now')
+			WHERE habit_id = ? AND user_id = ?;
+			""", (task, periodicity, habit_id, user_id))
+		# Streaks are counted in periods, they are recomputed when the periodicity changes
+		if previous is not None and previous.periodicity != periodicity:
+			rebuild_streaks(db, [habit_id])
+	_invalidate_habit(db, habit_id)
 
-def delete_habit(db, habit_id):
+def delete_habit(db, habit_id, user_id=DEFAULT_USER_ID):
 	"""Function to deactivate a habit in habits table. User wishes to delete a habit, is_active is set to 0 in the database.
 	Parameters:
 		- habit_id: the unique identifier of the habit to be deleted.
+		- user_id: the user owning the habit (DEFAULT_USER_ID by default).
 		- Requires a database connection."""
 	cur = db.cursor()
 	cur.execute("""
 		UPDATE habits
 		SET deleted_on = date('now'), is_active = 0
-		WHERE habit_id = ?;
-		""", (habit_id,))
-	db.commit()
+		WHERE habit_id = ? AND user_id = ?;
+		""", (habit_id, user_id))
+	_commit(db)
+	_invalidate_habit(db, habit_id)
 
-def get_habit_details(db, habit_id, created_by, is_active):
+def get_habit_details(db, habit_id, created_by, is_active, user_id=DEFAULT_USER_ID):
 	"""Retrieve details of a habit based on habit_id.
+	The habit row is read through habit_cache: repeated calls for the same habit do not query the database again until the habit is changed.
     Parameters:
     	- habit_id: The unique identifier of the habit.
     	- created_by: 'user' or 'predefined'
     	- is_active: 1 if created by user, 0 if predefined.
+    	- user_id: the user owning the habit (DEFAULT_USER_ID by default).
     	- Requires a database connection.
     Returns: A tuple containing the habit details such as name, periodicity, and other relevant information."""
+	key = (db.cache_key, habit_id) if getattr(db, "cache_key", None) is not None else None
+	habit = habit_cache.get(key) if key is not None else MISSING
+	if habit is MISSING:
+		# A habit changed and invalidated by another thread while the row is read must not be cached with its old row
+		generation = habit_cache.generation
+		cur = db.cursor()
+		cur.execute("""
+			SELECT habit_id, task, periodicity, created_by, created_on, is_active, user_id
+			FROM habits
+			WHERE habit_id = ?;
+			""", (habit_id,))
+		habit = cur.fetchone()
+		# Rows read inside an open transaction may still be rolled back, they are not cached
+		if key is not None and not db.in_transaction:
+			habit_cache.set(key, habit, generation)
+	if habit is None or habit.created_by != created_by or habit.is_active != is_active or habit.user_id != user_id:
+		return None
+	return habit
+
+def habit_exists(db, habit_id, created_by, is_active, user_id=DEFAULT_USER_ID, use_cache=True):
+	"""Function to check that a habit exists, e.g. to validate a habit_id entered by the user.
+	Validating an id costs a single primary key lookup whatever the number of habits, or no query at all when the habit row is in habit_cache.
+	Parameters:
+		- habit_id: The unique identifier of the habit.
+		- created_by: 'user' or 'predefined'
+		- is_active: 1 if created by user, 0 if predefined.
+		- user_id: the user owning the habit (DEFAULT_USER_ID by default).
+		- use_cache: False to always ask the database.
+		- Requires a database connection.
+	Returns True if the habit exists with the given created_by and is_active, False otherwise."""
+	if use_cache:
+		return get_habit_details(db, habit_id, created_by, is_active, user_id) is not None
 	cur = db.cursor()
 	cur.execute("""
-		SELECT habit_id, task, periodicity, created_by, created_on, is_active
+		SELECT 1
 		FROM habits
-		WHERE habit_id = ? AND created_by = ? AND is_active = ?;
-		""", (habit_id, created_by, is_active))
-	return cur.fetchone()
+		WHERE habit_id = ? AND created_by = ? AND is_active = ? AND user_id = ?;
+		""", (habit_id, created_by, is_active, user_id))
+	return cur.fetchone() is not None
+
+def _invalidate_habit(db, habit_id):
+	"""Remove the cached row of a habit after it was created, updated or deleted. Inside a transaction() block, the row is removed when the block commits."""
+	if getattr(db, "cache_key", None) is None:
+		return
+	if id(db) in _open_transactions:
+		_pending_invalidations.setdefault(id(db), set()).add(habit_id)
+	else:
+		habit_cache.invalidate((db.cache_key, habit_id))
+
+def invalidate_habits(db, habit_ids):
+	"""Function to remove the cached rows of habits changed without the functions of this module (e.g. copied between databases by shards.move_user).
+	Inside a transaction() block, the rows are removed when the block commits.
+	Parameters:
+		- habit_ids: the habit_id of the habits changed.
+		- Requires a database connection."""
+	for habit_id in habit_ids:
+		_invalidate_habit(db, habit_id)
 
 # Functions to interact with checkoff table
-def add_checkoff(db, habit_id, checkedoff_on=None):
+def _checkoff_date(checkedoff_on):
+	"""Return a checkoff date as YYYY-MM-DD, None for the current date. Raises ValueError for an invalid date, before anything is inserted:
+	the streak summary could not compute its period and the checkoff would be recorded without it."""
+	if checkedoff_on is None:
+		return None
+	return datetime.date.fromisoformat(str(checkedoff_on)).isoformat()
+
+def add_checkoff(db, habit_id, checkedoff_on=None, user_id=DEFAULT_USER_ID):
 	"""Function to mark a habit as completed. Add a new record in checkoffs table. The date is set to the current date by default in the database.
+	Nothing is recorded if the habit does not belong to the user or if it was already checked off on that date.
 	Parameters:
 		- habit_id: the unique identifier of the habit to be checked off.
-		- Requires a database connection."""
+		- user_id: the user owning the habit (DEFAULT_USER_ID by default).
+		- Requires a database connection.
+	Returns True if the checkoff was recorded, False otherwise. Raises ValueError if checkedoff_on is not a valid date."""
+	checkedoff_on = _checkoff_date(checkedoff_on)
 	cur = db.cursor()
 	# If checkedoff_on is None, use the current date
-	if checkedoff_on is None:
-		cur.execute("""
-			INSERT INTO checkoffs (habit_id, checkedoff_on)
-			VALUES (?, date('now'))
-			""", (habit_id,))
-	else:
+	cur.execute(f"""
+		INSERT OR IGNORE INTO checkoffs (user_id, habit_id, checkedoff_on, {CHECKOFF_PERIOD_COLUMNS})
+		SELECT user_id, habit_id, d.checkedoff_on, {checkoff_periods_sql("d.checkedoff_on")}
+		FROM habits, (SELECT COALESCE(?, date('now')) AS checkedoff_on) d
+		WHERE habit_id = ? AND user_id = ?
+		RETURNING checkoff_id, habit_id, checkedoff_on
+		""", (checkedoff_on, habit_id, user_id))
+	# Update the streak summary of the habit with the new checkoff (an ignored duplicate returns no row)
+	checkoffs = cur.fetchall()
+	_advance_streak_state(cur, checkoffs)
+	_commit(db)
+	return len(checkoffs) > 0
+
+def add_checkoffs_bulk(db, checkoffs, user_id=DEFAULT_USER_ID):
+	"""Function to mark many habits as completed at once. All the records are inserted in the checkoffs table with a single statement and a single commit.
+	Checkoffs of habits not belonging to the user and checkoffs already recorded (same habit, same date) are skipped.
+	Parameters:
+		- checkoffs: an iterable of (habit_id, checkedoff_on) tuples. checkedoff_on can be None to use the current date.
+		- user_id: the user owning the habits (DEFAULT_USER_ID by default).
+		- Requires a database connection.
+	Returns the number of checkoffs inserted. Raises ValueError if a date is not valid, nothing is inserted then."""
+	cur = db.cursor()
+	# The write lock is taken before the last checkoff id is read: another connection committing between the read and the insert
+	# would make the upgrade to a write transaction fail at once (busy_timeout does not apply)
+	with transaction(db, immediate=True):
+		# Checkoff ids only grow, the new checkoffs are the ones after the last id used before the insert
+		cur.execute("SELECT COALESCE(MAX(checkoff_id), 0) FROM checkoffs;")
+		last_checkoff_id = cur.fetchone()[0]
+		cur.executemany(f"""
+			INSERT OR IGNORE INTO checkoffs (user_id, habit_id, checkedoff_on, {CHECKOFF_PERIOD_COLUMNS})
+			SELECT user_id, habit_id, d.checkedoff_on, {checkoff_periods_sql("d.checkedoff_on")}
+			FROM habits, (SELECT COALESCE(?, date('now')) AS checkedoff_on) d
+			WHERE habit_id = ? AND user_id = ?
+			""", ((_checkoff_date(checkedoff_on), habit_id, user_id) for habit_id, checkedoff_on in checkoffs))
+		inserted = cur.rowcount
+		cur.row_factory = None
 		cur.execute("""
-			INSERT INTO checkoffs (habit_id, checkedoff_on)
-			VALUES (?, ?)
-			""", (habit_id, checkedoff_on))
-	db.commit()
+			SELECT checkoff_id, habit_id, checkedoff_on
+			FROM checkoffs
+			WHERE checkoff_id > ?
+			ORDER BY checkoff_id;
+			""", (last_checkoff_id,))
+		_advance_streak_state(cur, cur.fetchall())
+	return inserted
 
-def last_checkedoff_on(db, habit_id):
+def last_checkedoff_on(db, habit_id, user_id=DEFAULT_USER_ID):
 	"""Function to retrieve the last checkedoff date of a habit.
 	Returns the last checkedoff date of a habit from the checkoffs table.
 	Parameters:
 		- habit_id: the unique identifier of the habit to be checked off.
+		- user_id: the user owning the habit (DEFAULT_USER_ID by default).
 		- Requires a database connection."""
 	cur = db.cursor()
 	cur.execute("""
 		SELECT checkedoff_on
 		FROM checkoffs
-		WHERE habit_id = ?
+		WHERE user_id = ? AND habit_id = ?
 		ORDER BY checkedoff_on DESC
 		LIMIT 1;
-		""", (habit_id,))
+		""", (user_id, habit_id))
 	result = cur.fetchone()
 	if result:
 		return result[0]  # Return the first (and only) item in the tuple
 	return None  # Return None if there is no result
 
+def get_last_checkoff_day(db, habit_id, created_by, is_active, user_id=DEFAULT_USER_ID):
+	"""Function to retrieve the periodicity of a habit and the day numbers of its last checkoff, in a single query.
+	Parameters:
+		- habit_id: the unique identifier of the habit.
+		- created_by: 'user' or 'predefined'
+		- is_active: 1 if created by user, 0 if predefined.
+		- user_id: the user owning the habit (DEFAULT_USER_ID by default).
+		- Requires a database connection.
+	Returns a (periodicity, checkedoff_day, checkedoff_month) tuple (see period_bucket), None if the habit was never checked off."""
+	cur = db.cursor()
+	cur.execute("""
+		SELECT h.periodicity, c.checkedoff_day, c.checkedoff_month
+		FROM habits h
+		JOIN checkoffs c ON c.user_id = h.user_id AND c.habit_id = h.habit_id
+		WHERE h.user_id = ? AND h.habit_id = ? AND h.created_by = ? AND h.is_active = ?
+		ORDER BY c.checkedoff_on DESC
+		LIMIT 1;
+		""", (user_id, habit_id, created_by, is_active))
+	return cur.fetchone()
+
+def get_last_checkoffs(db, created_by, is_active, user_id=None):
+	"""Function to retrieve the last checkedoff date of every habit in a single query (one index lookup per habit).
+	Parameters:
+		- created_by: 'user' or 'predefined'
+		- is_active: 1 if created by user, 0 if predefined.
+		- user_id: the user owning the habits, None (default) for the habits of all users.
+		- Requires a database connection.
+	Returns a list of (habit_id, periodicity, last checkedoff date) tuples. Habits never checked off are not returned."""
+	user_filter = "" if user_id is None else "AND h.user_id = :user_id"
+	cur = db.cursor()
+	cur.row_factory = None
+	cur.execute(f"""
+		SELECT habit_id, periodicity, last_checkedoff_on
+		FROM (
+			SELECT h.habit_id, h.periodicity,
+				(SELECT MAX(c.checkedoff_on) FROM checkoffs c WHERE c.user_id = h.user_id AND c.habit_id = h.habit_id) AS last_checkedoff_on
+			FROM habits h
+			WHERE h.created_by = :created_by AND h.is_active = :is_active {user_filter}
+		)
+		WHERE last_checkedoff_on IS NOT NULL;
+		""", {"created_by": created_by, "is_active": is_active, "user_id": user_id})
+	return cur.fetchall()
+
 # Functions to retrieve lists of habits for analysis
-def get_all_habits(db, created_by, is_active):
+def get_all_habits(db, created_by, is_active, user_id=DEFAULT_USER_ID):
 	"""Function to retrieve a list of all active tracked habits (is_active = 1) from the habits table created by user (created_by = user).
 	Parameters:
 		- created_by: 'user' or 'predefined'
 		- is_active: 1 if created by user, 0 if predefined.
+		- user_id: the user owning the habits (DEFAULT_USER_ID by default).
 		- Requires a database connection."""
 	cur = db.cursor()
 	cur.execute("""
 		SELECT *
 		FROM habits
-		WHERE created_by = ? AND is_active = ?
-		""", (created_by, is_active))
+		WHERE user_id = ? AND created_by = ? AND is_active = ?
+		""", (user_id, created_by, is_active))
 	return cur.fetchall()
 
-def get_habit_ids(db):
+def get_habit_ids(db, user_id=DEFAULT_USER_ID):
 	"""Function to retrieve a list of all active tracked habits (is_active = 1) from the habits table created by user (created_by = user).
-	Requires a database connection.
+	Requires a database connection and the user owning the habits (DEFAULT_USER_ID by default).
 	Function returns a list of habit_id."""
 	cur = db.cursor()
 	cur.execute("""
 		SELECT habit_id
 		FROM habits
-		WHERE created_by = ? AND is_active = ?
-		""", ('user', 1))
+		WHERE user_id = ? AND created_by = ? AND is_active = ?
+		""", (user_id, 'user', 1))
 	return [id[0] for id in cur.fetchall()]
 
-def get_habits_by_periodicity(db, periodicity, created_by, is_active):
+def get_habits_by_periodicity(db, periodicity, created_by, is_active, user_id=DEFAULT_USER_ID):
 	"""Function that retrieves list of active tracked habits by periodicity.
 	Parameters:
 		- periodicity is selected by the user (daily, weekly or monthly).
 		- created_by: 'user' or 'predefined'
 		- is_active: 1 if created by user, 0 if predefined.
+		- user_id: the user owning the habits (DEFAULT_USER_ID by default).
 		- Requires a database connection.
 	Returns a list of habits with the requested periodicity."""
 	cur = db.cursor()
 	cur.execute("""
 		SELECT *
 		FROM habits
-		WHERE periodicity = ? AND created_by = ? AND is_active = ?
-		""", (periodicity, created_by, is_active))
+		WHERE user_id = ? AND periodicity = ? AND created_by = ? AND is_active = ?
+		""", (user_id, periodicity, created_by, is_active))
+	return cur.fetchall()
+
+def get_habits_page(db, created_by, is_active, after_habit_id=0, page_size=20, periodicity=None, user_id=DEFAULT_USER_ID):
+	"""Function to retrieve one page of the list of habits, in habit_id order. Pages are found by key (the habits after after_habit_id)
+	instead of by offset, so reading any page costs the same index lookup and only the columns displayed are selected.
+	Parameters:
+		- created_by: 'user' or 'predefined'
+		- is_active: 1 if created by user, 0 if predefined.
+		- after_habit_id: the habit_id of the last habit of the previous page, 0 (default) for the first page.
+		- page_size: the maximum number of habits returned.
+		- periodicity: daily, weekly or monthly to list only the habits with this periodicity, None (default) for all habits.
+		- user_id: the user owning the habits (DEFAULT_USER_ID by default).
+		- Requires a database connection.
+	Returns a list of (habit_id, task, periodicity, created_on, updated_on) tuples, empty after the last page."""
+	periodicity_filter = "" if periodicity is None else "AND periodicity = :periodicity"
+	cur = db.cursor()
+	cur.execute(f"""
+		SELECT habit_id, task, periodicity, created_on, updated_on
+		FROM habits
+		WHERE user_id = :user_id AND created_by = :created_by AND is_active = :is_active {periodicity_filter} AND habit_id > :after_habit_id
+		ORDER BY habit_id
+		LIMIT :page_size;
+		""", {"user_id": user_id, "created_by": created_by, "is_active": is_active, "periodicity": periodicity,
+			"after_habit_id": after_habit_id, "page_size": page_size})
 	return cur.fetchall()
 
+def iter_habit_pages(db, created_by, is_active, page_size=20, periodicity=None, user_id=DEFAULT_USER_ID):
+	"""Generator of the pages of the list of habits (see get_habits_page). A page is only queried when the previous one has been consumed.
+	Requires a database connection."""
+	after_habit_id = 0
+	while True:
+		page = get_habits_page(db, created_by, is_active, after_habit_id, page_size, periodicity, user_id)
+		if not page:
+			return
+		yield page
+		if len(page) < page_size:
+			return
+		after_habit_id = page[-1].habit_id
+
 # Functions to handle streaks.
-def start_streak(db, habit_id, started_on=None):
+def start_streak(db, habit_id, started_on=None, user_id=DEFAULT_USER_ID):
 	"""Function to add a new record to the streak table when a new habit is created by user or when user mark habit as completed after breaking it
 	Parameters:
 		- The creation date is set to the current date by default in the database.
 		- habit_id will be used as foreign key to track the habit's streak. It is retrieved from add_habit function.
+		- user_id: the user owning the habit (DEFAULT_USER_ID by default).
 		- Requires a database connection."""
 	cur = db.cursor()
 	if started_on is None:
 		cur.execute("""
-			INSERT INTO streaks (habit_id, started_on)
-			Values (?, date('now'));
-			""", (habit_id,))
+			INSERT INTO streaks (user_id, habit_id, started_on)
+			Values (?, ?, date('now'));
+			""", (user_id, habit_id))
 	else:
 		cur.execute("""
-			INSERT INTO streaks (habit_id, started_on)
-			Values (?, ?);
-			""", (habit_id, started_on))
-	db.commit()
+			INSERT INTO streaks (user_id, habit_id, started_on)
+			Values (?, ?, ?);
+			""", (user_id, habit_id, started_on))
+	_commit(db)
 
-def increment_current_streak(db, habit_id):
+def increment_current_streak(db, habit_id, user_id=DEFAULT_USER_ID):
 	"""Function to update the current habit streak by adding 1 to integer in current_streak column
 	Parameters:
 		- habit_id: the unique identifier of the habit to be deleted.
+		- user_id: the user owning the habit (DEFAULT_USER_ID by default).
 		- Requires a database connection."""
 	cur = db.cursor()
 	cur.execute("""
 		UPDATE streaks
 		SET current_streak = current_streak + 1
-		WHERE habit_id = ? AND is_active = 1;
-		""", (habit_id,))
-	db.commit()
+		WHERE user_id = ? AND habit_id = ? AND is_active = 1;
+		""", (user_id, habit_id))
+	_commit(db)
+
+def increment_streaks_bulk(db, habit_ids, user_id=DEFAULT_USER_ID):
+	"""Function to add 1 to the current streak of many habits at once, with a single statement and a single commit.
+	Parameters:
+		- habit_ids: an iterable of habit_id whose active streak is incremented.
+		- user_id: the user owning the habits (DEFAULT_USER_ID by default).
+		- Requires a database connection.
+	Returns the number of streaks updated."""
+	cur = db.cursor()
+	cur.executemany("""
+		UPDATE streaks
+		SET current_streak = current_streak + 1
+		WHERE user_id = ? AND habit_id = ? AND is_active = 1;
+		""", ((user_id, habit_id) for habit_id in habit_ids))
+	_commit(db)
+	return cur.rowcount
 
-def end_streak(db, habit_id):
+def end_streak(db, habit_id, user_id=DEFAULT_USER_ID):
 	"""Function to update the attribute is_active to 0 when habit is deleted or when user breaks the habit.
 	Parameters:
 		- habit_id: the unique identifier of the habit to be deleted.
+		- user_id: the user owning the habit (DEFAULT_USER_ID by default).
 		- Requires a database connection."""
 	cur = db.cursor()
 	cur.execute("""
 		UPDATE streaks
 		SET is_active = 0, ended_on = date('now')
-		WHERE habit_id = ? AND is_active = 1;
-		""", (habit_id,))
-	db.commit()
+		WHERE user_id = ? AND habit_id = ? AND is_active = 1;
+		""", (user_id, habit_id))
+	_commit(db)
+
+def end_streaks_bulk(db, habit_ids, user_id=None):
+	"""Function to end the active streak of many habits whose period lapsed at once, with one statement per table and a single commit.
+	A streak ends with the last checkoff of its habit, like the streaks closed by rebuild_streaks and the end dates reported from the
+	streak summaries (streak_state table). The end of the longest streak is recorded in the streak summary when it is the streak ended.
+	Parameters:
+		- habit_ids: a list of habit_id whose active streak is ended.
+		- user_id: the user owning the habits, None (default) when the habits belong to several users.
+		- Requires a database connection.
+	Returns the number of streaks ended."""
+	params = [{"user_id": user_id, "habit_id": habit_id} for habit_id in habit_ids]
+	cur = db.cursor()
+	with transaction(db):
+		cur.executemany("""
+			UPDATE streaks
+			SET is_active = 0, ended_on = COALESCE((SELECT last_checkedoff_on FROM streak_state WHERE habit_id = :habit_id), date('now'))
+			WHERE user_id = COALESCE(:user_id, (SELECT user_id FROM habits WHERE habit_id = :habit_id)) AND habit_id = :habit_id AND is_active = 1;
+			""", params)
+		ended = cur.rowcount
+		cur.executemany("""
+			UPDATE streak_state
+			SET longest_ended_on = last_checkedoff_on
+			WHERE habit_id = :habit_id AND longest_ended_on IS NULL AND longest_started_on IS current_started_on AND current_streak > 0
+				AND (:user_id IS NULL OR habit_id IN (SELECT habit_id FROM habits WHERE user_id = :user_id));
+			""", params)
+	return ended
 
-def get_longest_streak_all_habits(db, created_by, is_active):
-	"""Function to retrieve the longest streak of all habits.
+# Longest streak of a habit, as returned by get_longest_streak_all_habits and get_longest_streak_one_habit
+StreakRow = collections.namedtuple("StreakRow", ("habit_id", "streak", "started_on", "ended_on"))
+
+def get_longest_streak_all_habits(db, created_by, is_active, user_id=DEFAULT_USER_ID):
+	"""Function to retrieve the longest streak of all habits: the first entry of the streak leaderboard (see get_streak_leaderboard).
 	Parameters:
 		- created_by: 'user' or 'predefined'
 		- is_active: 1 if created by user, 0 if predefined.
-	Returns habit_id, streak, start and end dates.
+		- user_id: the user owning the habits (DEFAULT_USER_ID by default), None for the habits of all users.
+	Returns habit_id, streak, start and end dates (None if the streak is still ongoing).
 	- Requires a database connection."""
+	leaderboard = get_streak_leaderboard(db, created_by, is_active, 1, user_id=user_id)
+	if not leaderboard:
+		return None
+	longest = leaderboard[0]
+	return StreakRow(longest.habit_id, longest.streak, longest.started_on, longest.ended_on)
+
+def get_streak_leaderboard(db, created_by, is_active, k=10, periodicity=None, ongoing_only=False, user_id=DEFAULT_USER_ID, habit_id=None):
+	"""Function to retrieve the top k streaks, one per habit, with the name and periodicity of the habits in a single query.
+	The streak summaries (streak_state table) are read in streak order through their index, so only the first habits are looked at.
+	Parameters:
+		- created_by: 'user' or 'predefined'
+		- is_active: 1 if created by user, 0 if predefined.
+		- k: the number of streaks returned.
+		- periodicity: daily, weekly or monthly to rank only the habits with this periodicity, None (default) for all habits.
+		- ongoing_only: False (default) to rank the longest streak of each habit, True to rank the current streaks still ongoing.
+		- user_id: the user owning the habits (DEFAULT_USER_ID by default), None for the habits of all users.
+		- habit_id: the unique identifier of a habit to retrieve only its entry (e.g. right after a checkoff), None (default) for all habits.
+		- Requires a database connection.
+	Returns a list of (habit_id, task, periodicity, streak, start date, end date) tuples, longest first. The end date is None for an ongoing streak."""
+	filters = ["h.created_by = :created_by", "h.is_active = :is_active"]
+	if user_id is not None:
+		filters.append("h.user_id = :user_id")
+	if habit_id is not None:
+		filters.append("s.habit_id = :habit_id")
+	if periodicity is not None:
+		filters.append("h.periodicity = :periodicity")
+	if ongoing_only:
+		filters.append(_CURRENT_STREAK_ONGOING_SQL)
+		columns = "s.current_streak AS streak, s.current_started_on AS started_on, NULL AS ended_on"
+		order = "s.current_streak"
+	else:
+		columns = f"s.longest_streak AS streak, s.longest_started_on AS started_on, {_LONGEST_ENDED_ON_SQL} AS ended_on"
+		order = "s.longest_streak"
 	cur = db.cursor()
-	cur.execute("""
-		SELECT habit_id, current_streak, started_on, ended_on
-		FROM streaks
-			WHERE habit_id IN (SELECT habit_id FROM habits WHERE created_by = ? AND is_active = ?)
-		ORDER BY current_streak DESC
-        LIMIT 1;
-        """, (created_by, is_active))
+	cur.execute(f"""
+		SELECT h.habit_id, h.task, h.periodicity, {columns}
+		FROM streak_state s
+		JOIN habits h ON h.habit_id = s.habit_id
+		WHERE {" AND ".join(filters)}
+		ORDER BY {order} DESC, s.habit_id
+		LIMIT :k;
+		""", {"created_by": created_by, "is_active": is_active, "user_id": user_id, "periodicity": periodicity, "habit_id": habit_id, "k": k})
+	return cur.fetchall()
+
+def get_longest_streak_one_habit(db, habit_id, created_by, is_active, user_id=DEFAULT_USER_ID):
+	"""Function to retrieve the longest streak of a specific habit from its streak summary. Returns habit_id, streak, start and end dates (None if the streak is still ongoing).
+	Parameters:
+		- habit_id: the unique identifier of the habit user wants the longest streak for.
+		- created_by: 'user' or 'predefined'
+		- is_active: 1 if created by user, 0 if predefined.
+		- user_id: the user owning the habit (DEFAULT_USER_ID by default).
+		- Requires a database connection."""
+	cur = db.cursor()
+	cur.execute(f"""
+		SELECT s.habit_id, s.longest_streak AS streak, s.longest_started_on AS started_on, {_LONGEST_ENDED_ON_SQL} AS ended_on
+		FROM habits h
+		JOIN streak_state s ON s.habit_id = h.habit_id
+		WHERE h.user_id = ? AND h.created_by = ? AND h.is_active = ? AND h.habit_id = ?;
+		""", (user_id, created_by, is_active, habit_id))
 	return cur.fetchone()
 
-def get_longest_streak_one_habit(db, habit_id, created_by, is_active):
-    """Function to retrieve the longest streak of a specific habit. Returns habit_id, streak, start and end dates.
-    Parameters:
-        - habit_id: the unique identifier of the habit user wants the longest streak for.
-        - created_by: 'user' or 'predefined'
-        - is_active: 1 if created by user, 0 if predefined.
-        - Requires a database connection."""
-    cur = db.cursor()
-    cur.execute("""
-        SELECT s.habit_id, s.current_streak, s.started_on, s.ended_on
-        FROM streaks s
-        JOIN habits h ON s.habit_id = h.habit_id
-        WHERE h.created_by = ? AND h.is_active = ? AND s.habit_id = ?
-        ORDER BY s.current_streak DESC
-        LIMIT 1;
-        """, (created_by, is_active, habit_id))
-    return cur.fetchone()
\ No newline at end of file
+# Streaks derived from the checkoffs history.
+_EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+
+def period_bucket(periodicity, day):
+	"""Return the number of the period a date belongs to: the day (days since 1970-01-01) for daily habits,
+	the week starting on Monday for weekly habits and the calendar month for monthly habits. Consecutive periods have consecutive numbers.
+	These are the checkedoff_day, checkedoff_week and checkedoff_month columns of the checkoffs table (see checkoff_periods_sql).
+	Parameters:
+		- periodicity: daily, weekly or monthly.
+		- day: a datetime.date or an ISO formatted date (YYYY-MM-DD)."""
+	if isinstance(day, str):
+		day = datetime.date.fromisoformat(day)
+	if periodicity == 'daily':
+		return day.toordinal() - _EPOCH_ORDINAL
+	elif periodicity == 'weekly':
+		# 1970-01-01 is a Thursday: shifting by 3 days makes the weeks start on Monday
+		return (day.toordinal() - _EPOCH_ORDINAL + 3) // 7
+	return day.year * 12 + day.month - 1
+
+# SQL expressions of the period numbers of a date. The julian day number (julianday + 0.5) is positive, so its integer division rounds down
+# like period_bucket: 2440588 is the julian day number of 1970-01-01 and 348655 * 7 + 3 = 2440588.
+def epoch_day_sql(date_sql):
+	"""Return the SQL expression of the day number (days since 1970-01-01) of the SQL date date_sql, the checkedoff_day column of the checkoffs table.
+	Modules computing day numbers in their own queries (habit_analytics) use it so that a date is always given the same day."""
+	return f"(CAST(julianday({date_sql}) + 0.5 AS INTEGER) - 2440588)"
+
+def _epoch_week_sql(date_sql):
+	return f"(CAST(julianday({date_sql}) + 0.5 AS INTEGER) / 7 - 348655)"
+
+def _month_sql(date_sql):
+	return f"(CAST(strftime('%Y', {date_sql}) AS INTEGER) * 12 + CAST(strftime('%m', {date_sql}) AS INTEGER) - 1)"
+
+# Period number columns of the checkoffs table, written by every INSERT into checkoffs with the values of checkoff_periods_sql
+CHECKOFF_PERIOD_COLUMNS = "checkedoff_day, checkedoff_week, checkedoff_month"
+
+def checkoff_periods_sql(date_sql):
+	"""Return the SQL expressions of the checkedoff_day, checkedoff_week and checkedoff_month columns (CHECKOFF_PERIOD_COLUMNS) of a checkoff
+	dated date_sql. Modules inserting checkoffs in their own queries (importer) use it so that the stored day numbers match the date."""
+	return f"{epoch_day_sql(date_sql)}, {_epoch_week_sql(date_sql)}, {_month_sql(date_sql)}"
+
+def _period_bucket_sql(date_sql, periodicity_sql="h.periodicity"):
+	"""Return the SQL expression computing period_bucket of a date."""
+	return f"""(CASE {periodicity_sql}
+		WHEN 'daily' THEN {epoch_day_sql(date_sql)}
+		WHEN 'weekly' THEN {_epoch_week_sql(date_sql)}
+		ELSE {_month_sql(date_sql)}
+	END)"""
+
+def _checkoff_period_sql(checkoff="c", periodicity_sql="h.periodicity"):
+	"""Return the SQL expression of period_bucket of a checkoff, read from its integer period columns."""
+	return f"""(CASE {periodicity_sql}
+		WHEN 'daily' THEN {checkoff}.checkedoff_day
+		WHEN 'weekly' THEN {checkoff}.checkedoff_week
+		ELSE {checkoff}.checkedoff_month
+	END)"""
+
+# End date of the longest streak of a habit (streak_state s joined with habits h): a streak still counted as ongoing ends with its last checkoff
+# as soon as a whole period passed without checkoff, even if no new checkoff was recorded since.
+_LONGEST_ENDED_ON_SQL = f"""(CASE
+	WHEN s.longest_ended_on IS NULL AND s.last_period IS NOT NULL AND {_period_bucket_sql("date('now')")} - s.last_period > 1 THEN s.last_checkedoff_on
+	ELSE s.longest_ended_on
+	END)"""
+
+# Whether the current streak of a habit (streak_state s joined with habits h) is still ongoing: no whole period passed since its last checkoff.
+_CURRENT_STREAK_ONGOING_SQL = f"""(s.current_streak > 0 AND (s.last_period IS NULL OR {_period_bucket_sql("date('now')")} - s.last_period <= 1))"""
+
+def _compute_streak_runs(cur, habit_ids=None, as_of=None):
+	"""Compute all the streaks of the habits from the checkoffs table in a single SQL statement, into the temporary table streak_runs.
+	Checkoffs are grouped by period, then consecutive periods are grouped into islands (period number minus its rank, which is constant inside
+	a run of consecutive periods). Each island is one streak, its length is its number of periods.
+	Parameters:
+		- habit_ids: list of habit_id to compute, None (default) for all habits.
+		- as_of: the date the streaks are evaluated on, the current date by default.
+		- Requires a cursor."""
+	if habit_ids is None:
+		habit_filter = ""
+	else:
+		habit_filter = "AND h.habit_id IN (SELECT value FROM json_each(:habit_ids))"
+	params = {"as_of": as_of, "habit_ids": None if habit_ids is None else json.dumps(list(habit_ids))}
+	cur.execute("DROP TABLE IF EXISTS temp.streak_runs;")
+	cur.execute(f"""
+		CREATE TEMP TABLE streak_runs AS
+		WITH periods AS (
+			SELECT h.user_id, c.habit_id, h.is_active, {_checkoff_period_sql()} AS period,
+				{_period_bucket_sql("COALESCE(:as_of, date('now'))")} AS current_period,
+				MIN(c.checkedoff_on) AS first_on, MAX(c.checkedoff_on) AS last_on, MAX(c.checkoff_id) AS last_checkoff_id
+			FROM habits h
+			JOIN checkoffs c ON c.user_id = h.user_id AND c.habit_id = h.habit_id
+			WHERE 1 {habit_filter}
+			GROUP BY c.habit_id, period
+		),
+		islands AS (
+			SELECT *, period - ROW_NUMBER() OVER (PARTITION BY habit_id ORDER BY period) AS island
+			FROM periods
+		)
+		SELECT user_id, habit_id, is_active, COUNT(*) AS streak, MIN(first_on) AS started_on, MAX(last_on) AS ended_on,
+			MAX(period) AS last_period, MAX(last_checkoff_id) AS last_checkoff_id,
+			MAX(current_period) - MAX(period) <= 1 AS is_recent,
+			ROW_NUMBER() OVER (PARTITION BY habit_id ORDER BY island DESC) AS recency,
+			ROW_NUMBER() OVER (PARTITION BY habit_id ORDER BY COUNT(*) DESC, island DESC) AS length_rank
+		FROM islands
+		GROUP BY user_id, habit_id, island;
+		""", params)
+	# _write_streak_state looks the runs up by habit: without an index it would scan the whole table for every habit
+	cur.execute("CREATE INDEX temp.idx_streak_runs_habit ON streak_runs(habit_id, recency, length_rank);")
+
+def _write_streak_state(cur):
+	"""Replace the streak summary of the habits found in the temporary table streak_runs (see _compute_streak_runs). Requires a cursor."""
+	cur.execute("""
+		INSERT OR REPLACE INTO streak_state (habit_id, last_checkoff_id, last_checkedoff_on, last_period, current_streak, current_started_on,
+			longest_streak, longest_started_on, longest_ended_on)
+		SELECT cur.habit_id, (SELECT MAX(last_checkoff_id) FROM temp.streak_runs r WHERE r.habit_id = cur.habit_id),
+			cur.ended_on, cur.last_period, cur.streak, cur.started_on,
+			lng.streak, lng.started_on, CASE WHEN lng.recency = 1 THEN NULL ELSE lng.ended_on END
+		FROM temp.streak_runs cur
+		JOIN temp.streak_runs lng ON lng.habit_id = cur.habit_id AND lng.length_rank = 1
+		WHERE cur.recency = 1;
+		""")
+
+def _seed_streak_state_from_streaks(cur):
+	"""Create the streak summary of the habits having streaks but no checkoff (predefined habits) from their longest streak. Requires a cursor."""
+	cur.execute("""
+		INSERT OR IGNORE INTO streak_state (habit_id, current_streak, current_started_on, longest_streak, longest_started_on, longest_ended_on)
+		SELECT s.habit_id, CASE WHEN s.ended_on IS NULL THEN s.current_streak ELSE 0 END, CASE WHEN s.ended_on IS NULL THEN s.started_on END,
+			s.current_streak, s.started_on, s.ended_on
+		FROM streaks s
+		WHERE s.streak_id = (SELECT s2.streak_id FROM streaks s2 WHERE s2.user_id = s.user_id AND s2.habit_id = s.habit_id
+				ORDER BY s2.current_streak DESC, s2.streak_id DESC LIMIT 1)
+			AND NOT EXISTS (SELECT 1 FROM checkoffs c WHERE c.user_id = s.user_id AND c.habit_id = s.habit_id);
+		""")
+
+def rebuild_streaks(db, habit_ids=None, as_of=None):
+	"""Function to recompute the streaks table, the streak summaries (streak_state table) and the completion bitmaps from the checkoffs table, repairing counters that drifted from the history.
+	All the streaks are computed in a single SQL statement (see _compute_streak_runs).
+	The last streak of a habit is still active if the habit is active and its last period is the current or the previous one.
+	Habits without any checkoff (e.g. predefined habits) keep their streaks untouched.
+	Parameters:
+		- habit_ids: list of habit_id to rebuild, None (default) to rebuild all habits.
+		- as_of: the date the streaks are evaluated on, the current date by default.
+		- Requires a database connection.
+	Returns the number of streaks written."""
+	cur = db.cursor()
+	# The checkoffs are read before the streaks are written: the write lock is taken first, like in add_checkoffs_bulk
+	with transaction(db, immediate=True):
+		_compute_streak_runs(cur, habit_ids, as_of)
+		cur.execute("DELETE FROM streaks WHERE (user_id, habit_id) IN (SELECT user_id, habit_id FROM temp.streak_runs);")
+		cur.execute("""
+			INSERT INTO streaks (user_id, habit_id, started_on, ended_on, current_streak, is_active)
+			SELECT user_id, habit_id, started_on,
+				CASE WHEN recency = 1 AND is_recent AND is_active = 1 THEN NULL ELSE ended_on END,
+				streak,
+				recency = 1 AND is_recent AND is_active = 1
+			FROM temp.streak_runs
+			ORDER BY habit_id, started_on;
+			""")
+		written = cur.rowcount
+		_write_streak_state(cur)
+		cur.execute("DROP TABLE temp.streak_runs;")
+		_rebuild_completion_bitmaps(cur, habit_ids)
+	return written
+
+def _advance_streak_state(cur, checkoffs):
+	"""Fold new checkoffs into the streak summary of their habits. The summary keeps a watermark (last checkoff id and period processed)
+	and the length of the current run, so each checkoff costs O(1): the history of the habit is never read again.
+	A checkoff in the same period as the last one only moves the watermark, a checkoff in the next period extends the current streak
+	and a later one ends it and starts a new streak. Checkoffs dated before the last processed period are only counted by rebuild_streaks.
+	The period of every checkoff, older ones included, is also set in the completion bitmap of its habit.
+	Parameters:
+		- checkoffs: list of (checkoff_id, habit_id, checkedoff_on) tuples ordered by checkoff_id.
+		- Requires a cursor."""
+	by_habit = {}
+	for checkoff_id, habit_id, checkedoff_on in checkoffs:
+		by_habit.setdefault(habit_id, []).append((checkoff_id, checkedoff_on))
+
+	for habit_id, habit_checkoffs in by_habit.items():
+		cur.execute("""
+			SELECT h.periodicity, s.last_checkoff_id, s.last_checkedoff_on, s.last_period, s.current_streak, s.current_started_on,
+				s.longest_streak, s.longest_started_on, s.longest_ended_on
+			FROM habits h
+			LEFT JOIN streak_state s ON s.habit_id = h.habit_id
+			WHERE h.habit_id = ?;
+			""", (habit_id,))
+		row = cur.fetchone()
+		if row is None:
+			continue
+		periodicity, last_checkoff_id, last_on, last_period, current, current_started_on, longest, longest_started_on, longest_ended_on = row
+		current = current or 0
+		longest = longest or 0
+
+		periods = []
+		for checkoff_id, checkedoff_on in habit_checkoffs:
+			period = period_bucket(periodicity, checkedoff_on)
+			periods.append(period)
+			last_checkoff_id = checkoff_id
+			if last_period is not None and period <= last_period:
+				# Same period as the last checkoff or older checkoff: only the watermark moves
+				if period == last_period and checkedoff_on > last_on:
+					last_on = checkedoff_on
+				continue
+			if last_period is not None and period == last_period + 1:
+				current += 1
+			else:
+				# First checkoff or at least one period missed: the current streak ends and a new one starts
+				if longest_ended_on is None and longest_started_on == current_started_on and current:
+					longest_ended_on = last_on
+				current, current_started_on = 1, checkedoff_on
+			last_period, last_on = period, checkedoff_on
+			if current >= longest:
+				longest, longest_started_on, longest_ended_on = current, current_started_on, None
+
+		cur.execute("""
+			INSERT OR REPLACE INTO streak_state (habit_id, last_checkoff_id, last_checkedoff_on, last_period, current_streak, current_started_on,
+				longest_streak, longest_started_on, longest_ended_on)
+			VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?);
+			""", (habit_id, last_checkoff_id, last_on, last_period, current, current_started_on, longest, longest_started_on, longest_ended_on))
+		_set_completion_bits(cur, habit_id, periods)
+
+# Completion bitmaps. Each habit has one bit per period (see period_bucket), set when the habit was checked off in that period.
+# The bits are stored in chunks of BITMAP_CHUNK_BITS periods, keyed by habit_id and period // BITMAP_CHUNK_BITS: checking a period reads a single row,
+# and the 2 years of history of a daily habit take 2 or 3 chunks of 128 bytes instead of hundreds of checkoffs rows.
+BITMAP_CHUNK_BITS = 1024
+
+def _set_completion_bits(cur, habit_id, periods):
+	"""Set the bits of periods (period numbers, see period_bucket) in the completion bitmap of a habit. Requires a cursor."""
+	chunks = {}
+	for period in periods:
+		chunks.setdefault(period // BITMAP_CHUNK_BITS, []).append(period % BITMAP_CHUNK_BITS)
+	for chunk, offsets in chunks.items():
+		cur.execute("SELECT bits FROM habit_bitmaps WHERE habit_id = ? AND chunk = ?;", (habit_id, chunk))
+		row = cur.fetchone()
+		bits = bytearray(row[0]) if row is not None else bytearray(BITMAP_CHUNK_BITS // 8)
+		for offset in offsets:
+			bits[offset >> 3] |= 1 << (offset & 7)
+		cur.execute("INSERT OR REPLACE INTO habit_bitmaps (habit_id, chunk, bits) VALUES (?, ?, ?);", (habit_id, chunk, bytes(bits)))
+
+def _rebuild_completion_bitmaps(cur, habit_ids=None):
+	"""Recompute the completion bitmaps of the habits from the checkoffs table. SQLite lists the periods of each chunk,
+	NumPy packs them into bits, so the checkoffs are never handled one by one in Python.
+	Parameters:
+		- habit_ids: list of habit_id to rebuild, None (default) for all habits.
+		- Requires a cursor."""
+	if habit_ids is None:
+		habit_filter = ""
+	else:
+		habit_filter = "AND h.habit_id IN (SELECT value FROM json_each(:habit_ids))"
+	params = {"habit_ids": None if habit_ids is None else json.dumps(list(habit_ids)), "chunk_bits": BITMAP_CHUNK_BITS}
+	cur.execute("DELETE FROM habit_bitmaps WHERE :habit_ids IS NULL OR habit_id IN (SELECT value FROM json_each(:habit_ids));", params)
+	cur.row_factory = None
+	cur.execute(f"""
+		SELECT c.habit_id, {_checkoff_period_sql()} / :chunk_bits AS chunk, group_concat({_checkoff_period_sql()} % :chunk_bits, ',')
+		FROM habits h
+		JOIN checkoffs c ON c.user_id = h.user_id AND c.habit_id = h.habit_id
+		WHERE 1 {habit_filter}
+		GROUP BY c.habit_id, chunk;
+		""", params)
+	chunks = cur.fetchall()
+	bits = np.zeros(BITMAP_CHUNK_BITS, dtype=np.uint8)
+	rows = []
+	for habit_id, chunk, offsets in chunks:
+		bits[:] = 0
+		bits[np.fromstring(offsets, dtype=np.int64, sep=',')] = 1
+		rows.append((habit_id, chunk, np.packbits(bits, bitorder='little').tobytes()))
+	cur.executemany("INSERT INTO habit_bitmaps (habit_id, chunk, bits) VALUES (?, ?, ?);", rows)
+
+def _longest_run(bits):
+	"""Return the length of the longest run of consecutive set bits of an integer with O(log n) shifts and ANDs of the whole integer:
+	runs[k] has a bit set where a run of at least 2^k set bits starts, then the longest run is assembled from the largest power of two down."""
+	if bits == 0:
+		return 0
+	runs = [bits]
+	while runs[-1] & (runs[-1] >> (1 << (len(runs) - 1))):
+		runs.append(runs[-1] & (runs[-1] >> (1 << (len(runs) - 1))))
+	length = 1 << (len(runs) - 1)
+	starts = runs[-1]
+	for power in range(len(runs) - 2, -1, -1):
+		longer = starts & (runs[power] >> length)
+		if longer:
+			starts, length = longer, length + (1 << power)
+	return length
+
+def _run_ending_at(bits, position):
+	"""Return the number of consecutive set bits of an integer ending at bit position (0 if this bit is not set)."""
+	if position < 0:
+		return 0
+	mask = (1 << (position + 1)) - 1
+	# The run starts after the highest clear bit at or below position
+	return position + 1 - (~bits & mask).bit_length()
+
+def was_completed(db, habit_id, day=None, user_id=DEFAULT_USER_ID):
+	"""Function to check whether a habit was checked off in the period (day, week or month, following its periodicity) of a date.
+	The answer is one bit of the completion bitmap of the habit: a single primary key lookup, whatever the length of its history.
+	Parameters:
+		- habit_id: the unique identifier of the habit.
+		- day: the date (YYYY-MM-DD) to check, the current date by default.
+		- user_id: the user owning the habit (DEFAULT_USER_ID by default).
+		- Requires a database connection.
+	Returns True if the habit was checked off in that period, False otherwise."""
+	cur = db.cursor()
+	cur.execute(f"""
+		SELECT b.bits, p.period % :chunk_bits
+		FROM (
+			SELECT {_period_bucket_sql("COALESCE(:day, date('now'))")} AS period
+			FROM habits h
+			WHERE h.habit_id = :habit_id AND h.user_id = :user_id
+		) p
+		JOIN habit_bitmaps b ON b.habit_id = :habit_id AND b.chunk = p.period / :chunk_bits;
+		""", {"day": day, "habit_id": habit_id, "user_id": user_id, "chunk_bits": BITMAP_CHUNK_BITS})
+	row = cur.fetchone()
+	if row is None:
+		return False
+	bits, offset = row
+	return bool(bits[offset >> 3] >> (offset & 7) & 1)
+
+def get_completion_runs(db, habit_id, as_of=None, user_id=DEFAULT_USER_ID):
+	"""Function to compute the longest run and the current run of consecutive periods with a checkoff of a habit, from its completion bitmap.
+	The chunks are joined into a single integer and the runs are measured with shifts and ANDs (see _longest_run) instead of reading the checkoffs.
+	The current run is the run ending in the period of as_of, or in the previous period as the habit can still be checked off, 0 otherwise.
+	Parameters:
+		- habit_id: the unique identifier of the habit.
+		- as_of: the date (YYYY-MM-DD) the current run is evaluated on, the current date by default.
+		- user_id: the user owning the habit (DEFAULT_USER_ID by default).
+		- Requires a database connection.
+	Returns a (longest run, current run) tuple, in periods."""
+	cur = db.cursor()
+	cur.execute(f"""
+		SELECT {_period_bucket_sql("COALESCE(:as_of, date('now'))")}, b.chunk, b.bits
+		FROM habits h
+		JOIN habit_bitmaps b ON b.habit_id = h.habit_id
+		WHERE h.habit_id = :habit_id AND h.user_id = :user_id
+		ORDER BY b.chunk;
+		""", {"as_of": as_of, "habit_id": habit_id, "user_id": user_id})
+	chunks = cur.fetchall()
+	if not chunks:
+		return 0, 0
+	current_period, first_chunk = chunks[0][0], chunks[0][1]
+	# Bit i of bits is the period first_chunk * BITMAP_CHUNK_BITS + i
+	bits = 0
+	for _, chunk, chunk_bits in chunks:
+		bits |= int.from_bytes(chunk_bits, 'little') << ((chunk - first_chunk) * BITMAP_CHUNK_BITS)
+	position = current_period - first_chunk * BITMAP_CHUNK_BITS
+	return _longest_run(bits), max(_run_ending_at(bits, position), _run_ending_at(bits, position - 1))
@@ -0,0 +1,126 @@
+# Contains the streaming exporter. Habits, checkoffs and streaks are read in batches with fetchmany and written to CSV, JSON Lines
+# or a columnar format, so the memory used does not depend on the size of the tables.
+# Run it with: python export.py checkoffs checkoffs.csv
+import argparse
+import csv
+import json
+import os
+from db import get_read_db
+
+# Columns exported for each table, with their type in the columnar format
+EXPORT_TABLES = {
+    'habits': (('habit_id', 'int64'), ('user_id', 'int64'), ('task', 'string'), ('periodicity', 'string'), ('created_on', 'string'),
+               ('updated_on', 'string'), ('deleted_on', 'string'), ('is_active', 'int64'), ('created_by', 'string')),
+    'checkoffs': (('checkoff_id', 'int64'), ('user_id', 'int64'), ('habit_id', 'int64'), ('checkedoff_on', 'string')),
+    'streaks': (('streak_id', 'int64'), ('user_id', 'int64'), ('habit_id', 'int64'), ('started_on', 'string'), ('ended_on', 'string'),
+                ('current_streak', 'int64'), ('is_active', 'int64')),
+}
+FORMATS = ('csv', 'jsonl', 'columnar')
+
+
+def iter_batches(db, table, user_id=None, batch_size=10000):
+    """Generator of the rows of a table in lists of at most batch_size rows, read with fetchmany in primary key order.
+    Parameters:
+        - table: habits, checkoffs or streaks.
+        - user_id: the user whose rows are exported, None (default) for the rows of all users.
+        - batch_size: the number of rows fetched at a time.
+        - Requires a database connection."""
+    if table not in EXPORT_TABLES:
+        raise ValueError(f"Unknown table {table}, expected one of {', '.join(EXPORT_TABLES)}")
+    columns = ', '.join(column for column, _ in EXPORT_TABLES[table])
+    user_filter = "" if user_id is None else "WHERE user_id = :user_id"
+    cur = db.cursor()
+    # Plain tuples: the rows are only written out
+    cur.row_factory = None
+    cur.execute(f"SELECT {columns} FROM {table} {user_filter} ORDER BY {EXPORT_TABLES[table][0][0]};", {"user_id": user_id})
+    while True:
+        rows = cur.fetchmany(batch_size)
+        if not rows:
+            return
+        yield rows
+
+
+def export_csv(db, table, path, user_id=None, batch_size=10000):
+    """Function to export a table to a CSV file with a header line. Returns the number of rows exported."""
+    exported = 0
+    with open(path, 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(column for column, _ in EXPORT_TABLES[table])
+        for rows in iter_batches(db, table, user_id, batch_size):
+            writer.writerows(rows)
+            exported += len(rows)
+    return exported
+
+
+def export_jsonl(db, table, path, user_id=None, batch_size=10000):
+    """Function to export a table to a JSON Lines file, one object per row. Returns the number of rows exported."""
+    columns = [column for column, _ in EXPORT_TABLES[table]]
+    exported = 0
+    with open(path, 'w') as file:
+        for rows in iter_batches(db, table, user_id, batch_size):
+            file.writelines(json.dumps(dict(zip(columns, row))) + '\n' for row in rows)
+            exported += len(rows)
+    return exported
+
+
+def export_columnar(db, table, path, user_id=None, batch_size=10000):
+    """Function to export a table in a columnar format. Each batch of rows becomes a row group whose values are stored column by column.
+    With pyarrow installed, path is written as a Parquet file. Otherwise path is a directory holding one JSON Lines file per column
+    (one row group per line) and a _schema.json file with the columns, their types and the number of rows and row groups.
+    Returns the number of rows exported."""
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        pyarrow = None
+
+    columns = EXPORT_TABLES[table]
+    exported = 0
+    row_groups = 0
+    if pyarrow is not None:
+        schema = pyarrow.schema([(column, getattr(pyarrow, kind)()) for column, kind in columns])
+        with pyarrow.parquet.ParquetWriter(path, schema) as writer:
+            for rows in iter_batches(db, table, user_id, batch_size):
+                writer.write_table(pyarrow.Table.from_arrays([pyarrow.array(values, type) for values, type in zip(zip(*rows), schema.types)], schema=schema))
+                exported += len(rows)
+        return exported
+
+    os.makedirs(path, exist_ok=True)
+    files = [open(os.path.join(path, f"{column}.jsonl"), 'w') for column, _ in columns]
+    try:
+        for rows in iter_batches(db, table, user_id, batch_size):
+            for file, values in zip(files, zip(*rows)):
+                file.write(json.dumps(values) + '\n')
+            exported += len(rows)
+            row_groups += 1
+    finally:
+        for file in files:
+            file.close()
+    with open(os.path.join(path, '_schema.json'), 'w') as file:
+        json.dump({'table': table, 'columns': [{'name': column, 'type': kind} for column, kind in columns],
+                   'rows': exported, 'row_groups': row_groups}, file)
+    return exported
+
+
+def export(db, table, path, format='csv', user_id=None, batch_size=10000):
+    """Function to export a table (habits, checkoffs or streaks) to path in the given format (csv, jsonl or columnar).
+    Returns the number of rows exported."""
+    exporters = {'csv': export_csv, 'jsonl': export_jsonl, 'columnar': export_columnar}
+    if format not in exporters:
+        raise ValueError(f"Unknown format {format}, expected one of {', '.join(FORMATS)}")
+    return exporters[format](db, table, path, user_id, batch_size)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Export the habits, checkoffs or streaks table.")
+    parser.add_argument('table', choices=tuple(EXPORT_TABLES))
+    parser.add_argument('path', help="output file (a directory for the columnar format without pyarrow)")
+    parser.add_argument('--format', choices=FORMATS, help="output format (default: from the file extension, csv otherwise)")
+    parser.add_argument('--db', default="main.db", help="database file (default: main.db)")
+    parser.add_argument('--user-id', type=int, help="export the rows of a single user")
+    parser.add_argument('--batch-size', type=int, default=10000, help="rows fetched at a time (default: 10000)")
+    args = parser.parse_args()
+
+    format = args.format or {'.jsonl': 'jsonl', '.parquet': 'columnar'}.get(os.path.splitext(args.path)[1], 'csv')
+    exported = export(get_read_db(args.db), args.table, args.path, format, args.user_id, args.batch_size)
+    print(f"{exported} rows of {args.table} exported to {args.path}")
@@ -1,6 +1,8 @@
 from error_handler import error_1, error_2
-from db import last_checkedoff_on, get_habit_details
+from db import (get_last_checkoff_day, period_bucket, get_habit_details, get_last_checkoffs, add_habit, add_checkoff, start_streak,
+                increment_current_streak, end_streak, transaction, DEFAULT_USER_ID)
 import datetime
+import numpy as np
 
 
 class Habit:
@@ -14,7 +16,12 @@ class Habit:
     Methods:
         - __init__: Constructor to initialize the habit object
         - prompt_for_task: Method to prompt the user for the task name
-        - prompt_for_periodicity: Method to prompt the user for the periodicity of the habit (daily, monthly, weekly)"""
+        - prompt_for_periodicity: Method to prompt the user for the periodicity of the habit (daily, monthly, weekly)
+        - create_habit: Method to save a new habit with its first streak and checkoff
+        - mark_as_completed: Method to check off a habit and update its streak"""
+
+    # Fixed attributes instead of a __dict__ per object
+    __slots__ = ('habit_id', 'task', 'periodicity', 'date', 'checkoffs', 'created_by', 'is_active')
 
     def __init__(self, habit_id=None, task=None, periodicity=None, date=None, checkoffs=0, created_by='user', is_active=True):
         self.habit_id = habit_id
@@ -27,77 +34,155 @@ class Habit:
 
     def prompt_for_task(self):
         """Method to prompt the user for the task name. Input is taken from the command line. If the input is empty, the user is prompted to try again."""
-        print("Enter the name of the habit and press enter: ")
-        task = input()
-        if len(task) == 0:
+        while True:
+            print("Enter the name of the habit and press enter: ")
+            task = input()
+            if len(task) > 0:
+                return task
             print(error_1.get_error_message())
-            return self.prompt_for_task()
-        return task
 
     def prompt_for_periodicity(self):
         """Method to prompt the user for the periodicity of the habit (1 for daily, 2 for monthly, 3 for weekly).
         Input is taken from the command line. If the input is invalid (different from 1, 2 or 3), the user is prompted to try again."""
-        print("Choose a periodicity for the habit:\n"
-              "Press 1 for daily\n"
-              "Press 2 for weekly\n"
-              "Press 3 for monthly\n"
-              "Then press enter: ")
-        periodicity = input()
-        if periodicity == '1':
-            return 'daily'
-        elif periodicity == '2':
-            return 'weekly'
-        elif periodicity == '3':
-            return 'monthly'
-        else:
+        while True:
+            print("Choose a periodicity for the habit:\n"
+                  "Press 1 for daily\n"
+                  "Press 2 for weekly\n"
+                  "Press 3 for monthly\n"
+                  "Then press enter: ")
+            periodicity = input()
+            if periodicity == '1':
+                return 'daily'
+            elif periodicity == '2':
+                return 'weekly'
+            elif periodicity == '3':
+                return 'monthly'
             print(error_2.get_error_message())
-            return self.prompt_for_periodicity()
 
 
-    def check_habit_continuity(self, db, habit_id, created_by, is_active):
+    def check_habit_continuity(self, db, habit_id, created_by, is_active, user_id=DEFAULT_USER_ID):
         """Function to check if a habit is broken based on its periodicity and the last completion date.
         Parameters:
             - habit_id: the unique identifier of the habit to be checked off.
-        The function retrieves the last completion date of the habit from the checkoffs table and compares it to the current date.
+            - user_id: the user owning the habit (DEFAULT_USER_ID by default).
+        The function retrieves the day and month numbers of the last completion of the habit from the checkoffs table and compares them to the current date.
         Returns True if the habit is not broken and False if the habit is broken.
-        The habit is considered broken if the difference between the last completion date and the current date is greater than the periodicity of the habit."""
-        last_completion_date_str = last_checkedoff_on(db, habit_id)
+        The habit is considered broken if a whole period (day, week starting on Monday or calendar month, see period_bucket) passed without completion,
+        the same rule as the streak summaries and check_continuity_bulk."""
+        last_checkoff = get_last_checkoff_day(db, habit_id, created_by, is_active, user_id)
         # Check if there is a last completion date
-        if not last_completion_date_str:
+        if last_checkoff is None:
             # If there is no last completion date, it's the first checkoff, so the habit is not broken
             return True
+        periodicity, last_completion_day, last_completion_month = last_checkoff
 
-        habit_details = get_habit_details(db, habit_id, created_by, is_active)
-        periodicity = habit_details[2]
-
-        # Convert the last completion date from string to a datetime object
-        last_completion_date = datetime.datetime.strptime(last_completion_date_str, '%Y-%m-%d').date()
-        # Get the current date
+        # Get the current date as day and month numbers, like the ones stored with the checkoff
         current_date = datetime.date.today()
-        # Calculate the difference in days
-        difference = (current_date - last_completion_date).days
-
-        # Check if the habit is broken based on its periodicity
-        if periodicity == 'daily' and difference >= 2:
-            return False  # Habit is broken
-        elif periodicity == 'weekly' and difference >= 8:
-            return False  # Habit is broken
-        elif periodicity == 'monthly':
-            # For monthly, check if the month has changed beyond one month
-            month_diff = (current_date.year - last_completion_date.year) * 12 + current_date.month - last_completion_date.month
-            if month_diff >= 2:
-                return False  # Habit is broken
-
-        return True  # Habit is not broken
-
-    def get_task_periodicity(self, db, habit_id, created_by, is_active):
+        # Calculate the number of periods between the last completion and the current date
+        if periodicity == 'monthly':
+            difference = period_bucket('monthly', current_date) - last_completion_month
+        elif periodicity == 'weekly':
+            # The week of a day number, as computed by period_bucket
+            difference = period_bucket('weekly', current_date) - (last_completion_day + 3) // 7
+        else:
+            difference = period_bucket('daily', current_date) - last_completion_day
+
+        # The habit is broken if the period before the current one was missed
+        return difference < 2
+
+    def create_habit(self, db, task, periodicity, user_id=DEFAULT_USER_ID):
+        """Function to save a new habit, start its streak and add its first checkoff in a single transaction.
+        Parameters:
+            - task: the name of the habit.
+            - periodicity: the periodicity of the habit (daily, weekly or monthly).
+            - user_id: the user owning the habit (DEFAULT_USER_ID by default).
+        Returns the habit_id of the new habit."""
+        with transaction(db):
+            habit_id = add_habit(db, task, periodicity, user_id=user_id)
+            start_streak(db, habit_id, user_id=user_id)
+            add_checkoff(db, habit_id, user_id=user_id)
+        return habit_id
+
+    def mark_as_completed(self, db, habit_id, created_by, is_active, user_id=DEFAULT_USER_ID):
+        """Function to check off a habit. The checkoff and the streak update are committed together:
+        the current streak is incremented if the habit is not broken, otherwise it is ended and a new one is started.
+        Checking off a habit already checked off on the same day changes nothing.
+        Parameters:
+            - habit_id: the unique identifier of the habit to be checked off.
+            - created_by ('user' or 'predefined')
+            - is_active (1 if created by user, 0 if predefined).
+            - user_id: the user owning the habit (DEFAULT_USER_ID by default).
+        Returns True if the streak is still active and False if a new streak was started."""
+        # The write lock is taken before the continuity check: a transaction that reads first cannot wait for it afterwards
+        with transaction(db, immediate=True):
+            habit_continuity = self.check_habit_continuity(db, habit_id, created_by, is_active, user_id)
+            # A habit already checked off today keeps its streak as it is
+            if not add_checkoff(db, habit_id, user_id=user_id):
+                return habit_continuity
+            if habit_continuity:
+                increment_current_streak(db, habit_id, user_id)
+            else:
+                end_streak(db, habit_id, user_id)
+                start_streak(db, habit_id, user_id=user_id)
+        return habit_continuity
+
+    def get_task_periodicity(self, db, habit_id, created_by, is_active, user_id=DEFAULT_USER_ID):
         """Function to retrieve the task name and periodicity of a habit.
         Parameters:
             - habit_id: the unique identifier of the habit to be checked off.
             - created_by ('user' or 'predefined')
             - is_active (1 if created by user, 0 if predefined).
+            - user_id: the user owning the habit (DEFAULT_USER_ID by default).
         Returns the task name and periodicity of the habit."""
-        habit_details = get_habit_details(db, habit_id, created_by, is_active)
-        task_name = habit_details[1]
-        periodicity = habit_details[2]
-        return task_name, periodicity
\ No newline at end of file
+        habit_details = get_habit_details(db, habit_id, created_by, is_active, user_id)
+        return habit_details.task, habit_details.periodicity
+
+
+def check_continuity_bulk(db, as_of=None, created_by='user', is_active=1, user_id=None, invalid_dates=None):
+    """Function to check the continuity of all habits at once, with the same rules as Habit.check_habit_continuity.
+    The last completion date of every habit is fetched with a single query, then the daily, weekly and monthly rules are evaluated
+    on NumPy date arrays instead of one query and one date conversion per habit.
+    Parameters:
+        - as_of: the date the habits are checked on (datetime.date or YYYY-MM-DD), the current date by default.
+        - created_by ('user' or 'predefined')
+        - is_active (1 if created by user, 0 if predefined).
+        - user_id: the user owning the habits, None (default) for the habits of all users.
+        - invalid_dates: a list receiving the (habit_id, last completion date) of the habits whose last completion date cannot be read,
+          which are then left out. None (default) to raise ValueError instead.
+    Returns the set of habit_id of the broken habits. Habits never checked off are not broken."""
+    last_checkoffs = get_last_checkoffs(db, created_by, is_active, user_id)
+    if not last_checkoffs:
+        return set()
+    habit_ids, periodicities, last_completion_dates = zip(*last_checkoffs)
+    try:
+        last_completion_dates = np.array(last_completion_dates, dtype='datetime64[D]')
+    except ValueError:
+        if invalid_dates is None:
+            raise
+        # Dates written by older versions may not be dates: they are found one at a time, only when the whole array cannot be read
+        readable = []
+        for last_checkoff in last_checkoffs:
+            try:
+                np.datetime64(last_checkoff[2], 'D')
+            except ValueError:
+                invalid_dates.append((last_checkoff[0], last_checkoff[2]))
+            else:
+                readable.append(last_checkoff)
+        if not readable:
+            return set()
+        habit_ids, periodicities, last_completion_dates = zip(*readable)
+        last_completion_dates = np.array(last_completion_dates, dtype='datetime64[D]')
+    habit_ids = np.array(habit_ids, dtype=np.int64)
+    periodicities = np.array(periodicities)
+    current_date = np.datetime64(as_of if as_of is not None else datetime.date.today(), 'D')
+
+    # Number of periods (see period_bucket) between the last completion date and the current date: days since 1970-01-01,
+    # weeks starting on Monday (1970-01-01 is a Thursday) and calendar months
+    last_days, current_day = last_completion_dates.astype(np.int64), current_date.astype(np.int64)
+    month_diff = (current_date.astype('datetime64[M]') - last_completion_dates.astype('datetime64[M]')).astype(np.int64)
+    difference = np.where(periodicities == 'daily', current_day - last_days,
+                          np.where(periodicities == 'weekly', (current_day + 3) // 7 - (last_days + 3) // 7, month_diff))
+
+    # A habit is broken if the period before the current one was missed
+    broken = difference >= 2
+    return set(habit_ids[broken].tolist())
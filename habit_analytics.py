@@ -0,0 +1,258 @@
+# Contains the analytics of the habits computed with NumPy: completion rate, rolling adherence, weekday heatmap and streak histogram,
+# and HabitStore, the habits themselves as columns of arrays.
+# The checkoffs of all the habits are loaded once as compact arrays of days, then every metric is computed for all the habits at once
+# with array operations instead of a Python loop per habit.
+import datetime
+import numpy as np
+from db import DEFAULT_USER_ID, PERIODICITIES, period_bucket, epoch_day_sql
+
+# Number of days of one period, to know how many checkoffs a window of days expects
+PERIOD_DAYS = {'daily': 1, 'weekly': 7, 'monthly': 30.4375}
+
+
+def _epoch_day(day):
+    """Return the number of days since 1970-01-01 of a datetime.date, an ISO formatted date or None (the current date), like the checkedoff_day column."""
+    return period_bucket('daily', datetime.date.today() if day is None else day)
+
+
+def period_buckets(days, periodicity_codes):
+    """Return the period number of each day (days since 1970-01-01) for the periodicity of its habit (index in PERIODICITIES):
+    the day itself for daily habits, the week starting on Monday for weekly habits and the calendar month for monthly habits.
+    Consecutive periods have consecutive numbers."""
+    days = np.asarray(days, dtype=np.int64)
+    months = days.astype('datetime64[D]').astype('datetime64[M]').astype(np.int64)
+    # 1970-01-01 is a Thursday: shifting by 3 days makes the weeks start on Monday
+    return np.select([periodicity_codes == 0, periodicity_codes == 1], [days, (days + 3) // 7], months)
+
+
+class CheckoffArrays:
+    """Class to represent the checkoffs of many habits as NumPy arrays. The days of the checkoffs of all the habits are stored in a single array,
+    habit after habit and sorted within each habit; the checkoffs of the habit at index i are days[offsets[i]:offsets[i + 1]].
+    Attributes:
+        - habit_ids: The habit_id of each habit (int64)
+        - periodicities: The periodicity of each habit as an index in PERIODICITIES (int8)
+        - created_on: The creation day of each habit, in days since 1970-01-01 (int32)
+        - offsets: The position of the first checkoff of each habit in days, plus the total number of checkoffs (int64)
+        - days: The day of each checkoff, in days since 1970-01-01 (int32)
+    Methods:
+        - load: Method to load the checkoffs of the habits from the database
+        - habit_index: Method to retrieve the index of the habit of each checkoff"""
+
+    def __init__(self, habit_ids, periodicities, created_on, offsets, days):
+        self.habit_ids = habit_ids
+        self.periodicities = periodicities
+        self.created_on = created_on
+        self.offsets = offsets
+        self.days = days
+
+    @classmethod
+    def load(cls, db, created_by='user', is_active=1, user_id=DEFAULT_USER_ID):
+        """Method to load the habits and their checkoffs with a single query returning one row per habit.
+        SQLite joins the day numbers (checkedoff_day) of the checkoffs of each habit in a string, which NumPy parses at once:
+        the checkoffs are never turned into Python objects one by one.
+        Parameters:
+            - created_by ('user' or 'predefined')
+            - is_active (1 if created by user, 0 if predefined).
+            - user_id: the user owning the habits (DEFAULT_USER_ID by default), None for the habits of all users.
+            - Requires a database connection."""
+        user_filter = "" if user_id is None else "AND h.user_id = :user_id"
+        cur = db.cursor()
+        cur.row_factory = None
+        cur.execute(f"""
+            SELECT h.habit_id,
+                CASE h.periodicity WHEN 'daily' THEN 0 WHEN 'weekly' THEN 1 ELSE 2 END,
+                {epoch_day_sql("COALESCE(h.created_on, date('now'))")},
+                -- Counts the same values as group_concat: a day that is NULL (a date SQLite cannot read) must not shift the slices of the next habits
+                COUNT(c.checkedoff_day),
+                group_concat(c.checkedoff_day, ',')
+            FROM habits h
+            -- Joined on habit_id alone, the day numbers are read from idx_checkoffs_habit_day without visiting the checkoffs rows
+            LEFT JOIN checkoffs c ON c.habit_id = h.habit_id
+            WHERE h.created_by = :created_by AND h.is_active = :is_active {user_filter}
+            GROUP BY h.habit_id
+            ORDER BY h.habit_id;
+            """, {"created_by": created_by, "is_active": is_active, "user_id": user_id})
+        rows = cur.fetchall()
+        habits = np.array([row[:4] for row in rows], dtype=np.int64).reshape(len(rows), 4)
+        joined_days = ','.join(row[4] for row in rows if row[4] is not None)
+        days = np.fromstring(joined_days, dtype=np.int32, sep=',') if joined_days else np.zeros(0, dtype=np.int32)
+        offsets = np.concatenate(([0], np.cumsum(habits[:, 3]))).astype(np.int64)
+        checkoffs = cls(habits[:, 0], habits[:, 1].astype(np.int8), habits[:, 2].astype(np.int32), offsets, days)
+
+        # group_concat follows the index order (by date) but does not promise it: the days are sorted again if needed
+        habit_index = checkoffs.habit_index()
+        if np.any((np.diff(days) < 0) & (habit_index[1:] == habit_index[:-1])):
+            checkoffs.days = days[np.lexsort((days, habit_index))]
+        return checkoffs
+
+    def __len__(self):
+        return len(self.habit_ids)
+
+    def habit_index(self):
+        """Method to retrieve the index (in habit_ids) of the habit of each checkoff."""
+        return np.repeat(np.arange(len(self.habit_ids)), np.diff(self.offsets))
+
+
+class HabitStore:
+    """Class to represent many habits as columns of NumPy arrays instead of one row object per habit, e.g. to analyse a million habits.
+    A habit takes 29 bytes plus its task, stored UTF-8 encoded one after the other in a single buffer, instead of a tuple with a Python object per column.
+    The habits are sorted by habit_id.
+    Attributes:
+        - habit_ids: The habit_id of each habit (int64)
+        - user_ids: The user owning each habit (int64)
+        - periodicities: The periodicity of each habit as an index in PERIODICITIES (int8)
+        - created_on: The creation day of each habit, in days since 1970-01-01 (int32)
+        - task_offsets: The position of the task of each habit in tasks, plus the total length of the tasks (int64)
+        - tasks: The tasks of all the habits, UTF-8 encoded (bytes)
+    Methods:
+        - load: Method to load the habits from the database
+        - task: Method to retrieve the task of a habit
+        - index_of: Method to find the index of habits from their habit_id
+        - count_by_periodicity: Method to count the habits of each periodicity
+        - nbytes: Method to retrieve the memory used by the arrays"""
+
+    def __init__(self, habit_ids, user_ids, periodicities, created_on, task_offsets, tasks):
+        self.habit_ids = habit_ids
+        self.user_ids = user_ids
+        self.periodicities = periodicities
+        self.created_on = created_on
+        self.task_offsets = task_offsets
+        self.tasks = tasks
+
+    @classmethod
+    def load(cls, db, created_by='user', is_active=1, user_id=DEFAULT_USER_ID, batch_size=50000):
+        """Method to load the habits from the database, batch_size rows at a time: the rows of a batch are turned into arrays before the
+        next batch is read, so the memory used is the one of the arrays plus one batch of rows.
+        Parameters:
+            - created_by ('user' or 'predefined')
+            - is_active (1 if created by user, 0 if predefined).
+            - user_id: the user owning the habits (DEFAULT_USER_ID by default), None for the habits of all users.
+            - batch_size: the number of rows read at a time.
+            - Requires a database connection."""
+        user_filter = "" if user_id is None else "AND user_id = :user_id"
+        cur = db.cursor()
+        cur.row_factory = None
+        cur.execute(f"""
+            SELECT habit_id, user_id,
+                CASE periodicity WHEN 'daily' THEN 0 WHEN 'weekly' THEN 1 ELSE 2 END,
+                {epoch_day_sql("COALESCE(created_on, date('now'))")},
+                task
+            FROM habits
+            WHERE created_by = :created_by AND is_active = :is_active {user_filter}
+            ORDER BY habit_id;
+            """, {"created_by": created_by, "is_active": is_active, "user_id": user_id})
+        numbers, task_lengths, tasks = [], [], []
+        while True:
+            rows = cur.fetchmany(batch_size)
+            if not rows:
+                break
+            encoded = [row[4].encode() for row in rows]
+            numbers.append(np.array([row[:4] for row in rows], dtype=np.int64))
+            task_lengths.append(np.fromiter(map(len, encoded), dtype=np.int64, count=len(encoded)))
+            tasks.append(b''.join(encoded))
+        numbers = np.concatenate(numbers) if numbers else np.zeros((0, 4), dtype=np.int64)
+        task_offsets = np.concatenate(([0], np.cumsum(np.concatenate(task_lengths)) if task_lengths else [])).astype(np.int64)
+        return cls(numbers[:, 0].copy(), numbers[:, 1].copy(), numbers[:, 2].astype(np.int8), numbers[:, 3].astype(np.int32), task_offsets, b''.join(tasks))
+
+    def __len__(self):
+        return len(self.habit_ids)
+
+    def task(self, index):
+        """Method to retrieve the task of the habit at index."""
+        return self.tasks[self.task_offsets[index]:self.task_offsets[index + 1]].decode()
+
+    def index_of(self, habit_ids):
+        """Method to find the index of habits from their habit_id. Returns an array of indexes, -1 for the habits not in the store."""
+        habit_ids = np.asarray(habit_ids, dtype=np.int64)
+        if not len(self):
+            return np.full(len(habit_ids), -1, dtype=np.int64)
+        indexes = np.minimum(np.searchsorted(self.habit_ids, habit_ids), len(self) - 1)
+        return np.where(self.habit_ids[indexes] == habit_ids, indexes, -1)
+
+    def count_by_periodicity(self):
+        """Method to count the habits of each periodicity. Returns a dictionary with the number of daily, weekly and monthly habits."""
+        counts = np.bincount(self.periodicities, minlength=len(PERIODICITIES))
+        return {periodicity: int(counts[code]) for code, periodicity in enumerate(PERIODICITIES)}
+
+    def nbytes(self):
+        """Method to retrieve the number of bytes used by the arrays and the tasks."""
+        return sum(array.nbytes for array in (self.habit_ids, self.user_ids, self.periodicities, self.created_on, self.task_offsets)) + len(self.tasks)
+
+
+def _period_runs(checkoffs):
+    """Return the index of the habit and the period number of each distinct (habit, period) with a checkoff, in order."""
+    habit_index = checkoffs.habit_index()
+    buckets = period_buckets(checkoffs.days, checkoffs.periodicities[habit_index])
+    # Checkoffs are sorted by habit then day, so a new period is a change of habit or of period number
+    distinct = np.ones(len(buckets), dtype=bool)
+    distinct[1:] = (habit_index[1:] != habit_index[:-1]) | (buckets[1:] != buckets[:-1])
+    return habit_index[distinct], buckets[distinct]
+
+
+def completion_rate(checkoffs, as_of=None):
+    """Function to compute the completion rate of every habit: the share of its periods (days, weeks or months) with at least one checkoff,
+    from the period it was created in (or its first checkoff, if earlier) to the period of as_of included.
+    Parameters:
+        - checkoffs: the CheckoffArrays of the habits.
+        - as_of: the date the rates are computed on (datetime.date or YYYY-MM-DD), the current date by default.
+    Returns an array of rates between 0 and 1, in the order of checkoffs.habit_ids."""
+    habit_index, buckets = _period_runs(checkoffs)
+    completed = np.bincount(habit_index, minlength=len(checkoffs))
+    first = period_buckets(checkoffs.created_on, checkoffs.periodicities)
+    has_checkoffs = np.diff(checkoffs.offsets) > 0
+    first_checkoff = period_buckets(checkoffs.days[checkoffs.offsets[:-1][has_checkoffs]], checkoffs.periodicities[has_checkoffs])
+    first[has_checkoffs] = np.minimum(first[has_checkoffs], first_checkoff)
+    current = period_buckets(np.full(len(checkoffs), _epoch_day(as_of)), checkoffs.periodicities)
+    elapsed = np.maximum(current - first + 1, 1)
+    return np.minimum(completed / elapsed, 1.0)
+
+
+def rolling_adherence(checkoffs, window=7, days=30, as_of=None):
+    """Function to compute the rolling adherence of every habit on each of the last days: the number of checkoffs in the window of days ending
+    that day divided by the number of checkoffs expected in the window (window days for a daily habit, window / 7 for a weekly one,
+    window / 30.4375 for a monthly one), capped at 1. Use window=7 and window=30 for the weekly and monthly adherence.
+    Parameters:
+        - checkoffs: the CheckoffArrays of the habits.
+        - window: the number of days of the rolling window.
+        - days: the number of days of the series.
+        - as_of: the last day of the series (datetime.date or YYYY-MM-DD), the current date by default.
+    Returns an array of shape (number of habits, days), the last column being as_of."""
+    last_day = _epoch_day(as_of)
+    origin = last_day - days - window + 1
+    habit_index = checkoffs.habit_index()
+    in_range = (checkoffs.days >= origin) & (checkoffs.days <= last_day)
+    # Checkoffs per habit and day, then the sum over the window as a difference of cumulative sums
+    width = days + window
+    daily = np.bincount(habit_index[in_range] * width + (checkoffs.days[in_range] - origin), minlength=len(checkoffs) * width)
+    cumulative = np.cumsum(daily.reshape(len(checkoffs), width), axis=1, dtype=np.int32)
+    in_window = cumulative[:, window:] - cumulative[:, :-window]
+    expected = window / np.array([PERIOD_DAYS[periodicity] for periodicity in PERIODICITIES])[checkoffs.periodicities]
+    return np.minimum(in_window / expected[:, None], 1.0)
+
+
+def weekday_heatmap(checkoffs):
+    """Function to count the checkoffs of every habit by day of the week.
+    Returns an array of shape (number of habits, 7), the columns going from Monday to Sunday. Sum it over the habits for the overall heatmap."""
+    # 1970-01-01 is a Thursday (index 3 when Monday is 0)
+    weekdays = (checkoffs.days.astype(np.int64) + 3) % 7
+    return np.bincount(checkoffs.habit_index() * 7 + weekdays, minlength=len(checkoffs) * 7).reshape(len(checkoffs), 7)
+
+
+def streak_lengths(checkoffs):
+    """Function to compute the length of all the streaks (runs of consecutive periods with a checkoff) of all the habits.
+    Returns the index of the habit of each streak and the length of each streak (in periods), habit after habit in chronological order."""
+    habit_index, buckets = _period_runs(checkoffs)
+    if len(buckets) == 0:
+        return habit_index, buckets
+    starts = np.ones(len(buckets), dtype=bool)
+    starts[1:] = (habit_index[1:] != habit_index[:-1]) | (buckets[1:] != buckets[:-1] + 1)
+    start_positions = np.flatnonzero(starts)
+    return habit_index[start_positions], np.diff(np.append(start_positions, len(buckets)))
+
+
+def streak_histogram(checkoffs):
+    """Function to compute the distribution of the streak lengths for each periodicity.
+    Returns a dictionary with an array per periodicity (daily, weekly, monthly) whose item n is the number of streaks of n periods."""
+    habit_index, lengths = streak_lengths(checkoffs)
+    periodicities = checkoffs.periodicities[habit_index]
+    return {periodicity: np.bincount(lengths[periodicities == code], minlength=1) for code, periodicity in enumerate(PERIODICITIES)}
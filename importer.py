@@ -0,0 +1,117 @@
+# Contains the bulk importer of historical checkoffs, e.g. when a user moves from another tracker with years of history.
+# The checkoffs are sorted and deduplicated in a staging table, merged into the checkoffs table with a single statement,
+# then the streaks of the habits that received checkoffs are rebuilt once.
+# Run it with: python importer.py history.csv (columns habit_id,checkedoff_on)
+import argparse
+import csv
+import itertools
+import time
+from db import get_db, rebuild_streaks, transaction, checkoff_periods_sql, CHECKOFF_PERIOD_COLUMNS
+
+
+def read_csv(path):
+    """Generator of the (habit_id, checkedoff_on) tuples of a CSV file with a habit_id and a checkedoff_on column."""
+    with open(path, newline='') as file:
+        for row in csv.DictReader(file):
+            yield row['habit_id'], row['checkedoff_on']
+
+
+def _valid_checkoffs(chunk):
+    """Return the (habit_id, checkedoff_on) tuples of a chunk whose habit_id is an integer SQLite can store, with the dates as strings.
+    The dates are validated by the merge (see import_checkoffs)."""
+    valid = []
+    for habit_id, day in chunk:
+        try:
+            habit_id = int(habit_id)
+        except (TypeError, ValueError):
+            continue
+        if -2 ** 63 <= habit_id < 2 ** 63:
+            valid.append((habit_id, str(day)))
+    return valid
+
+
+def import_checkoffs(db, checkoffs, user_id=None, chunk_size=50000, rebuild=True):
+    """Function to import many historical checkoffs at once, in a single transaction.
+    The checkoffs are loaded with executemany into a staging table keyed by (habit_id, checkedoff_on), which sorts them and drops the duplicates,
+    then merged into the checkoffs table where the unique index skips the checkoffs already recorded.
+    Checkoffs of unknown habits (or of habits not belonging to the user) are skipped, and so are invalid rows (a habit_id that is not an integer
+    or an invalid date): they are counted as skipped instead of aborting the import.
+    Parameters:
+        - checkoffs: an iterable of (habit_id, checkedoff_on) tuples, in any order.
+        - user_id: the user owning the habits, None (default) to accept the habits of any user.
+        - chunk_size: the number of checkoffs loaded per executemany call.
+        - rebuild: True (default) to rebuild the streaks of the habits that received checkoffs.
+        - Requires a database connection.
+    Returns the number of checkoffs read, of invalid rows skipped, of unique valid checkoffs, of checkoffs imported, the number of habits rebuilt
+    and the duration in seconds. An invalid date repeated for the same habit is skipped once."""
+    start = time.perf_counter()
+    cur = db.cursor()
+    read = 0
+    skipped = 0
+    with transaction(db, immediate=True):
+        cur.execute("DROP TABLE IF EXISTS temp.staged_checkoffs;")
+        cur.execute("""
+            CREATE TEMP TABLE staged_checkoffs (
+                habit_id INTEGER NOT NULL,
+                checkedoff_on TEXT NOT NULL,
+                PRIMARY KEY (habit_id, checkedoff_on)
+            ) WITHOUT ROWID;
+            """)
+        iterator = iter(checkoffs)
+        while True:
+            chunk = list(itertools.islice(iterator, chunk_size))
+            if not chunk:
+                break
+            read += len(chunk)
+            valid = _valid_checkoffs(chunk)
+            skipped += len(chunk) - len(valid)
+            # Each chunk is sorted and deduplicated before the load, so the staging b-tree is filled in key order
+            cur.executemany("INSERT OR IGNORE INTO temp.staged_checkoffs VALUES (?, ?);", sorted(set(valid)))
+        # A modifier makes date() normalize out of range days (2024-02-30), so only valid YYYY-MM-DD dates compare equal
+        cur.execute("DELETE FROM temp.staged_checkoffs WHERE date(checkedoff_on, '+0 days') IS NOT checkedoff_on;")
+        skipped += cur.rowcount
+        cur.execute("SELECT COUNT(*) FROM temp.staged_checkoffs;")
+        unique = cur.fetchone()[0]
+
+        # Checkoff ids only grow, the imported checkoffs are the ones after the last id used before the merge
+        cur.execute("SELECT COALESCE(MAX(checkoff_id), 0) FROM checkoffs;")
+        last_checkoff_id = cur.fetchone()[0]
+        user_filter = "" if user_id is None else "AND h.user_id = :user_id"
+        cur.execute(f"""
+            INSERT OR IGNORE INTO checkoffs (user_id, habit_id, checkedoff_on, {CHECKOFF_PERIOD_COLUMNS})
+            SELECT h.user_id, s.habit_id, s.checkedoff_on, {checkoff_periods_sql("s.checkedoff_on")}
+            FROM temp.staged_checkoffs s
+            JOIN habits h ON h.habit_id = s.habit_id {user_filter}
+            ORDER BY s.habit_id, s.checkedoff_on;
+            """, {"user_id": user_id})
+        imported = cur.rowcount
+        cur.execute("DROP TABLE temp.staged_checkoffs;")
+
+        cur.execute("SELECT DISTINCT habit_id FROM checkoffs WHERE checkoff_id > ? ORDER BY habit_id;", (last_checkoff_id,))
+        habit_ids = [habit_id for (habit_id,) in cur.fetchall()]
+        if rebuild and habit_ids:
+            rebuild_streaks(db, habit_ids)
+    return {
+        'read': read,
+        'skipped': skipped,
+        'unique': unique,
+        'imported': imported,
+        'habits_rebuilt': len(habit_ids) if rebuild else 0,
+        'duration': time.perf_counter() - start,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Import historical checkoffs from a CSV file with the columns habit_id,checkedoff_on.")
+    parser.add_argument('file')
+    parser.add_argument('--db', default="main.db", help="database file (default: main.db)")
+    parser.add_argument('--user-id', type=int, help="only import the checkoffs of the habits of this user")
+    args = parser.parse_args()
+
+    db = get_db(args.db)
+    try:
+        metrics = import_checkoffs(db, read_csv(args.file), args.user_id)
+    finally:
+        db.close()
+    print(f"{metrics['imported']} checkoffs imported out of {metrics['read']} read ({metrics['unique']} unique, {metrics['skipped']} invalid skipped), "
+          f"streaks of {metrics['habits_rebuilt']} habit(s) rebuilt in {metrics['duration']:.2f} s")
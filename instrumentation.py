@@ -0,0 +1,258 @@
+# Contains the instrumentation of the db module: every query function of db.py is wrapped to count its calls, errors and returned rows and to
+# record its latency in a histogram, and every connection traces its SQL statements and commits (sqlite3 set_trace_callback).
+# Calls slower than a threshold are written to a slow-query log with the query plan of their statements, and the metrics can be written
+# in the Prometheus text format, e.g. to the directory read by the node_exporter textfile collector.
+import bisect
+import collections
+import datetime
+import functools
+import inspect
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+import db as db_module
+
+# Upper bounds (in seconds) of the latency histogram buckets, the last bucket (+Inf) is implicit
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+# Statements kept per call for the slow-query log: a bulk insert traces one statement per row
+MAX_LOGGED_STATEMENTS = 20
+# Statements whose query plan is logged
+_EXPLAINED_STATEMENTS = ("SELECT", "WITH", "INSERT", "UPDATE", "DELETE", "REPLACE")
+
+
+class QueryMetrics:
+    """Class to represent the metrics collected on the functions of the db module.
+    Attributes:
+        - slow_ms: The duration (in milliseconds) above which a call is a slow query
+        - slow_log: The file the slow queries are appended to (one JSON object per line), None to only keep them in memory
+        - calls, errors, rows, statements: Counters by function name (rows returned, SQL statements executed)
+        - buckets: The latency histogram of each function: the number of calls per bucket of LATENCY_BUCKETS, plus one for slower calls
+        - durations: The total duration (in seconds) of the calls of each function
+        - commits: The number of transactions committed
+        - slow_queries: The last 100 slow queries
+    Methods:
+        - record_call: Method to record a call of a function
+        - record_statement: Method to record an SQL statement traced by a connection
+        - prometheus: Method to format the metrics in the Prometheus text format
+        - write_prometheus: Method to write the metrics to a file in the Prometheus text format"""
+
+    def __init__(self, slow_ms=100, slow_log=None):
+        self.slow_ms = slow_ms
+        self.slow_log = slow_log
+        self.calls = collections.Counter()
+        self.errors = collections.Counter()
+        self.rows = collections.Counter()
+        self.statements = collections.Counter()
+        self.buckets = collections.defaultdict(lambda: [0] * (len(LATENCY_BUCKETS) + 1))
+        self.durations = collections.Counter()
+        self.commits = 0
+        self.slow_queries = collections.deque(maxlen=100)
+        self._lock = threading.Lock()
+        # Stack of the instrumented calls running in each thread, the traced statements are counted for the innermost one
+        self._local = threading.local()
+
+    def _stack(self):
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def record_call(self, function, duration, rows, failed=False):
+        """Method to record a call of function (its name) that took duration seconds and returned rows rows."""
+        with self._lock:
+            self.calls[function] += 1
+            self.durations[function] += duration
+            self.rows[function] += rows
+            self.buckets[function][bisect.bisect_left(LATENCY_BUCKETS, duration)] += 1
+            if failed:
+                self.errors[function] += 1
+
+    def record_statement(self, sql):
+        """Method to record an SQL statement traced by a connection: it is counted for the innermost function running it, and commits are counted."""
+        if getattr(self._local, "explaining", False):
+            return
+        stack = self._stack()
+        function = stack[-1][0] if stack else None
+        with self._lock:
+            if function is not None:
+                self.statements[function] += 1
+            if sql.startswith("COMMIT"):
+                self.commits += 1
+        # Every running call keeps the statement for its slow-query log entry, nested calls included
+        for _, statements in stack:
+            if len(statements) < MAX_LOGGED_STATEMENTS:
+                statements.append(sql)
+
+    def _log_slow_query(self, db, function, duration, args, kwargs, statements):
+        """Write a slow call with the query plan of its statements to the slow-query log."""
+        entry = {
+            "time": datetime.datetime.now().isoformat(timespec="seconds"),
+            "function": function,
+            "duration_ms": round(duration * 1000, 3),
+            "arguments": repr(args[1:] + tuple(kwargs.items()))[:200],
+            "statements": [],
+        }
+        self._local.explaining = True
+        try:
+            for sql in statements:
+                statement = {"sql": sql}
+                if isinstance(db, sqlite3.Connection) and sql.lstrip().upper().startswith(_EXPLAINED_STATEMENTS):
+                    try:
+                        statement["plan"] = [row[3] for row in db.execute("EXPLAIN QUERY PLAN " + sql).fetchall()]
+                    except sqlite3.Error as error:
+                        # e.g. a statement on a temporary table dropped since
+                        statement["plan_error"] = str(error)
+                entry["statements"].append(statement)
+        finally:
+            self._local.explaining = False
+        with self._lock:
+            self.slow_queries.append(entry)
+            if self.slow_log is not None:
+                with open(self.slow_log, "a") as file:
+                    file.write(json.dumps(entry) + "\n")
+
+    def prometheus(self):
+        """Method to format the metrics in the Prometheus text format (version 0.0.4)."""
+        with self._lock:
+            lines = []
+
+            def counter(name, description, values):
+                lines.append(f"# HELP {name} {description}")
+                lines.append(f"# TYPE {name} counter")
+                lines.extend(f'{name}{{function="{function}"}} {value}' for function, value in sorted(values.items()))
+
+            counter("habits_db_calls_total", "Number of calls of each function of the db module.", self.calls)
+            counter("habits_db_errors_total", "Number of calls of each function of the db module that raised an exception.", self.errors)
+            counter("habits_db_rows_total", "Number of rows returned by each function of the db module.", self.rows)
+            counter("habits_db_statements_total", "Number of SQL statements executed by each function of the db module.", self.statements)
+            lines.append("# HELP habits_db_commits_total Number of transactions committed.")
+            lines.append("# TYPE habits_db_commits_total counter")
+            lines.append(f"habits_db_commits_total {self.commits}")
+            lines.append("# HELP habits_db_call_duration_seconds Latency of the calls of each function of the db module.")
+            lines.append("# TYPE habits_db_call_duration_seconds histogram")
+            for function, buckets in sorted(self.buckets.items()):
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS + ("+Inf",), buckets):
+                    cumulative += count
+                    lines.append(f'habits_db_call_duration_seconds_bucket{{function="{function}",le="{bound}"}} {cumulative}')
+                lines.append(f'habits_db_call_duration_seconds_sum{{function="{function}"}} {self.durations[function]:.6f}')
+                lines.append(f'habits_db_call_duration_seconds_count{{function="{function}"}} {self.calls[function]}')
+            return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path):
+        """Method to write the metrics to path in the Prometheus text format. The file is replaced at once, so a collector never reads half a file."""
+        temporary = f"{path}.{os.getpid()}.tmp"
+        with open(temporary, "w") as file:
+            file.write(self.prometheus())
+        os.replace(temporary, path)
+
+
+# Metrics of the current instrumentation and the (module, name, original function) replaced by instrument
+_metrics = None
+_patches = []
+
+
+def _rows(result):
+    """Return the number of rows of the result of a db function: the length of a list, 1 for a single row."""
+    if isinstance(result, list):
+        return len(result)
+    if isinstance(result, tuple):
+        return 1
+    return 0
+
+
+def _wrap(function, metrics):
+    """Return function wrapped to record its calls in metrics."""
+    name = function.__name__
+
+    @functools.wraps(function)
+    def instrumented(*args, **kwargs):
+        frame = (name, [])
+        stack = metrics._stack()
+        stack.append(frame)
+        start = time.perf_counter()
+        failed = True
+        result = None
+        try:
+            result = function(*args, **kwargs)
+            failed = False
+            return result
+        finally:
+            duration = time.perf_counter() - start
+            stack.pop()
+            metrics.record_call(name, duration, _rows(result), failed)
+            if duration * 1000 >= metrics.slow_ms:
+                metrics._log_slow_query(args[0] if args else None, name, duration, args, kwargs, frame[1])
+    return instrumented
+
+
+def attach(db, metrics=None):
+    """Function to trace the SQL statements and commits of a connection opened before instrument was called (connections opened
+    afterwards through the db module are traced automatically).
+    Parameters:
+        - metrics: the QueryMetrics to record to, the ones of the current instrumentation by default.
+        - Requires a database connection."""
+    metrics = metrics or _metrics
+    db.set_trace_callback(metrics.record_statement)
+
+
+def _instrumented_functions():
+    """Return the functions of the db module to instrument: the public functions taking a connection as first parameter.
+    Generators (iter_habit_pages) and context managers (transaction) are left alone, the queries they run go through instrumented functions."""
+    functions = {}
+    for name, function in vars(db_module).items():
+        if name.startswith("_") or not inspect.isfunction(function) or function.__module__ != db_module.__name__:
+            continue
+        if inspect.isgeneratorfunction(function) or hasattr(function, "__wrapped__"):
+            continue
+        parameters = list(inspect.signature(function).parameters)
+        if parameters and parameters[0] == "db":
+            functions[name] = function
+    return functions
+
+
+def instrument(slow_ms=100, slow_log=None):
+    """Function to instrument the db module. Each query function is replaced by a wrapper recording its calls, in the db module and in every
+    module that imported it (from db import ...), and the connections opened afterwards trace their statements and commits.
+    Parameters:
+        - slow_ms: the duration in milliseconds above which a call is written to the slow-query log.
+        - slow_log: the file the slow queries are appended to, None to only keep them in memory.
+    Returns the QueryMetrics collecting the metrics. Call uninstrument to restore the original functions."""
+    global _metrics
+    if _metrics is not None:
+        uninstrument()
+    metrics = QueryMetrics(slow_ms, slow_log)
+    replacements = {id(function): _wrap(function, metrics) for function in _instrumented_functions().values()}
+
+    original_connect = db_module.connect
+
+    @functools.wraps(original_connect)
+    def connect(*args, **kwargs):
+        connection = original_connect(*args, **kwargs)
+        attach(connection, metrics)
+        return connection
+    replacements[id(original_connect)] = connect
+
+    originals = {id(function): function for function in list(_instrumented_functions().values()) + [original_connect]}
+    for module in list(sys.modules.values()):
+        if module is None or module is sys.modules[__name__]:
+            continue
+        for name, value in list(vars(module).items()):
+            if id(value) in replacements and originals.get(id(value)) is value:
+                setattr(module, name, replacements[id(value)])
+                _patches.append((module, name, value))
+    _metrics = metrics
+    return metrics
+
+
+def uninstrument():
+    """Function to restore the original functions of the db module and of the modules that imported them.
+    Connections keep tracing to the previous metrics until they are closed."""
+    global _metrics
+    while _patches:
+        module, name, function = _patches.pop()
+        setattr(module, name, function)
+    _metrics = None
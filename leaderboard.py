@@ -0,0 +1,134 @@
+# Contains the in-memory streak leaderboard. The top K streaks are kept in a heap between two queries, so that a dashboard polling
+# the leaderboard is answered from memory, and the streak of a habit just checked off is merged without reading the whole leaderboard again.
+import heapq
+import threading
+import time
+from db import get_streak_leaderboard, DEFAULT_USER_ID
+
+
+class StreakLeaderboard:
+    """Class to represent the top k streaks of a set of habits (see get_streak_leaderboard for the filters), cached in memory.
+    The entries are kept in a min-heap of at most k entries: the weakest entry is at the top, so a new streak is compared to it
+    and replaces it in O(log k). The position of each habit in the heap is indexed by habit_id, so the streak of a habit
+    already in the leaderboard is also updated in O(log k). The leaderboard is read again from the database once ttl seconds
+    have passed, or after invalidate.
+    Attributes:
+        - k: The number of streaks in the leaderboard
+        - ttl: The number of seconds the leaderboard is answered from memory
+        - created_by, is_active, periodicity, ongoing_only, user_id: The filters of get_streak_leaderboard
+        - refreshes: The number of times the leaderboard was read from the database
+    Methods:
+        - top: Method to retrieve the leaderboard, longest streak first
+        - offer: Method to merge the new streak of a habit into the leaderboard
+        - update: Method to merge the streak of a habit just checked off, read from the database
+        - invalidate: Method to read the leaderboard from the database on the next call to top"""
+
+    def __init__(self, k=10, ttl=30, created_by='user', is_active=1, periodicity=None, ongoing_only=False, user_id=DEFAULT_USER_ID):
+        self.k = k
+        self.ttl = ttl
+        self.created_by = created_by
+        self.is_active = is_active
+        self.periodicity = periodicity
+        self.ongoing_only = ongoing_only
+        self.user_id = user_id
+        self.refreshes = 0
+        self._heap = []
+        # Index of each habit_id in the heap, kept up to date by _swap
+        self._positions = {}
+        self._sorted = None
+        self._expires = 0.0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _heap_entry(entry):
+        # Ties are ranked by habit_id like in get_streak_leaderboard: the larger habit_id is the weaker entry
+        return (entry[3], -entry[0], entry)
+
+    def _swap(self, i, j):
+        heap = self._heap
+        heap[i], heap[j] = heap[j], heap[i]
+        self._positions[heap[i][2][0]] = i
+        self._positions[heap[j][2][0]] = j
+
+    def _sift_up(self, index):
+        while index > 0:
+            parent = (index - 1) // 2
+            if self._heap[index] >= self._heap[parent]:
+                return
+            self._swap(index, parent)
+            index = parent
+
+    def _sift_down(self, index):
+        heap = self._heap
+        while True:
+            weakest = index
+            for child in (2 * index + 1, 2 * index + 2):
+                if child < len(heap) and heap[child] < heap[weakest]:
+                    weakest = child
+            if weakest == index:
+                return
+            self._swap(index, weakest)
+            index = weakest
+
+    def top(self, db):
+        """Method to retrieve the leaderboard: a list of (habit_id, task, periodicity, streak, start date, end date) tuples, longest streak first.
+        The database is only queried when the leaderboard expired. Requires a database connection."""
+        with self._lock:
+            if time.monotonic() >= self._expires:
+                rows = get_streak_leaderboard(db, self.created_by, self.is_active, self.k, self.periodicity, self.ongoing_only, self.user_id)
+                self._heap = [self._heap_entry(row) for row in rows]
+                heapq.heapify(self._heap)
+                self._positions = {entry[0]: index for index, (_, _, entry) in enumerate(self._heap)}
+                self._sorted = None
+                self._expires = time.monotonic() + self.ttl
+                self.refreshes += 1
+            if self._sorted is None:
+                self._sorted = [entry for _, _, entry in sorted(self._heap, reverse=True)]
+            return self._sorted
+
+    def offer(self, entry):
+        """Method to merge the current streak of a habit, a (habit_id, task, periodicity, streak, start date, end date) tuple, into the leaderboard.
+        A streak that got shorter may let a habit outside the leaderboard in: the leaderboard is then read again on the next call to top."""
+        if self.periodicity is not None and entry[2] != self.periodicity:
+            return
+        with self._lock:
+            if self.ongoing_only and entry[5] is not None:
+                # The streak ended, it leaves the leaderboard of the ongoing streaks
+                self._expires = 0.0
+                return
+            heap_entry = self._heap_entry(entry)
+            index = self._positions.get(entry[0])
+            if index is not None:
+                if entry[3] < self._heap[index][0]:
+                    self._expires = 0.0
+                    return
+                # A longer streak is a stronger entry: it moves away from the top of the min-heap
+                self._heap[index] = heap_entry
+                self._sift_down(index)
+            elif len(self._heap) < self.k:
+                self._heap.append(heap_entry)
+                self._positions[entry[0]] = len(self._heap) - 1
+                self._sift_up(len(self._heap) - 1)
+            elif heap_entry > self._heap[0]:
+                del self._positions[self._heap[0][2][0]]
+                self._heap[0] = heap_entry
+                self._positions[entry[0]] = 0
+                self._sift_down(0)
+            else:
+                return
+            self._sorted = None
+
+    def update(self, db, habit_id):
+        """Method to merge the streak of a habit just checked off into the leaderboard. Only the streak summary of this habit is read,
+        with the filters of the leaderboard. Requires a database connection."""
+        rows = get_streak_leaderboard(db, self.created_by, self.is_active, 1, self.periodicity, self.ongoing_only, self.user_id, habit_id)
+        if rows:
+            self.offer(rows[0])
+        elif habit_id in self._positions:
+            # The habit no longer matches the filters (e.g. its ongoing streak ended)
+            self.invalidate()
+
+    def invalidate(self):
+        """Method to read the leaderboard from the database on the next call to top, e.g. after habits were deleted."""
+        with self._lock:
+            self._expires = 0.0
@@ -1,14 +1,39 @@
 # Description: This is the main file for the MindMold program. It will be the file that the user runs to interact with the program.
-from functions_main import cli, main_menu, handle_choice
+# Use --script to read the answers to the prompts from a file instead of the keyboard, e.g. python main.py --script commands.txt
+# Use --metrics to instrument the database queries and write their metrics to a file in the Prometheus text format when the program ends.
+import argparse
+import sys
+import time
+from functions_main import cli, run
+from instrumentation import instrument
 
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="MindMold habit tracker.")
+    parser.add_argument('--script', help="file with one answer per line, read instead of the keyboard; the program ends with the file")
+    parser.add_argument('--metrics', help="file the metrics of the database queries are written to (Prometheus text format)")
+    parser.add_argument('--slow-ms', type=float, default=100, help="with --metrics, duration of a slow query in milliseconds (default: 100)")
+    parser.add_argument('--slow-log', help="with --metrics, file the slow queries and their query plans are appended to")
+    args = parser.parse_args()
+    if args.script:
+        sys.stdin = open(args.script)
+    # The db module is instrumented before the connection is opened, so that its statements are traced
+    metrics = instrument(args.slow_ms, args.slow_log) if args.metrics else None
+
     db = cli()
 
+    # Display the main menu with a welcome message and prompt the user for a choice
+    print("Welcome to MindMold. Mold your mind and body into their best versions with MindMold – habit tracking made easy! \n")
+    print("You've taken the first step towards transforming your life, one habit at a time. What's on the agenda today?")
+    start = time.perf_counter()
+    actions = run(db)
+    duration = time.perf_counter() - start
 
-# Display the main menu with a welcome message and prompt the user for a choice
-print("Welcome to MindMold. Mold your mind and body into their best versions with MindMold – habit tracking made easy! \n")
-print("You've taken the first step towards transforming your life, one habit at a time. What's on the agenda today?")
-user_choice = main_menu()
-handle_choice(db, user_choice)
+    if args.script:
+        # The throughput goes to stderr so that it is not mixed with the output of the script
+        print(f"{actions} actions in {duration:.2f} s ({actions / duration if duration else 0:.0f} actions/s)", file=sys.stderr)
+        sys.stdin.close()
+    db.close()
+    if metrics is not None:
+        metrics.write_prometheus(args.metrics)
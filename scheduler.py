@@ -0,0 +1,75 @@
+# Contains the streak expiry scheduler. It ends the streaks of the habits whose period has lapsed without waiting for the user to mark them as completed.
+# Run it next to the program with: python scheduler.py --interval 86400
+import argparse
+import datetime
+import sqlite3
+import sys
+import time
+from db import get_db, end_streaks_bulk, transaction
+from habit import check_continuity_bulk
+
+
+def expire_streaks(db, as_of=None, created_by='user', is_active=1, user_id=None):
+    """Function to end the active streak of every broken habit in a single pass and a single transaction.
+    The broken habits are found with check_continuity_bulk, then their streaks and streak summaries are ended with end_streaks_bulk.
+    Habits whose last checkoff date cannot be read are left out, so that one bad row does not stop the pass.
+    Parameters:
+        - as_of: the date the habits are checked on (datetime.date or YYYY-MM-DD), the current date by default.
+        - created_by ('user' or 'predefined')
+        - is_active (1 if created by user, 0 if predefined).
+        - user_id: the user owning the habits, None (default) for the habits of all users.
+        - Requires a database connection.
+    Returns the metrics of the pass: date checked, number of broken habits, number of streaks closed, the (habit_id, date) of the habits
+    left out and duration in seconds."""
+    start = time.perf_counter()
+    checked_on = str(as_of) if as_of is not None else datetime.date.today().isoformat()
+    invalid_dates = []
+    # The write lock is taken before reading: a deferred transaction reading a snapshot that another connection commits over
+    # cannot be upgraded to a write transaction (database is locked, without waiting for busy_timeout)
+    with transaction(db, immediate=True):
+        broken_habits = check_continuity_bulk(db, checked_on, created_by, is_active, user_id, invalid_dates)
+        streaks_closed = end_streaks_bulk(db, sorted(broken_habits), user_id)
+    return {
+        'checked_on': checked_on,
+        'broken_habits': len(broken_habits),
+        'streaks_closed': streaks_closed,
+        'invalid_dates': invalid_dates,
+        'duration': time.perf_counter() - start,
+    }
+
+
+def run_scheduler(name="main.db", interval=86400, runs=None):
+    """Function to run expire_streaks on the database specified by name every interval seconds.
+    The time taken by a pass is deducted from the wait, so passes keep a steady cadence. The metrics of each pass are printed.
+    A pass failing on a database error (e.g. the database locked by another program for longer than busy_timeout) is reported
+    and retried at the next pass instead of stopping the scheduler. Habits left out because their last checkoff date cannot be read are reported too.
+    Parameters:
+        - interval: number of seconds between two passes (one day by default).
+        - runs: number of passes before returning, None (default) to run until interrupted."""
+    db = get_db(name)
+    completed_runs = 0
+    try:
+        while runs is None or completed_runs < runs:
+            started = time.monotonic()
+            try:
+                metrics = expire_streaks(db)
+            except sqlite3.Error as error:
+                print(f"{datetime.datetime.now().isoformat(timespec='seconds')}: pass failed: {error}", file=sys.stderr)
+            else:
+                for habit_id, checkedoff_on in metrics['invalid_dates']:
+                    print(f"{metrics['checked_on']}: habit {habit_id} skipped: invalid checkoff date {checkedoff_on!r}", file=sys.stderr)
+                print(f"{metrics['checked_on']}: {metrics['streaks_closed']} streak(s) closed for {metrics['broken_habits']} broken habit(s) in {metrics['duration']:.3f} s")
+            completed_runs += 1
+            if runs is None or completed_runs < runs:
+                time.sleep(max(0.0, interval - (time.monotonic() - started)))
+    finally:
+        db.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="End the streaks of the habits whose period has lapsed.")
+    parser.add_argument('--db', default="main.db", help="database file (default: main.db)")
+    parser.add_argument('--interval', type=float, default=86400, help="seconds between two passes (default: 86400)")
+    parser.add_argument('--once', action='store_true', help="run a single pass and exit")
+    args = parser.parse_args()
+    run_scheduler(args.db, args.interval, 1 if args.once else None)
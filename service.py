@@ -0,0 +1,360 @@
+# Contains the HTTP/JSON service mode. The operations of the main menu are exposed as endpoints so that the tracker can be driven
+# by other programs without the interactive prompts, and a load test measuring the requests per second and the latency of the service.
+# Run the service with: python service.py serve --port 8000, and load test it with: python service.py loadtest --port 8000
+import argparse
+import http.client
+import json
+import re
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+from db import (get_db, get_read_db, get_all_habits, get_habits_by_periodicity, get_habit_details, habit_exists, update_habit,
+                delete_habit, get_longest_streak_all_habits, get_longest_streak_one_habit, DEFAULT_USER_ID, PERIODICITIES)
+from habit import Habit
+from cache import LRUCache, MISSING
+from leaderboard import StreakLeaderboard
+from error_handler import error_1, error_2, error_3
+
+
+class ServiceError(Exception):
+    """Error returned to the client as a JSON object with the given HTTP status."""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def _habit_json(habit):
+    """Return the habit_id, task, periodicity and creation date of a habits row as a dictionary."""
+    return {'habit_id': habit.habit_id, 'task': habit.task, 'periodicity': habit.periodicity, 'created_on': habit.created_on}
+
+
+def _streak_json(streak):
+    """Return a row of get_longest_streak_all_habits or get_longest_streak_one_habit as a dictionary."""
+    if streak is None:
+        return None
+    return {'habit_id': streak.habit_id, 'streak': streak.streak, 'started_on': streak.started_on, 'ended_on': streak.ended_on}
+
+
+class HabitRequestHandler(BaseHTTPRequestHandler):
+    """Class to handle the requests of the service. Each route calls the same db and Habit functions as the main menu.
+    Requests are answered with HTTP/1.1 so that clients can keep their connection open between requests.
+    The user is given by the user_id query parameter (DEFAULT_USER_ID by default).
+    Methods:
+        - list_habits: GET /habits (optional periodicity query parameter)
+        - create_habit: POST /habits with the task and the periodicity
+        - update_habit: PUT /habits/<habit_id> with the new task and/or periodicity
+        - delete_habit: DELETE /habits/<habit_id>
+        - mark_as_completed: POST /habits/<habit_id>/checkoffs
+        - longest_streak_one_habit: GET /habits/<habit_id>/longest-streak
+        - longest_streak_all_habits: GET /longest-streak
+        - leaderboard: GET /leaderboard (optional k, periodicity and ongoing query parameters)"""
+
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately, Nagle's algorithm would hold the body until the client acknowledges the headers
+    disable_nagle_algorithm = True
+    # Idle keep-alive connections are closed after this many seconds to give their worker thread back to the pool
+    timeout = 5
+
+    routes = (
+        ('GET', re.compile(r'^/habits$'), 'list_habits'),
+        ('POST', re.compile(r'^/habits$'), 'create_habit'),
+        ('PUT', re.compile(r'^/habits/(\d+)$'), 'update_habit'),
+        ('DELETE', re.compile(r'^/habits/(\d+)$'), 'delete_habit'),
+        ('POST', re.compile(r'^/habits/(\d+)/checkoffs$'), 'mark_as_completed'),
+        ('GET', re.compile(r'^/habits/(\d+)/longest-streak$'), 'longest_streak_one_habit'),
+        ('GET', re.compile(r'^/longest-streak$'), 'longest_streak_all_habits'),
+        ('GET', re.compile(r'^/leaderboard$'), 'leaderboard'),
+    )
+
+    def do_GET(self):
+        self._dispatch('GET')
+
+    def do_POST(self):
+        self._dispatch('POST')
+
+    def do_PUT(self):
+        self._dispatch('PUT')
+
+    def do_DELETE(self):
+        self._dispatch('DELETE')
+
+    def log_message(self, format, *args):
+        """Requests are not logged to keep the service fast under load."""
+
+    def _dispatch(self, method):
+        """Find the route of the request, call it and send its result as JSON."""
+        url = urlsplit(self.path)
+        self.query = parse_qs(url.query)
+        try:
+            body = self._read_body()
+            for route_method, pattern, name in self.routes:
+                match = pattern.match(url.path)
+                if match and route_method == method:
+                    status, result = getattr(self, name)(*[int(group) for group in match.groups()], body)
+                    break
+            else:
+                raise ServiceError(404, f"No route for {method} {url.path}")
+        except ServiceError as error:
+            status, result = error.status, {'error': str(error)}
+        except (ValueError, OverflowError) as error:
+            # A query parameter that is not a number or an id too large for SQLite is an invalid request, not a server error
+            status, result = 400, {'error': f"Invalid request: {error}"}
+        except sqlite3.Error as error:
+            status, result = 500, {'error': str(error)}
+        self._send_json(status, result)
+
+    def _read_body(self):
+        """Return the JSON body of the request as a dictionary (empty when there is no body)."""
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+        except ValueError:
+            length = -1
+        if length < 0:
+            # The end of the body is unknown: the connection cannot be reused for another request
+            self.close_connection = True
+            raise ServiceError(400, "The Content-Length header of the request is not valid.")
+        if length == 0:
+            return {}
+        try:
+            body = json.loads(self.rfile.read(length))
+        except ValueError:
+            raise ServiceError(400, "The body of the request is not valid JSON.")
+        if not isinstance(body, dict):
+            raise ServiceError(400, "The body of the request must be a JSON object.")
+        return body
+
+    def _send_json(self, status, result):
+        payload = json.dumps(result).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _user_id(self):
+        try:
+            return int(self.query.get('user_id', [DEFAULT_USER_ID])[0])
+        except ValueError:
+            raise ServiceError(400, error_2.get_error_message())
+
+    def _check_habit(self, db, habit_id, user_id):
+        if not habit_exists(db, habit_id, 'user', 1, user_id):
+            raise ServiceError(404, error_3.get_error_message())
+
+    def _check_task_periodicity(self, task, periodicity):
+        if not isinstance(task, str) or len(task) == 0:
+            raise ServiceError(400, error_1.get_error_message())
+        if periodicity not in PERIODICITIES:
+            raise ServiceError(400, "Periodicity must be daily, weekly or monthly.")
+
+    def list_habits(self, body):
+        db = get_read_db(self.server.name)
+        periodicity = self.query.get('periodicity', [None])[0]
+        if periodicity is None:
+            habits = get_all_habits(db, 'user', 1, self._user_id())
+        elif periodicity in PERIODICITIES:
+            habits = get_habits_by_periodicity(db, periodicity, 'user', 1, self._user_id())
+        else:
+            raise ServiceError(400, "Periodicity must be daily, weekly or monthly.")
+        return 200, [_habit_json(habit) for habit in habits]
+
+    def create_habit(self, body):
+        task, periodicity = body.get('task'), body.get('periodicity')
+        self._check_task_periodicity(task, periodicity)
+        habit_id = Habit().create_habit(self.server.get_db(), task, periodicity, self._user_id())
+        return 201, {'habit_id': habit_id, 'task': task, 'periodicity': periodicity}
+
+    def update_habit(self, habit_id, body):
+        db = self.server.get_db()
+        user_id = self._user_id()
+        self._check_habit(db, habit_id, user_id)
+        habit_details = get_habit_details(db, habit_id, 'user', 1, user_id)
+        task, periodicity = body.get('task', habit_details.task), body.get('periodicity', habit_details.periodicity)
+        self._check_task_periodicity(task, periodicity)
+        update_habit(db, habit_id, task, periodicity, user_id)
+        return 200, {'habit_id': habit_id, 'task': task, 'periodicity': periodicity}
+
+    def delete_habit(self, habit_id, body):
+        db = self.server.get_db()
+        user_id = self._user_id()
+        self._check_habit(db, habit_id, user_id)
+        delete_habit(db, habit_id, user_id)
+        return 200, {'habit_id': habit_id, 'deleted': True}
+
+    def mark_as_completed(self, habit_id, body):
+        db = self.server.get_db()
+        user_id = self._user_id()
+        self._check_habit(db, habit_id, user_id)
+        streak_active = Habit().mark_as_completed(db, habit_id, 'user', 1, user_id)
+        # The leaderboards of the user are updated in memory instead of waiting for them to expire
+        for leaderboard in self.server.leaderboards.values():
+            if leaderboard.user_id == user_id:
+                leaderboard.update(db, habit_id)
+        return 200, {'habit_id': habit_id, 'streak_active': streak_active}
+
+    def longest_streak_one_habit(self, habit_id, body):
+        db = get_read_db(self.server.name)
+        user_id = self._user_id()
+        self._check_habit(db, habit_id, user_id)
+        return 200, _streak_json(get_longest_streak_one_habit(db, habit_id, 'user', 1, user_id))
+
+    def longest_streak_all_habits(self, body):
+        db = get_read_db(self.server.name)
+        return 200, _streak_json(get_longest_streak_all_habits(db, 'user', 1, self._user_id()))
+
+
+    def leaderboard(self, body):
+        user_id = self._user_id()
+        periodicity = self.query.get('periodicity', [None])[0]
+        ongoing_only = self.query.get('ongoing', ['0'])[0] in ('1', 'true')
+        try:
+            k = int(self.query.get('k', [10])[0])
+        except ValueError:
+            raise ServiceError(400, error_2.get_error_message())
+        if periodicity is not None and periodicity not in PERIODICITIES:
+            raise ServiceError(400, "Periodicity must be daily, weekly or monthly.")
+        # Dashboards poll the same leaderboards, they are answered from memory for leaderboard_ttl seconds
+        key = (user_id, periodicity, ongoing_only, k)
+        leaderboard = self.server.leaderboards.get(key)
+        if leaderboard is MISSING:
+            leaderboard = StreakLeaderboard(k, self.server.leaderboard_ttl, periodicity=periodicity, ongoing_only=ongoing_only, user_id=user_id)
+            self.server.leaderboards.set(key, leaderboard)
+        return 200, [{'habit_id': habit_id, 'task': task, 'periodicity': habit_periodicity, 'streak': streak, 'started_on': started_on, 'ended_on': ended_on}
+                     for habit_id, task, habit_periodicity, streak, started_on, ended_on in leaderboard.top(get_read_db(self.server.name))]
+
+
+class HabitServer(ThreadingHTTPServer):
+    """HTTP server answering the requests of HabitRequestHandler on a fixed pool of worker threads.
+    Each worker thread keeps its own write connection (get_db) and read connection (get_read_db) for as long as it lives,
+    so requests never pay for opening a connection and the schema check.
+    Attributes:
+        - name: The path of the SQLite database
+        - workers: The number of worker threads, i.e. the number of client connections served at the same time
+        - leaderboards: The StreakLeaderboard of each combination of filters requested, answered from memory for leaderboard_ttl seconds
+          and updated by every checkoff
+    Methods:
+        - get_db: Method to retrieve the write connection of the current worker thread"""
+
+    def __init__(self, address, name="main.db", workers=32, leaderboard_ttl=5):
+        self.name = name
+        self.workers = workers
+        self.leaderboards = LRUCache(maxsize=1024)
+        self.leaderboard_ttl = leaderboard_ttl
+        self._local = threading.local()
+        # The schema is created (or upgraded) once before the first request
+        get_db(name).close()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='habit-service')
+        super().__init__(address, HabitRequestHandler)
+
+    def process_request(self, request, client_address):
+        self._executor.submit(self.process_request_thread, request, client_address)
+
+    def get_db(self):
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = self._local.db = get_db(self.name)
+        return db
+
+    def server_close(self):
+        super().server_close()
+        self._executor.shutdown(wait=True)
+
+
+def serve(name="main.db", host='127.0.0.1', port=8000, workers=32):
+    """Function to run the service on the database specified by name until interrupted."""
+    server = HabitServer((host, port), name, workers)
+    print(f"Serving {name} on http://{host}:{server.server_address[1]} with {workers} worker threads")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def run_load_test(host='127.0.0.1', port=8000, method='GET', path='/habits', body=None, requests=1000, concurrency=8):
+    """Function to send requests to the service from concurrency threads, each client keeping its connection open.
+    Parameters:
+        - method, path and body: the request sent (body is a dictionary sent as JSON). path can also be a list of paths sent in turn,
+          e.g. to check off a different habit with each request.
+        - requests: the total number of requests.
+        - concurrency: the number of clients sending requests at the same time.
+    Returns the number of requests, the number of errors (status 400 and above), the duration in seconds,
+    the requests per second and the median and 99th percentile latencies in milliseconds."""
+    paths = [path] if isinstance(path, str) else list(path)
+    payload = json.dumps(body).encode() if body is not None else None
+    headers = {'Content-Type': 'application/json'} if payload is not None else {}
+    latencies = []
+    errors = []
+
+    def client(number, count):
+        connection = http.client.HTTPConnection(host, port)
+        client_latencies, client_errors = [], 0
+        try:
+            for request in range(count):
+                started = time.perf_counter()
+                # The clients take the paths in turn, so no two requests use the same path before all the paths are used
+                connection.request(method, paths[(number + request * concurrency) % len(paths)], payload, headers)
+                response = connection.getresponse()
+                response.read()
+                client_latencies.append(time.perf_counter() - started)
+                client_errors += response.status >= 400
+        finally:
+            connection.close()
+        latencies.extend(client_latencies)
+        errors.append(client_errors)
+
+    counts = [requests // concurrency + (i < requests % concurrency) for i in range(concurrency)]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for future in [executor.submit(client, number, count) for number, count in enumerate(counts) if count]:
+            future.result()
+    duration = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'errors': sum(errors),
+        'duration': duration,
+        'requests_per_second': len(latencies) / duration if duration else 0.0,
+        'p50_ms': latencies[len(latencies) // 2] * 1000 if latencies else 0.0,
+        'p99_ms': latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000 if latencies else 0.0,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run the habit tracker as an HTTP/JSON service or load test a running service.")
+    commands = parser.add_subparsers(dest='command', required=True)
+    serve_parser = commands.add_parser('serve', help="run the service")
+    serve_parser.add_argument('--db', default="main.db", help="database file (default: main.db)")
+    serve_parser.add_argument('--host', default='127.0.0.1')
+    serve_parser.add_argument('--port', type=int, default=8000)
+    serve_parser.add_argument('--workers', type=int, default=32, help="worker threads (default: 32)")
+    load_parser = commands.add_parser('loadtest', help="load test a running service")
+    load_parser.add_argument('--host', default='127.0.0.1')
+    load_parser.add_argument('--port', type=int, default=8000)
+    load_parser.add_argument('--requests', type=int, default=1000)
+    load_parser.add_argument('--concurrency', type=int, default=8)
+    load_parser.add_argument('--checkoffs', action='store_true', help="mark new habits as completed (one per request) instead of listing the habits")
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        serve(args.db, args.host, args.port, args.workers)
+    else:
+        method, path, paths = 'GET', '/habits', '/habits'
+        if args.checkoffs:
+            # A habit is checked off at most once a day: each request checks off its own habit, otherwise all but the first would change nothing
+            connection = http.client.HTTPConnection(args.host, args.port)
+            paths = []
+            for number in range(args.requests):
+                connection.request('POST', '/habits', json.dumps({'task': f'Load test {number}', 'periodicity': 'daily'}), {'Content-Type': 'application/json'})
+                paths.append(f"/habits/{json.loads(connection.getresponse().read())['habit_id']}/checkoffs")
+            connection.close()
+            method, path = 'POST', '/habits/<habit_id>/checkoffs'
+        metrics = run_load_test(args.host, args.port, method, paths, None, args.requests, args.concurrency)
+        print(f"{metrics['requests']} {method} {path} requests ({metrics['errors']} errors) in {metrics['duration']:.2f} s: "
+              f"{metrics['requests_per_second']:.0f} req/s, p50 {metrics['p50_ms']:.2f} ms, p99 {metrics['p99_ms']:.2f} ms")
@@ -0,0 +1,185 @@
+# Contains the shard router. It spreads users over several SQLite files so that writes of different users do not wait for each other,
+# SQLite allowing a single writer per file. The functions of the db module are used unchanged on the connection of the user's shard.
+import bisect
+import hashlib
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from db import get_db, connect, transaction, invalidate_habits, get_longest_streak_all_habits
+
+
+def _hash(key):
+    """Return the position of a key on the hash ring. md5 is used instead of hash() so that every process computes the same position."""
+    return int.from_bytes(hashlib.md5(str(key).encode()).digest()[:8], 'big')
+
+
+class ShardRouter:
+    """Class to route each user to one of several SQLite files (shards) with consistent hashing.
+    Each shard is placed many times on a hash ring (virtual nodes) and a user belongs to the first shard found after the user's position,
+    so adding a shard only moves the users now closer to the new shard (about 1/N of them) and the others stay where they are.
+    Attributes:
+        - shards: The paths of the SQLite files
+        - replicas: The number of virtual nodes per shard
+    Methods:
+        - add_shard: Method to add a SQLite file to the ring
+        - shard_for: Method to find the shard of a user
+        - get_db: Method to retrieve the connection to the shard of a user
+        - call: Method to call a function of the db module on the shard of a user
+        - move_user: Method to move the data of a user to the user's shard after shards were added
+        - map: Method to run a function on every shard in parallel processes
+        - close: Method to close the connections opened by the current thread"""
+
+    def __init__(self, shards, replicas=100):
+        self.shards = []
+        self.replicas = replicas
+        self._ring = []
+        self._nodes = {}
+        self._local = threading.local()
+        for path in shards:
+            self.add_shard(path)
+
+    def add_shard(self, path):
+        """Method to add a SQLite file to the ring. The tables are created if needed.
+        The users whose shard changes must then be moved with move_user."""
+        if path in self.shards:
+            return
+        get_db(path).close()
+        self.shards.append(path)
+        for replica in range(self.replicas):
+            position = _hash(f"{path}#{replica}")
+            bisect.insort(self._ring, position)
+            self._nodes[position] = path
+
+    def shard_for(self, user_id):
+        """Method to find the path of the shard of a user."""
+        if not self._ring:
+            raise ValueError("The router has no shard.")
+        index = bisect.bisect(self._ring, _hash(user_id)) % len(self._ring)
+        return self._nodes[self._ring[index]]
+
+    def get_db(self, user_id):
+        """Method to retrieve the connection to the shard of a user. Each thread keeps one connection per shard."""
+        connections = getattr(self._local, 'connections', None)
+        if connections is None:
+            connections = self._local.connections = {}
+        path = self.shard_for(user_id)
+        if path not in connections:
+            connections[path] = get_db(path)
+        return connections[path]
+
+    def call(self, function, user_id, *args, **kwargs):
+        """Method to call a function of the db module on the shard of a user, e.g. router.call(add_checkoff, user_id, habit_id).
+        The connection is passed as first argument and user_id as keyword argument."""
+        return function(self.get_db(user_id), *args, user_id=user_id, **kwargs)
+
+    def move_user(self, user_id, source):
+        """Method to move all the data of a user from the shard source to the shard the user belongs to now (after add_shard).
+        The habits get new habit_id in their new shard (ids are only unique inside a shard). The copy is committed before the data is
+        deleted from source, so an interruption can leave a copy behind in source but never loses data.
+        The cached rows of the habits (see db.habit_cache) are invalidated in both shards once each transaction commits.
+        Returns a dictionary mapping the old habit_id to the new ones."""
+        destination = self.shard_for(user_id)
+        if destination == source:
+            return {}
+        db = self.get_db(user_id)
+        db.execute("ATTACH DATABASE ? AS source;", (source,))
+        try:
+            habit_ids = {}
+            with transaction(db):
+                cur = db.cursor()
+                cur.execute("INSERT OR IGNORE INTO users (user_id, name, created_on) SELECT user_id, name, created_on FROM source.users WHERE user_id = ?;", (user_id,))
+                cur.execute("SELECT habit_id FROM source.habits WHERE user_id = ? ORDER BY habit_id;", (user_id,))
+                for (old_habit_id,) in cur.fetchall():
+                    cur.execute("""
+                        INSERT INTO habits (task, periodicity, created_on, updated_on, deleted_on, is_active, created_by, user_id)
+                        SELECT task, periodicity, created_on, updated_on, deleted_on, is_active, created_by, user_id
+                        FROM source.habits
+                        WHERE habit_id = ?;
+                        """, (old_habit_id,))
+                    habit_ids[old_habit_id] = cur.lastrowid
+                cur.execute("CREATE TEMP TABLE moved_habits (old_id INTEGER PRIMARY KEY, new_id INTEGER);")
+                cur.executemany("INSERT INTO temp.moved_habits VALUES (?, ?);", habit_ids.items())
+                cur.execute("""
+                    INSERT INTO checkoffs (user_id, habit_id, checkedoff_on, checkedoff_day, checkedoff_week, checkedoff_month)
+                    SELECT c.user_id, m.new_id, c.checkedoff_on, c.checkedoff_day, c.checkedoff_week, c.checkedoff_month
+                    FROM source.checkoffs c
+                    JOIN temp.moved_habits m ON m.old_id = c.habit_id
+                    WHERE c.user_id = ?
+                    ORDER BY c.checkoff_id;
+                    """, (user_id,))
+                cur.execute("""
+                    INSERT INTO streaks (user_id, habit_id, started_on, ended_on, current_streak, is_active)
+                    SELECT s.user_id, m.new_id, s.started_on, s.ended_on, s.current_streak, s.is_active
+                    FROM source.streaks s
+                    JOIN temp.moved_habits m ON m.old_id = s.habit_id
+                    WHERE s.user_id = ?
+                    ORDER BY s.streak_id;
+                    """, (user_id,))
+                cur.execute("""
+                    INSERT INTO streak_state (habit_id, last_checkoff_id, last_checkedoff_on, last_period, current_streak, current_started_on,
+                        longest_streak, longest_started_on, longest_ended_on)
+                    SELECT m.new_id, COALESCE((SELECT MAX(c.checkoff_id) FROM checkoffs c WHERE c.user_id = ? AND c.habit_id = m.new_id), 0),
+                        s.last_checkedoff_on, s.last_period, s.current_streak, s.current_started_on, s.longest_streak, s.longest_started_on, s.longest_ended_on
+                    FROM source.streak_state s
+                    JOIN temp.moved_habits m ON m.old_id = s.habit_id;
+                    """, (user_id,))
+                cur.execute("""
+                    INSERT INTO habit_bitmaps (habit_id, chunk, bits)
+                    SELECT m.new_id, b.chunk, b.bits
+                    FROM source.habit_bitmaps b
+                    JOIN temp.moved_habits m ON m.old_id = b.habit_id;
+                    """)
+                cur.execute("DROP TABLE temp.moved_habits;")
+                # A habit_id reused in the destination may have a cached row (or a cached None), dropped once the copy commits
+                invalidate_habits(db, habit_ids.values())
+        finally:
+            db.execute("DETACH DATABASE source;")
+
+        source_db = get_db(source)
+        try:
+            with transaction(source_db):
+                for table in ("habit_bitmaps", "streak_state", "streaks", "checkoffs"):
+                    key = "habit_id IN (SELECT habit_id FROM habits WHERE user_id = ?)" if table in ("habit_bitmaps", "streak_state") else "user_id = ?"
+                    source_db.execute(f"DELETE FROM {table} WHERE {key};", (user_id,))
+                source_db.execute("DELETE FROM habits WHERE user_id = ?;", (user_id,))
+                source_db.execute("DELETE FROM users WHERE user_id = ?;", (user_id,))
+                invalidate_habits(source_db, habit_ids)
+        finally:
+            source_db.close()
+        return habit_ids
+
+    def map(self, function, *args, processes=None):
+        """Method to run function(path, *args) on every shard in a pool of processes (one per shard by default).
+        function must be defined at module level so that it can be sent to the processes.
+        Returns the list of (path, result) tuples."""
+        with ProcessPoolExecutor(max_workers=processes or len(self.shards)) as pool:
+            results = pool.map(function, self.shards, *[[arg] * len(self.shards) for arg in args])
+            return list(zip(self.shards, results))
+
+    def close(self):
+        """Method to close the connections opened by the current thread."""
+        connections = getattr(self._local, 'connections', {})
+        for db in connections.values():
+            db.close()
+        connections.clear()
+
+
+def _longest_streak_in_shard(path, created_by, is_active):
+    """Return the longest streak of all the users of one shard (runs in a worker process of ShardRouter.map)."""
+    db = connect(path, read_only=True)
+    try:
+        return get_longest_streak_all_habits(db, created_by, is_active, user_id=None)
+    finally:
+        db.close()
+
+
+def longest_streak_all_shards(router, created_by='user', is_active=1, processes=None):
+    """Function to retrieve the longest streak of all habits of all users, over all the shards of a router.
+    Each shard is queried in its own process, then the results are merged.
+    Parameters:
+        - created_by ('user' or 'predefined')
+        - is_active (1 if created by user, 0 if predefined).
+        - processes: number of worker processes, one per shard by default.
+    Returns the shard path, habit_id, streak, start and end dates of the longest streak, None if there is no streak."""
+    results = [(path,) + tuple(streak) for path, streak in router.map(_longest_streak_in_shard, created_by, is_active, processes=processes)
+               if streak is not None]
+    return max(results, key=lambda result: result[2], default=None)
@@ -1,5 +1,27 @@
-from habit import Habit
-from db import get_db, add_habit, start_streak, increment_current_streak, add_checkoff, get_habit_details, delete_habit, get_longest_streak_one_habit, get_longest_streak_all_habits, get_habits_by_periodicity, update_habit, end_streak
+import asyncio
+import http.client
+import io
+import json
+import pickle
+import sqlite3
+import threading
+import habit
+from async_db import AsyncDatabase
+from habit import Habit, check_continuity_bulk
+from scheduler import expire_streaks, run_scheduler
+from shards import ShardRouter, longest_streak_all_shards
+from service import HabitServer, run_load_test
+from functions_main import run
+from batch import run_batch
+from export import export
+from importer import import_checkoffs
+from Analysis import Analysis
+from leaderboard import StreakLeaderboard
+from habit_analytics import CheckoffArrays, HabitStore, completion_rate, rolling_adherence, weekday_heatmap, streak_histogram
+from benchmark import run_suite, compare
+from instrumentation import instrument, uninstrument, attach
+from error_handler import error_1, error_3
+from db import get_db, migrate, add_user, habit_exists, habit_cache, rebuild_streaks, get_read_db, close_read_dbs, get_schema_version, SCHEMA_VERSION, transaction, add_checkoffs_bulk, increment_streaks_bulk, last_checkedoff_on, add_habit, start_streak, increment_current_streak, add_checkoff, get_habit_details, delete_habit, get_longest_streak_one_habit, get_longest_streak_all_habits, get_habits_by_periodicity, update_habit, end_streak, get_habits_page, get_streak_leaderboard, get_last_checkoff_day, period_bucket, was_completed, get_completion_runs, named_row, get_habit_ids, epoch_day_sql
 
 
 class Testing:
@@ -54,6 +76,54 @@ class Testing:
         habit_periodicity = periodicity.get_task_periodicity(self.db, self.habit_id_1, 'user', 1)
         assert habit_periodicity[1] == "daily"
 
+    def test_continuity_bulk(self):
+        """Method to test the bulk continuity check of the habit module.
+        Test that the broken habits are found for a given date."""
+
+        # On 2024-02-23 only the weekly habit 2 is broken (last completed on 2024-02-07)
+        assert check_continuity_bulk(self.db, "2024-02-23") == {self.habit_id_2}
+
+        # On 2024-02-24 the daily habit 1 is broken as well (last completed on 2024-02-22)
+        assert check_continuity_bulk(self.db, "2024-02-24") == {self.habit_id_1, self.habit_id_2}
+
+        # Weeks start on Monday like the streak summaries: a weekly habit completed on Monday 2024-01-01 continues until Sunday 2024-01-14
+        habit_id = add_habit(self.db, "weekly habit", "weekly", created_on="2024-01-01")
+        add_checkoff(self.db, habit_id, checkedoff_on="2024-01-01")
+        assert habit_id not in check_continuity_bulk(self.db, "2024-01-14")
+        assert habit_id in check_continuity_bulk(self.db, "2024-01-15")
+
+    def test_expire_streaks(self, capsys):
+        """Method to test the streak expiry pass of the scheduler module.
+        Test that the streaks of the broken habits are ended once, with their last checkoff, and that unreadable dates are reported."""
+
+        # On 2024-02-24 both habits are broken, their streaks are ended on that date
+        metrics = expire_streaks(self.db, "2024-02-24")
+        assert metrics['broken_habits'] == 2
+        assert metrics['streaks_closed'] == 2
+        active_streaks = self.db.execute("SELECT COUNT(*) FROM streaks WHERE is_active = 1").fetchone()[0]
+        assert active_streaks == 0
+
+        # The streaks end with their last checkoff, the end date reported by the streak summaries
+        ended_on = self.db.execute("SELECT habit_id, ended_on FROM streaks ORDER BY habit_id").fetchall()
+        assert ended_on == [(self.habit_id_1, "2024-02-22"), (self.habit_id_2, "2024-02-07")]
+        assert [get_longest_streak_one_habit(self.db, habit_id, "user", 1)[3] for habit_id, _ in ended_on] == ["2024-02-22", "2024-02-07"]
+        assert self.db.execute("SELECT longest_ended_on FROM streak_state ORDER BY habit_id").fetchall() == [("2024-02-22",), ("2024-02-07",)]
+
+        # A second pass has nothing left to close
+        assert expire_streaks(self.db, "2024-02-24")['streaks_closed'] == 0
+
+        # A checkoff date that cannot be read is reported for its habit without stopping the pass
+        habit_id = add_habit(self.db, "legacy habit", "daily", created_on="2024-02-01")
+        start_streak(self.db, habit_id, started_on="2024-02-01")
+        self.db.execute("INSERT INTO checkoffs (user_id, habit_id, checkedoff_on) VALUES (1, ?, 'not a date')", (habit_id,))
+        self.db.execute("UPDATE streaks SET is_active = 1 WHERE habit_id = ?", (self.habit_id_1,))
+        self.db.commit()
+        metrics = expire_streaks(self.db, "2024-02-24")
+        assert metrics['invalid_dates'] == [(habit_id, "not a date")]
+        assert metrics['streaks_closed'] == 1
+        run_scheduler("test.db", runs=1)
+        assert f"habit {habit_id} skipped" in capsys.readouterr().err
+
     def test_db(self):
         """Method to test the functionality of the db module.
         Test of the get_habit_details, update_habit, end_streak, and delete_habit methods."""
@@ -73,6 +143,370 @@ class Testing:
         habit_2_details = get_habit_details(self.db, self.habit_id_2, "user", 0)
         assert habit_2_details[5] == 0
 
+    def test_habit_cache(self):
+        """Method to test the habit cache of the db module.
+        Test that repeated reads of a habit are cache hits and that an update invalidates the cached row."""
+
+        # The second read of habit 1 is answered by the cache
+        habit_cache.clear()
+        get_habit_details(self.db, self.habit_id_1, "user", 1)
+        get_habit_details(self.db, self.habit_id_1, "user", 1)
+        assert habit_cache.stats()['hits'] == 1
+        assert habit_cache.stats()['misses'] == 1
+
+        # After an update the new name is read from the database
+        update_habit(self.db, self.habit_id_1, "test habit 1 renamed", "daily")
+        assert get_habit_details(self.db, self.habit_id_1, "user", 1)[1] == "test habit 1 renamed"
+        assert habit_cache.stats()['misses'] == 2
+
+        # A row read by another connection before a transaction commits is not left in the cache after the commit
+        read_db = get_read_db("test.db")
+        with transaction(self.db, immediate=True):
+            update_habit(self.db, self.habit_id_1, "test habit 1 renamed again", "daily")
+            assert get_habit_details(read_db, self.habit_id_1, "user", 1).task == "test habit 1 renamed"
+        assert get_habit_details(read_db, self.habit_id_1, "user", 1).task == "test habit 1 renamed again"
+        close_read_dbs()
+
+        # A row read before an invalidation is not stored
+        generation = habit_cache.generation
+        habit_cache.invalidate(("test.db", 0))
+        assert not habit_cache.set(("test.db", 0), "old row", generation)
+        assert habit_cache.set(("test.db", 0), "new row", habit_cache.generation)
+
+    def test_habit_exists(self):
+        """Method to test the habit id validation of the db module, with and without the cache."""
+
+        # Habit 1 is an active user habit, habit 999 does not exist
+        assert habit_exists(self.db, self.habit_id_1, "user", 1)
+        assert not habit_exists(self.db, 999, "user", 1)
+
+        # A deleted habit is no longer valid
+        delete_habit(self.db, self.habit_id_2)
+        assert not habit_exists(self.db, self.habit_id_2, "user", 1)
+        assert not habit_exists(self.db, self.habit_id_2, "user", 1, use_cache=False)
+
+    def test_users(self):
+        """Method to test the multi-user support of the db module.
+        Test that the habits, checkoffs and streaks of a second user are kept apart from the ones of the default user."""
+
+        # A second user creates a daily habit and completes it twice
+        user_id = add_user(self.db, "second user")
+        habit_id = add_habit(self.db, "second user habit", "daily", created_on="2024-02-17", user_id=user_id)
+        add_checkoff(self.db, habit_id, checkedoff_on="2024-02-17", user_id=user_id)
+        add_checkoff(self.db, habit_id, checkedoff_on="2024-02-18", user_id=user_id)
+
+        # Check that each user only sees their own habits
+        assert [habit[0] for habit in get_habits_by_periodicity(self.db, "daily", "user", 1, user_id=user_id)] == [habit_id]
+        assert [habit[0] for habit in get_habits_by_periodicity(self.db, "daily", "user", 1)] == [self.habit_id_1]
+        assert get_habit_details(self.db, habit_id, "user", 1) is None
+
+        # Check that the longest streak is computed per user and a habit of another user cannot be checked off
+        assert get_longest_streak_all_habits(self.db, "user", 1, user_id=user_id)[:2] == (habit_id, 2)
+        add_checkoff(self.db, self.habit_id_1, checkedoff_on="2024-02-23", user_id=user_id)
+        assert last_checkedoff_on(self.db, self.habit_id_1) == "2024-02-22"
+
+    def test_shards(self, tmp_path, monkeypatch):
+        """Method to test the shard router of the shards module.
+        Test that users are routed to their shard, moved when a shard is added and that the longest streak is found over all shards."""
+        monkeypatch.chdir(tmp_path)
+        router = ShardRouter(["shard_0.db", "shard_1.db"])
+        try:
+            # Each user gets a daily habit completed user_id days in a row, in the user's shard
+            for user_id in range(1, 21):
+                router.call(add_user, user_id, f"user {user_id}")
+                habit_id = router.call(add_habit, user_id, "sharded habit", "daily", created_on="2024-01-01")
+                router.call(add_checkoffs_bulk, user_id, [(habit_id, f"2024-01-{day:02d}") for day in range(1, user_id + 1)])
+            assert len({router.shard_for(user_id) for user_id in range(1, 21)}) == 2
+
+            # After adding a shard, only the users routed to the new shard are moved and they keep their data
+            previous_shards = {user_id: router.shard_for(user_id) for user_id in range(1, 21)}
+            router.add_shard("shard_2.db")
+            moved_users = [user_id for user_id in range(1, 21) if router.shard_for(user_id) != previous_shards[user_id]]
+            assert len(moved_users) > 0
+            assert all(router.shard_for(user_id) == "shard_2.db" for user_id in moved_users)
+            for user_id in moved_users:
+                # The habit of the user is cached in its old shard, and its future id is cached as missing in the new shard
+                source_db = get_db(previous_shards[user_id])
+                old_habit_id = get_habit_ids(source_db, user_id)[0]
+                assert get_habit_details(source_db, old_habit_id, "user", 1, user_id) is not None
+                next_habit_id = router.get_db(user_id).execute("SELECT COALESCE(MAX(habit_id), 0) + 1 FROM habits").fetchone()[0]
+                assert get_habit_details(router.get_db(user_id), next_habit_id, "user", 1, user_id) is None
+                new_habit_ids = router.move_user(user_id, previous_shards[user_id])
+                assert get_habit_details(source_db, old_habit_id, "user", 1, user_id) is None
+                assert get_habit_details(router.get_db(user_id), new_habit_ids[old_habit_id], "user", 1, user_id) is not None
+                source_db.close()
+                streak = router.call(get_longest_streak_one_habit, user_id, list(new_habit_ids.values())[0], "user", 1)
+                assert streak[1] == user_id
+                assert router.get_db(user_id).execute("SELECT COUNT(*) FROM checkoffs WHERE checkedoff_day IS NULL").fetchone()[0] == 0
+
+            # The longest streak of all users is the one of user 20, wherever it is stored
+            longest_streak = longest_streak_all_shards(router, processes=2)
+            assert longest_streak[0] == router.shard_for(20)
+            assert longest_streak[2] == 20
+        finally:
+            router.close()
+
+    def test_async_db(self, monkeypatch):
+        """Method to test the async_db module.
+        Test that concurrent checkoffs are committed in groups, that a failing write does not prevent the others from being saved
+        and that the read-only connections of the reader threads are closed with the database."""
+        opened, closed = set(), set()
+        monkeypatch.setattr("db.get_read_db", lambda name, get_read_db=get_read_db: opened.add(threading.get_ident()) or get_read_db(name))
+        monkeypatch.setattr("db.close_read_dbs", lambda close_read_dbs=close_read_dbs: closed.add(threading.get_ident()) or close_read_dbs())
+
+        async def concurrent_writes():
+            async with AsyncDatabase("test.db") as database:
+                # 30 checkoffs of habit 1 and an invalid habit (no task) sent at the same time
+                checkoffs = [database.add_checkoff(self.habit_id_1, checkedoff_on=f"2024-03-{day:02d}") for day in range(1, 31)]
+                results = await asyncio.gather(database.add_habit(None, "daily"), *checkoffs, return_exceptions=True)
+                last_checkoff = await database.last_checkedoff_on(self.habit_id_1)
+                return database, results, last_checkoff
+
+        database, results, last_checkoff = asyncio.run(concurrent_writes())
+        assert isinstance(results[0], sqlite3.IntegrityError)
+        assert last_checkoff == "2024-03-30"
+        assert database.writes == 31
+        assert database.commits < database.writes
+        assert opened and opened <= closed
+
+    def test_service(self):
+        """Method to test the service module.
+        Test that a habit created and checked off through the HTTP endpoints is saved, that invalid requests are rejected and that the load test reaches the service."""
+        server = HabitServer(("127.0.0.1", 0), "test.db", workers=4, leaderboard_ttl=60)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        port = server.server_address[1]
+        try:
+            # Create a habit and mark it as completed on the same kept-alive connection
+            connection = http.client.HTTPConnection("127.0.0.1", port)
+            connection.request("GET", "/leaderboard?ongoing=1")
+            assert json.loads(connection.getresponse().read()) == []
+            connection.request("POST", "/habits", json.dumps({"task": "Stretch", "periodicity": "daily"}))
+            response = connection.getresponse()
+            habit_id = json.loads(response.read())["habit_id"]
+            assert response.status == 201
+            connection.request("POST", f"/habits/{habit_id}/checkoffs")
+            assert json.loads(connection.getresponse().read()) == {"habit_id": habit_id, "streak_active": True}
+            assert get_longest_streak_one_habit(self.db, habit_id, "user", 1)[1] == 1
+            # The checkoff is merged into the leaderboard kept in memory, without reading it again
+            connection.request("GET", "/leaderboard?ongoing=1")
+            assert [(entry["habit_id"], entry["streak"]) for entry in json.loads(connection.getresponse().read())] == [(habit_id, 1)]
+            assert server.leaderboards.values()[0].refreshes == 1
+
+            # Check that an empty task and an unknown habit are rejected
+            connection.request("POST", "/habits", json.dumps({"task": "", "periodicity": "daily"}))
+            response = connection.getresponse()
+            assert response.status == 400 and json.loads(response.read())["error"] == error_1.get_error_message()
+            connection.request("DELETE", "/habits/999")
+            response = connection.getresponse()
+            assert response.status == 404 and json.loads(response.read())["error"] == error_3.get_error_message()
+
+            # Check that an id too large for SQLite and an invalid Content-Length are answered with 400
+            connection.request("DELETE", "/habits/" + "9" * 30)
+            response = connection.getresponse()
+            assert response.status == 400 and "error" in json.loads(response.read())
+            connection.putrequest("POST", "/habits")
+            connection.putheader("Content-Length", "abc")
+            connection.endheaders()
+            response = connection.getresponse()
+            assert response.status == 400 and "error" in json.loads(response.read())
+            connection.close()
+
+            # Check that the load test sends all its requests without errors
+            metrics = run_load_test("127.0.0.1", port, requests=40, concurrency=4)
+            assert metrics["requests"] == 40 and metrics["errors"] == 0
+
+            # A checkoff load test sent to several habits records one checkoff per request
+            habit_ids = [add_habit(self.db, f"load test {number}", "daily") for number in range(6)]
+            metrics = run_load_test("127.0.0.1", port, "POST", [f"/habits/{habit_id}/checkoffs" for habit_id in habit_ids], requests=6, concurrency=3)
+            assert metrics["errors"] == 0
+            placeholders = ", ".join("?" * len(habit_ids))
+            assert self.db.execute(f"SELECT COUNT(DISTINCT habit_id) FROM checkoffs WHERE habit_id IN ({placeholders})", habit_ids).fetchone()[0] == 6
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_cli(self, monkeypatch, capsys):
+        """Method to test the main loop of the functions_main module with scripted input.
+        Test that more actions than the recursion limit can be performed, invalid answers being asked again, and that the input ending quits the program."""
+        # 1500 views of the habit list, then a habit created after an empty task name and an invalid periodicity
+        script = "2\n\n" * 1500 + "1\n\nRead\n4\n1\n\n"
+        monkeypatch.setattr("sys.stdin", io.StringIO(script))
+        assert run(self.db) == 1501
+        assert "Thank you for using MindMold. Goodbye!" in capsys.readouterr().out
+        assert len(get_habits_by_periodicity(self.db, "daily", "user", 1)) == 2
+
+    def test_batch(self):
+        """Method to test the batch module.
+        Test that the commands of a JSON Lines and of a CSV batch are applied, invalid commands being skipped, and that the streaks are rebuilt."""
+        jsonl = [
+            '{"op": "add", "task": "Journal", "periodicity": "daily", "date": "2024-03-01", "ref": "journal"}',
+            '{"op": "checkoff", "habit_id": "journal", "date": "2024-03-02"}',
+            '{"op": "checkoff", "habit_id": "journal", "date": "2024-03-01"}',
+            '{"op": "checkoff", "habit_id": "journal", "date": "2024-03-03"}',
+            '{"op": "add", "task": "", "periodicity": "daily"}',
+            'not json',
+        ]
+        metrics = run_batch(self.db, jsonl, chunk_size=2)
+        assert (metrics["rows"], metrics["applied"]) == (6, 4)
+        assert [line_number for line_number, _ in metrics["errors"]] == [5, 6]
+        journal_id = get_habits_by_periodicity(self.db, "daily", "user", 1)[-1][0]
+        assert get_longest_streak_one_habit(self.db, journal_id, "user", 1)[1:3] == (3, "2024-03-01")
+
+        # Rename the habit and delete habit 2 from a CSV batch
+        csv_lines = ["op,habit_id,task,periodicity,date", f"update,{journal_id},Write,,", f"delete,{self.habit_id_2},,,", "delete,999,,,"]
+        metrics = run_batch(self.db, csv_lines, format="csv")
+        assert metrics["applied"] == 2 and metrics["errors"] == [(4, "habit 999 does not exist")]
+        assert get_habit_details(self.db, journal_id, "user", 1)[1:3] == ("Write", "daily")
+        assert get_habit_details(self.db, self.habit_id_2, "user", 1) is None
+
+        # Ids too large for SQLite are reported and skipped, the commands of their chunk are still applied
+        large_ids = ['{"op": "add", "task": "Walk", "periodicity": "daily"}', '{"op": "checkoff", "habit_id": 99999999999999999999999}',
+                     '{"op": "add", "task": "Run", "periodicity": "daily", "user_id": 99999999999999999999999}']
+        metrics = run_batch(self.db, large_ids)
+        assert metrics["applied"] == 1 and [line_number for line_number, _ in metrics["errors"]] == [2, 3]
+
+    def test_export(self, tmp_path):
+        """Method to test the export module.
+        Test that the checkoffs are exported in the CSV, JSON Lines and columnar formats, read in batches smaller than the table."""
+        checkoffs = self.db.execute("SELECT checkoff_id, user_id, habit_id, checkedoff_on FROM checkoffs ORDER BY checkoff_id").fetchall()
+
+        assert export(self.db, "checkoffs", tmp_path / "checkoffs.csv", "csv", batch_size=3) == len(checkoffs)
+        lines = (tmp_path / "checkoffs.csv").read_text().splitlines()
+        assert lines[0] == "checkoff_id,user_id,habit_id,checkedoff_on" and len(lines) == len(checkoffs) + 1
+
+        assert export(self.db, "checkoffs", tmp_path / "checkoffs.jsonl", "jsonl", batch_size=3) == len(checkoffs)
+        first = json.loads((tmp_path / "checkoffs.jsonl").read_text().splitlines()[0])
+        assert first == dict(zip(("checkoff_id", "user_id", "habit_id", "checkedoff_on"), checkoffs[0]))
+
+        assert export(self.db, "checkoffs", tmp_path / "checkoffs", "columnar", batch_size=3) == len(checkoffs)
+        # Without pyarrow, the columnar export is a directory of column files
+        if (tmp_path / "checkoffs").is_dir():
+            schema = json.loads((tmp_path / "checkoffs" / "_schema.json").read_text())
+            assert schema["rows"] == len(checkoffs)
+            dates = [value for line in (tmp_path / "checkoffs" / "checkedoff_on.jsonl").read_text().splitlines() for value in json.loads(line)]
+            assert dates == [checkoff[3] for checkoff in checkoffs]
+
+    def test_import(self):
+        """Method to test the importer module and the unique checkoff per habit and day.
+        Test that duplicated, already recorded, unknown and invalid checkoffs are skipped and that the streak is rebuilt with the imported history."""
+        history = [(self.habit_id_1, "2024-02-24"), (self.habit_id_1, "2024-02-23"), (self.habit_id_1, "2024-02-24"),
+                   (self.habit_id_1, "2024-02-22"), (999, "2024-02-24"), (self.habit_id_1, "2024-02-30"), ("abc", "2024-02-25"), (10 ** 30, "2024-02-25")]
+        metrics = import_checkoffs(self.db, history, chunk_size=4)
+        assert (metrics["read"], metrics["skipped"], metrics["unique"], metrics["imported"], metrics["habits_rebuilt"]) == (8, 3, 4, 2, 1)
+        assert get_longest_streak_one_habit(self.db, self.habit_id_1, "user", 1)[1:3] == (8, "2024-02-17")
+
+        # Check that a habit cannot be checked off twice on the same day
+        assert add_checkoff(self.db, self.habit_id_1, checkedoff_on="2024-02-24") is False
+        assert add_checkoff(self.db, self.habit_id_1, checkedoff_on="2024-02-25") is True
+
+    def test_pagination(self, monkeypatch, capsys):
+        """Method to test the paginated habit list of the db and analysis modules.
+        Test that the pages follow each other by habit_id and that the list stops when the user types q."""
+        habit_ids = [self.habit_id_1, self.habit_id_2] + [add_habit(self.db, f"habit {number}", "daily") for number in range(5)]
+        first_page = get_habits_page(self.db, "user", 1, page_size=3)
+        assert [habit[0] for habit in first_page] == habit_ids[:3] and len(first_page[0]) == 5
+        second_page = get_habits_page(self.db, "user", 1, first_page[-1][0], page_size=3, periodicity="daily")
+        assert [habit[0] for habit in second_page] == habit_ids[3:6]
+
+        # Display pages of 2 habits, see the second page then stop
+        answers = iter(["", "q"])
+        monkeypatch.setattr("builtins.input", lambda prompt="": next(answers))
+        Analysis().display_habit_list(self.db, "user", 1, page_size=2)
+        output = capsys.readouterr().out
+        assert output.count("Habit # ") == 4 and output.endswith("End of list.\n")
+
+    def test_leaderboard(self):
+        """Method to test the streak leaderboard of the db and leaderboard modules.
+        Test the ranking of the streaks with their habit names and that the in-memory leaderboard merges new streaks without querying again."""
+        leaderboard = get_streak_leaderboard(self.db, "user", 1, k=5)
+        assert [(habit[0], habit[1], habit[3]) for habit in leaderboard] == [(self.habit_id_1, "test habit 1", 6), (self.habit_id_2, "test habit 2", 4)]
+        assert [habit[0] for habit in get_streak_leaderboard(self.db, "user", 1, periodicity="weekly")] == [self.habit_id_2]
+        # The streaks of the test habits ended in 2024
+        assert get_streak_leaderboard(self.db, "user", 1, ongoing_only=True) == []
+
+        top_streaks = StreakLeaderboard(k=1, ttl=60)
+        assert top_streaks.top(self.db)[0][0] == self.habit_id_1
+        top_streaks.offer((self.habit_id_2, "test habit 2", "weekly", 9, "2024-01-17", None))
+        assert top_streaks.top(self.db) == [(self.habit_id_2, "test habit 2", "weekly", 9, "2024-01-17", None)]
+        assert top_streaks.refreshes == 1
+
+        # Habits already in the leaderboard are found through their position in the heap
+        top_streaks = StreakLeaderboard(k=3, ttl=60, user_id=None)
+        top_streaks.top(self.db)
+        streaks = {self.habit_id_1: 6, self.habit_id_2: 4}
+        for habit_id, streak in [(10, 3), (11, 5), (self.habit_id_2, 7), (10, 8), (12, 6), (11, 9), (self.habit_id_1, 10)]:
+            streaks[habit_id] = streak
+            top_streaks.offer((habit_id, "", "daily", streak, None, None))
+        assert [(entry[0], entry[3]) for entry in top_streaks.top(self.db)] == sorted(streaks.items(), key=lambda item: (-item[1], item[0]))[:3]
+        assert top_streaks.refreshes == 1
+
+    def test_habit_analytics(self):
+        """Method to test the habit_analytics module.
+        Test the completion rate, rolling adherence, weekday heatmap and streak histogram of the test habits, computed for both habits at once."""
+        checkoffs = CheckoffArrays.load(self.db)
+        assert checkoffs.habit_ids.tolist() == [self.habit_id_1, self.habit_id_2]
+
+        # Habit 1 was completed 6 days out of 9 and habit 2 4 weeks out of 6
+        assert [round(rate, 3) for rate in completion_rate(checkoffs, as_of="2024-02-25")] == [0.667, 0.667]
+        # 3, 4 then 5 checkoffs of habit 1 in the last 7 days on 2024-02-19, 20 and 21
+        adherence = rolling_adherence(checkoffs, window=7, days=3, as_of="2024-02-21")
+        assert [round(value, 3) for value in adherence[0]] == [0.429, 0.571, 0.714]
+
+        # Habit 1 was completed from Saturday to Thursday, habit 2 on Wednesdays
+        assert weekday_heatmap(checkoffs).tolist() == [[1, 1, 1, 1, 0, 1, 1], [0, 0, 4, 0, 0, 0, 0]]
+        histogram = streak_histogram(checkoffs)
+        assert histogram["daily"][6] == 1 and histogram["weekly"][4] == 1
+
+        # A stored date SQLite cannot read has no day: it is left out without shifting the checkoffs of the next habit
+        self.db.execute("INSERT INTO checkoffs (user_id, habit_id, checkedoff_on) VALUES (1, ?, 'not a date')", (self.habit_id_1,))
+        checkoffs = CheckoffArrays.load(self.db)
+        assert checkoffs.offsets.tolist() == [0, 6, 10]
+        assert weekday_heatmap(checkoffs).tolist()[1] == [0, 0, 4, 0, 0, 0, 0]
+
+    def test_benchmark(self, tmp_path):
+        """Method to test the benchmark module.
+        Test that the seeded generator always builds the same dataset, that every benchmark is timed and that a slower run is flagged as a regression."""
+        results = run_suite([1000], repeat=3, directory=tmp_path)
+        dataset = results["sizes"]["1000"]["dataset"]
+        assert dataset["checkoffs"] == run_suite([1000], repeat=1, directory=tmp_path)["sizes"]["1000"]["dataset"]["checkoffs"]
+        assert 500 < dataset["checkoffs"] < 1500
+        assert set(results["sizes"]["1000"]["benchmarks"]) == {"add_checkoff", "check_habit_continuity", "get_longest_streak_all_habits",
+                                                               "get_habits_by_periodicity", "list_habits"}
+
+        # Check that a run twice as slow as the baseline is a regression, and the baseline itself is not
+        slower = json.loads(json.dumps(results))
+        slower["sizes"]["1000"]["benchmarks"]["list_habits"]["median_ms"] = results["sizes"]["1000"]["benchmarks"]["list_habits"]["median_ms"] * 2 + 1
+        assert [regression[1] for regression in compare(slower, results)] == ["list_habits"]
+        assert compare(results, results) == []
+
+    def test_instrumentation(self, tmp_path):
+        """Method to test the instrumentation module.
+        Test that the calls made through the modules importing the db functions are counted, that commits are traced
+        and that a slow call is logged with its query plan."""
+        metrics = instrument(slow_ms=0, slow_log=str(tmp_path / "slow.jsonl"))
+        try:
+            attach(self.db)
+            assert habit.get_last_checkoff_day is not get_last_checkoff_day.__wrapped__
+            Habit().mark_as_completed(self.db, self.habit_id_1, "user", 1)
+            habit_list = get_habits_by_periodicity(self.db, "daily", "user", 1)
+        finally:
+            uninstrument()
+        assert not hasattr(habit.get_last_checkoff_day, "__wrapped__")
+
+        assert metrics.calls["add_checkoff"] == 1 and metrics.calls["get_last_checkoff_day"] == 1
+        assert metrics.rows["get_habits_by_periodicity"] == len(habit_list) == 1
+        assert metrics.commits == 1
+
+        # Check that the slow-query log has the query plan of the periodicity query
+        entries = [json.loads(line) for line in (tmp_path / "slow.jsonl").read_text().splitlines()]
+        periodicity_entry = [entry for entry in entries if entry["function"] == "get_habits_by_periodicity"][0]
+        assert "idx_habits" in " ".join(periodicity_entry["statements"][0]["plan"])
+
+        # Check the Prometheus histogram of the periodicity query
+        text = metrics.prometheus()
+        assert 'habits_db_call_duration_seconds_count{function="get_habits_by_periodicity"} 1' in text
+        assert 'habits_db_call_duration_seconds_bucket{function="get_habits_by_periodicity",le="+Inf"} 1' in text
+
     def test_analysis(self):
         """Method to test the functionality of the analysis module.
         Test of the display_habit_list, display_longest_streak_all_habits, get_longest_streak_one_habit,
@@ -93,7 +527,199 @@ class Testing:
         assert len(habit_list) == 1
         assert habit_list[0][0] == self.habit_id_1
 
+    def test_migrations(self):
+        """Method to test the schema migrations of the db module.
+        Test that the database is at the latest version and that the checkoff lookup uses the covering index."""
+
+        # Check that the schema version is the latest one
+        assert get_schema_version(self.db) == SCHEMA_VERSION
+
+        # Check that the last checkoff lookup is answered by the index instead of a full scan
+        query_plan = self.db.execute("""EXPLAIN QUERY PLAN
+            SELECT checkedoff_on FROM checkoffs WHERE user_id = 1 AND habit_id = ? ORDER BY checkedoff_on DESC LIMIT 1""", (self.habit_id_1,)).fetchall()
+        assert "idx_checkoffs_user_habit_date" in query_plan[0][3]
+
+    def test_day_numbers(self):
+        """Method to test the integer day numbers of the checkoffs.
+        Test that the stored columns match period_bucket and that a database of version 6 gets its day numbers and keeps its streak summaries valid."""
+        checkoff = self.db.execute("""SELECT checkedoff_on, checkedoff_day, checkedoff_week, checkedoff_month FROM checkoffs
+            WHERE habit_id = ? ORDER BY checkedoff_on DESC LIMIT 1""", (self.habit_id_2,)).fetchone()
+        assert checkoff[1:] == (period_bucket("daily", checkoff[0]), period_bucket("weekly", checkoff[0]), period_bucket("monthly", checkoff[0]))
+        assert checkoff[1] == 19760 and checkoff[2] == 2823
+        assert get_last_checkoff_day(self.db, self.habit_id_2, "user", 1) == ("weekly", 19760, 24289)
+        # The day numbers are stored with the checkoff (hidden is 2 or 3 for a generated column) and indexed with the habit
+        columns = {column[1]: column[6] for column in self.db.execute("PRAGMA table_xinfo(checkoffs)")}
+        assert columns["checkedoff_day"] == columns["checkedoff_week"] == columns["checkedoff_month"] == 0
+        query_plan = self.db.execute("EXPLAIN QUERY PLAN SELECT group_concat(checkedoff_day) FROM checkoffs WHERE habit_id = ?", (self.habit_id_2,)).fetchall()
+        assert "COVERING INDEX idx_checkoffs_habit_day" in query_plan[0][3]
+
+        # An invalid date is refused before it is inserted, so the next commit does not save it
+        try:
+            add_checkoff(self.db, self.habit_id_1, checkedoff_on="2024-13-40")
+            assert False
+        except ValueError:
+            pass
+        self.db.commit()
+        assert last_checkedoff_on(self.db, self.habit_id_1) == "2024-02-22"
+
+        # A summary of version 6 counted the weeks from the julian day 0: the migration moves it to the new numbering
+        state_query = "SELECT last_period, current_streak FROM streak_state WHERE habit_id = ?"
+        habit_2_state = self.db.execute(state_query, (self.habit_id_2,)).fetchone()
+        self.db.execute("UPDATE streak_state SET last_period = last_period + 348655 WHERE habit_id = ?", (self.habit_id_2,))
+        self.db.execute("DROP INDEX idx_checkoffs_habit_day")
+        for column in ("checkedoff_day", "checkedoff_week", "checkedoff_month"):
+            self.db.execute(f"ALTER TABLE checkoffs DROP COLUMN {column}")
+        self.db.execute("PRAGMA user_version = 6")
+        self.db.commit()
+        migrate(self.db)
+        assert self.db.execute(state_query, (self.habit_id_2,)).fetchone() == habit_2_state
+        assert get_last_checkoff_day(self.db, self.habit_id_2, "user", 1) == ("weekly", 19760, 24289)
+
+        # The migration fills the day numbers of the existing checkoffs and every insert writes them, including the checkoffs dated by SQLite
+        add_checkoffs_bulk(self.db, [(self.habit_id_1, None), (self.habit_id_2, "2024-02-14")])
+        mismatches = self.db.execute(f"SELECT COUNT(*) FROM checkoffs WHERE checkedoff_day IS NOT {epoch_day_sql('checkedoff_on')}").fetchone()[0]
+        assert mismatches == 0
+
+    def test_completion_bitmaps(self):
+        """Method to test the completion bitmaps of the db module.
+        Test the completion of a day and of a week, the longest and current runs, and that the bitmap follows a change of periodicity."""
+        assert was_completed(self.db, self.habit_id_1, "2024-02-20")
+        assert not was_completed(self.db, self.habit_id_1, "2024-02-23")
+        # Habit 2 was completed on Wednesday 2024-01-24: the whole week counts
+        assert was_completed(self.db, self.habit_id_2, "2024-01-28")
+        assert not was_completed(self.db, self.habit_id_2, "2024-02-14")
+
+        # The current run of habit 1 is ongoing on the day after its last checkoff, broken on the day after
+        assert get_completion_runs(self.db, self.habit_id_1, as_of="2024-02-23") == (6, 6)
+        assert get_completion_runs(self.db, self.habit_id_1, as_of="2024-02-24") == (6, 0)
+        add_checkoff(self.db, self.habit_id_1, checkedoff_on="2024-02-24")
+        assert get_completion_runs(self.db, self.habit_id_1, as_of="2024-02-24") == (6, 1)
+
+        # As a weekly habit, habit 1 was completed in the weeks of 2024-02-12 and 2024-02-19
+        update_habit(self.db, self.habit_id_1, "test habit 1", "weekly")
+        assert get_completion_runs(self.db, self.habit_id_1, as_of="2024-02-24") == (2, 2)
+
+    def test_habit_store(self):
+        """Method to test the named rows of the db module and the HabitStore of the habit_analytics module.
+        Test the columns of the rows, that rows pickle as plain tuples, and the arrays and tasks of the store."""
+        habit_details = get_habit_details(self.db, self.habit_id_1, "user", 1)
+        assert (habit_details.task, habit_details.periodicity) == ("test habit 1", "daily")
+        assert pickle.loads(pickle.dumps(habit_details)) == tuple(habit_details)
+        assert [row.task for row in self.db.execute("SELECT task FROM habits ORDER BY habit_id;")] == ["test habit 1", "test habit 2"]
+        cur = self.db.cursor()
+        cur.row_factory = None
+        assert type(cur.execute("SELECT task FROM habits;").fetchone()) is tuple
+        # A row factory set on the connection replaces the named rows
+        self.db.row_factory = sqlite3.Row
+        assert type(self.db.execute("SELECT task FROM habits;").fetchone()) is sqlite3.Row
+        self.db.row_factory = named_row
+        assert Habit.__slots__ and not hasattr(Habit(), "__dict__")
+
+        add_habit(self.db, "tâche mensuelle", "monthly", created_on="2024-01-01")
+        store = HabitStore.load(self.db, batch_size=2)
+        assert len(store) == 3
+        assert store.habit_ids[0] == self.habit_id_1
+        assert store.task(1) == "test habit 2" and store.task(2) == "tâche mensuelle"
+        # 2024-02-17 is day 19770 since 1970-01-01
+        assert store.created_on[0] == 19770
+        assert store.count_by_periodicity() == {"daily": 1, "weekly": 1, "monthly": 1}
+        assert list(store.index_of([self.habit_id_2, 999999])) == [1, -1]
+        assert store.nbytes() < 200
+
+    def test_transactions(self):
+        """Method to test the transaction context manager and the bulk functions of the db module.
+        Test that bulk writes are committed together and that a failed transaction is rolled back."""
+
+        # Check that bulk checkoffs and streak increments are applied in one transaction
+        with transaction(self.db):
+            add_checkoffs_bulk(self.db, [(self.habit_id_1, "2024-02-23"), (self.habit_id_2, "2024-02-14")])
+            increment_streaks_bulk(self.db, [self.habit_id_1, self.habit_id_2])
+        assert last_checkedoff_on(self.db, self.habit_id_1) == "2024-02-23"
+        assert get_longest_streak_one_habit(self.db, self.habit_id_2, "user", 1)[1] == 5
+
+        # Check that an error inside the transaction discards all its changes
+        try:
+            with transaction(self.db):
+                add_checkoff(self.db, self.habit_id_1, checkedoff_on="2024-02-24")
+                raise ValueError
+        except ValueError:
+            pass
+        assert last_checkedoff_on(self.db, self.habit_id_1) == "2024-02-23"
+
+        # The bulk insert holds the write lock from its first read: another connection cannot commit while the checkoffs are read
+        other_db = get_db("test.db")
+        other_db.execute("PRAGMA busy_timeout = 0;")
+        def checkoffs():
+            try:
+                add_checkoff(other_db, self.habit_id_2, checkedoff_on="2024-02-21")
+            except sqlite3.OperationalError:
+                other_db.rollback()
+            yield self.habit_id_1, "2024-02-24"
+        assert add_checkoffs_bulk(self.db, checkoffs()) == 1
+        other_db.close()
+
+    def test_connections(self):
+        """Method to test the connections of the db module.
+        Test that the database uses write-ahead logging and that the per-thread read connection sees the data but cannot write."""
+
+        # Check that the database is in WAL mode
+        journal_mode = self.db.execute("PRAGMA journal_mode").fetchone()[0]
+        assert journal_mode == "wal"
+
+        # Check that the read connection is reused and reads the committed habits
+        read_db = get_read_db("test.db")
+        assert get_read_db("test.db") is read_db
+        habit_list = get_habits_by_periodicity(read_db, "weekly", "user", 1)
+        assert habit_list[0][0] == self.habit_id_2
+
+        # Check that the read connection refuses writes
+        try:
+            add_checkoff(read_db, self.habit_id_1)
+            assert False
+        except sqlite3.OperationalError:
+            pass
+
+    def test_rebuild_streaks(self):
+        """Method to test the streak engine of the db module.
+        Test that the streaks are recomputed from the checkoffs, a missed day splitting the history in two streaks."""
+
+        # Break habit 1 on 2024-02-23 and complete it again on 2024-02-24
+        add_checkoff(self.db, self.habit_id_1, checkedoff_on="2024-02-24")
+        streaks_written = rebuild_streaks(self.db, as_of="2024-02-25")
+        assert streaks_written == 3
+
+        # Check that the first streak of habit 1 ended after 6 days and the second one is still ongoing
+        habit_1_streaks = self.db.execute("""SELECT started_on, ended_on, current_streak, is_active
+            FROM streaks WHERE habit_id = ? ORDER BY started_on""", (self.habit_id_1,)).fetchall()
+        assert habit_1_streaks == [("2024-02-17", "2024-02-22", 6, 0), ("2024-02-24", None, 1, 1)]
+
+        # Check that the 4 consecutive weeks of habit 2 are one streak, ended as the habit was not completed for 2 weeks
+        habit_2_streak = get_longest_streak_one_habit(self.db, self.habit_id_2, "user", 1)
+        assert habit_2_streak[1:] == (4, "2024-01-17", "2024-02-07")
+
+    def test_streak_state(self):
+        """Method to test the streak summary maintained by the db module on every checkoff.
+        Test that a missed day ends the longest streak and that the incremental summary matches the one rebuilt from the history."""
+
+        # Break habit 1 on 2024-02-23, complete it twice on 2024-02-24 and on 2024-02-25
+        add_checkoff(self.db, self.habit_id_1, checkedoff_on="2024-02-24")
+        add_checkoff(self.db, self.habit_id_1, checkedoff_on="2024-02-24")
+        add_checkoff(self.db, self.habit_id_1, checkedoff_on="2024-02-25")
+        state_query = """SELECT last_checkedoff_on, current_streak, current_started_on, longest_streak, longest_started_on, longest_ended_on
+            FROM streak_state WHERE habit_id = ?"""
+        habit_1_state = self.db.execute(state_query, (self.habit_id_1,)).fetchone()
+        assert habit_1_state == ("2024-02-25", 2, "2024-02-24", 6, "2024-02-17", "2024-02-22")
+
+        # Check that rebuilding from the full history gives the same summary
+        rebuild_streaks(self.db)
+        assert self.db.execute(state_query, (self.habit_id_1,)).fetchone() == habit_1_state
+
     def teardown_method(self):
-        """Method to close the database connection and delete the test database after testing."""
+        """Method to close the database connections and delete the test database (and its WAL files) after testing."""
         import os
-        os.remove("test.db")
+        self.db.close()
+        close_read_dbs()
+        habit_cache.clear()
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists("test.db" + suffix):
+                os.remove("test.db" + suffix)